@@ -10,9 +10,132 @@ import os
 import json
 import sqlite3
 import datetime
-from typing import List, Dict, Any, Tuple, Optional, Union
-from PIL import Image, ExifTags
+import cProfile
+import collections
+import itertools
+import pathlib
+import re
+from html import escape
+from urllib.parse import quote
+from collections import namedtuple
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import List, Dict, Any, Tuple, Optional, Union, Iterable, Iterator, Deque, NamedTuple
 from config import DEFAULT_CONFIG
+from image_size import get_image_size, open_size_cache, close_size_cache, cached_image_size
+from thumbnails import make_thumbnails, thumbnail_folder as thumbnail_folder_for
+from fragment_cache import (FRAGMENT_CACHE_SUFFIX, open_fragment_cache, close_fragment_cache, 
+                            row_digest, get_fragment, put_fragment, prune_fragments)
+import profiling
+from profiling import timed
+from image_blobs import (SQLITE_MAX_VARIABLES, BlobImages, resolve_image_blobs, make_blob_thumbnails, 
+                         extract_originals, read_blob_sizes)
+from embedded_images import EMBED_BUDGET, EmbeddedImages
+from spatial_index import (SPATIAL_INDEX_SUFFIX, open_spatial_index, ids_in_bbox, ids_within_radius, 
+                           ids_in_polygon, nearest_notes)
+from search_index import (SEARCH_INDEX_SUFFIX, SEARCH_SCRIPT_SUFFIX, SearchScriptSink, open_search_index, 
+                          update_search_index, search as search_text, search_box)
+from form_json import FormControl, flatten_forms, load_controls, loads as form_json_loads
+from connection_pool import ConnectionPool, connection_for, shared_pool
+
+# Size of the write buffer used when streaming the report to disk
+WRITE_BUFFER_SIZE = 1024 * 1024
+
+
+REPORT_TITLE = "Inspection Report"
+
+PAGE_FOOTER = "</body>\n</html>\n"
+
+# Fixed HTML around each form and control; field data is escaped before it is filled in
+FORM_START = "<h3>{}</h3>\n<ul>\n"
+FORM_END = "</ul>\n"
+CONTROL_ITEM = "\t<li><em>{}: </em><strong> {}</strong></li>\n"
+# Browsers only load or decode a photo once it is scrolled near the screen
+IMAGE_ITEM = ("<p><a href=\"file:///{0}\"><img width=\"{1}\" height=\"{2}\" src=\"file:///{3}\" "
+              "loading=\"lazy\"/></a></p>\n")
+# A thumbnail whose original isn't on disk to link to
+THUMBNAIL_ITEM = "<p><img width=\"{0}\" height=\"{1}\" src=\"file:///{2}\" loading=\"lazy\"/></p>\n"
+EMBEDDED_IMAGE_ITEM = "<p><img alt=\"{0}\" width=\"{1}\" height=\"{2}\" src=\"{3}\" loading=\"lazy\"/></p>\n"
+IMAGE_LINK = "<p><a href=\"file:///{0}\">{1}</a></p>\n"
+IMAGE_NAME = "<p>{}</p>\n"
+IMAGE_ERROR = "<p>Error processing image: {}</p>\n"
+needs_escape = re.compile("[&<>\"']").search
+
+# The note columns the report reads, with the names each one goes by in Smash
+# databases and older exports, and the position the report originally read it
+# from for tables that use neither name
+NOTE_FIELDS = {
+    "id": (("_id",), 0),
+    "timestamp": (("ts", "modified"), 4),
+    "section": (("text", "section"), 6),
+    "forms": (("form", "forms"), 7),
+    "lat": (("lat",), None),
+    "lon": (("lon",), None),
+}
+
+# A note row holding only the columns the report reads
+Note = namedtuple("Note", list(NOTE_FIELDS))
+
+# Rows fetched from the notes cursor at a time
+NOTE_BATCH_SIZE = 500
+
+# Notes each render worker may have queued or in progress at once
+RENDER_WINDOW_PER_WORKER = 4
+
+class ReportOptions(NamedTuple):
+    """How a report is written, apart from where from and where to.
+
+    thumbnail_format: "jpeg", "webp" or None to show the originals.
+    workers: processes making thumbnails, None for one per CPU.
+    incremental: reuse the HTML of notes that haven't changed since the last run.
+    page_size, split_by_section: write pages with an index, see write_paged_report.
+    note_filters: passed on to iter_notes; db_options: passed on to open_db.
+    render_workers, render_mode: render notes on a "thread" or "process" pool.
+    embed_thumbnails, embed_budget: write thumbnails into the report as data
+    URIs, up to embed_budget bytes, so it can be sent on without the photos.
+    exports: file names (.jsonl, .csv, .parquet or .gpkg) written next to the
+    report from the same notes, see note_export.
+    search: give the report a search box, looking words up in a script
+    written next to it.
+    image_source: "folder", or "blobs" to read the photos from the imagedata
+    table; write_originals: write every original out, not only those the
+    report shows, so the thumbnails can link to them.
+    """
+    thumbnail_format: Optional[str] = "jpeg"
+    workers: Optional[int] = None
+    incremental: bool = False
+    page_size: Optional[int] = None
+    split_by_section: bool = False
+    note_filters: Optional[Dict[str, Any]] = None
+    db_options: Optional[Dict[str, Any]] = None
+    render_workers: int = 1
+    render_mode: str = "thread"
+    embed_thumbnails: bool = False
+    embed_budget: Optional[int] = EMBED_BUDGET
+    exports: Optional[List[str]] = None
+    search: bool = False
+    image_source: str = "folder"
+    write_originals: bool = False
+
+def check_report_options(options: ReportOptions) -> ReportOptions:
+    """Raise ValueError for options that can't be used together, and settle the others."""
+    if options.image_source not in ("folder", "blobs"):
+        raise ValueError(f"Unknown image source: {options.image_source}")
+    if options.render_mode not in ("thread", "process"):
+        raise ValueError(f"Unknown render mode: {options.render_mode}")
+    if options.embed_thumbnails:
+        if options.thumbnail_format is None:
+            raise ValueError("Embedding thumbnails needs a thumbnail_format")
+        if options.render_workers > 1 and options.render_mode == "process":
+            # The embedded thumbnails and their budget are shared between the notes
+            raise ValueError("Embedded thumbnails can only be rendered on threads")
+        if options.incremental:
+            # Notes taken from the cache would not count towards the budget
+            print("Embedded thumbnails are rendered in full, ignoring incremental")
+            options = options._replace(incremental=False)
+    return options
+
+def has_note_filters(options: ReportOptions) -> bool:
+    return any(value is not None for value in (options.note_filters or {}).values())
 
 # Use the config
 def generate_inspection_report(dbfile: Optional[str] = None, 
@@ -20,7 +143,14 @@ def generate_inspection_report(dbfile: Optional[str] = None,
                               output_file_name: Optional[str] = None, 
                               dummy_imagespec: str = "dummy.jpg", 
                               photo_size: int = 400,
-                              auto_open: bool = True) -> None:
+                              auto_open: bool = True,
+                              profile: bool = False,
+                              profile_json: Optional[str] = None,
+                              cprofile_file: Optional[str] = None,
+                              options: Optional[ReportOptions] = None,
+                              **report_options: Any) -> None:
+    """Write the report; report_options are fields of ReportOptions, replacing those of options."""
+    options = (options or ReportOptions())._replace(**report_options)
     # If parameters are not provided, use the config
     if dbfile is None or image_folder is None or output_file_name is None:
         config = DEFAULT_CONFIG
@@ -30,13 +160,26 @@ def generate_inspection_report(dbfile: Optional[str] = None,
         dummy_imagespec = config["dummy_imagespec"]
         photo_size = config["photo_size"]
     
-    db = open_db(dbfile)
-    all_rows = get_notes(db)
     output_filespec = os.path.join(image_folder, output_file_name)
-    remove_file(output_filespec)
-    web_text = get_contents(all_rows, db, image_folder, photo_size)
-    write_file(output_filespec=output_filespec, t=web_text)
-    db.close()
+    # Stage timings are only collected when asked for
+    profiling_run = profile or profile_json is not None or cprofile_file is not None
+    if profiling_run:
+        profiling.reset()
+        profiling.enable()
+    profiler = cProfile.Profile() if cprofile_file is not None else None
+    if profiler is not None:
+        profiler.enable()
+    try:
+        write_report(dbfile, image_folder, output_filespec, photo_size, options)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(cprofile_file)
+        if profiling_run:
+            profiling.disable()
+            print(profiling.format_summary())
+            if profile_json is not None:
+                profiling.dump_json(profile_json, {"dbfile": dbfile, "output": output_filespec})
     print("done")
     if auto_open:
         try: # should work on Windows
@@ -44,118 +187,552 @@ def generate_inspection_report(dbfile: Optional[str] = None,
         except OSError:
             print('Could not open URL')
 
+def write_report(dbfile: str, 
+                 image_folder: str, 
+                 output_filespec: str, 
+                 photo_size: int,
+                 options: Optional[ReportOptions] = None) -> None:
+    """Render the report, see ReportOptions.
+
+    With image_source="blobs" the photos are read from the imagedata table
+    instead of image_folder. Thumbnails are made from the blobs, and an
+    original is only written to image_folder when the report shows it (when
+    it has no thumbnail), or for every photo with write_originals; without
+    write_originals, thumbnails don't link to their originals.
+    """
+    options = check_report_options(options or ReportOptions())
+    note_filters = options.note_filters or {}
+    # The report only reads the database, so by default it is opened read-only
+    db = open_db(dbfile, **{"read_only": True, **(options.db_options or {})})
+    size_cache = None
+    fragment_cache = None
+    sinks: List[Any] = []
+    finished = False
+    # note_export builds on this module
+    from note_export import open_sinks, feed_sinks, close_sinks
+    try:
+        remove_file(output_filespec)
+        try:
+            size_cache = open_size_cache(image_folder)
+        except sqlite3.Error as e:
+            print(f"Could not open the image size cache: {str(e)}")
+        # Only the photos of the notes in the report are prepared
+        image_names = get_image_names(db, **note_filters)
+        image_blobs = None
+        if options.image_source == "blobs":
+            image_blobs = {os.path.join(image_folder, image_names[image_id]): imagedata_id 
+                           for image_id, imagedata_id in resolve_image_blobs(db, image_names).items()}
+        thumbnails = None
+        if options.thumbnail_format is not None:
+            thumbnail_folder = thumbnail_folder_for(image_folder, photo_size)
+            with profiling.stage("make_thumbnails"):
+                if image_blobs is not None:
+                    thumbnails = make_blob_thumbnails(dbfile, image_blobs, thumbnail_folder, photo_size, 
+                                                      options.thumbnail_format, workers=options.workers)
+                else:
+                    image_specs = [os.path.join(image_folder, name) for name in set(image_names.values())]
+                    thumbnails = make_thumbnails(image_specs, thumbnail_folder, photo_size, 
+                                                 options.thumbnail_format, workers=options.workers)
+        blob_images = None
+        if image_blobs is not None:
+            # The report shows the originals that have no thumbnail, so those are written out,
+            # and their sizes are read from the blobs rather than from the written files
+            shown = {image_spec: imagedata_id for image_spec, imagedata_id in image_blobs.items() 
+                     if thumbnails is None or image_spec not in thumbnails}
+            with profiling.stage("read_blob_sizes"):
+                blob_images = BlobImages(read_blob_sizes(dbfile, shown), options.write_originals)
+            with profiling.stage("extract_originals"):
+                extract_originals(dbfile, image_blobs if options.write_originals else shown)
+        embedded = EmbeddedImages(options.embed_budget) if options.embed_thumbnails else None
+        # Keep each note's HTML between runs and only render the notes that changed
+        if options.incremental:
+            settings = (f"{image_folder}|{photo_size}|{options.thumbnail_format}|"
+                        f"{options.image_source}|{options.write_originals}")
+            fragment_cache = open_fragment_cache(output_filespec + FRAGMENT_CACHE_SUFFIX, settings)
+        # Notes are rendered one at a time and written as they are produced,
+        # so memory use does not grow with the size of the survey
+        title = os.path.splitext(os.path.basename(output_filespec))[0]
+        render_options = dict(image_folder=image_folder, photo_size=photo_size, image_names=image_names, 
+                              size_cache=size_cache, thumbnails=thumbnails, fragment_cache=fragment_cache, 
+                              render_workers=options.render_workers, render_mode=options.render_mode, 
+                              embedded=embedded, blob_images=blob_images, 
+                              prune_fragment_cache=not has_note_filters(options))
+        rows = iter_notes(db, order_by_section=options.split_by_section, **note_filters)
+        if profiling.is_enabled():
+            rows = profiling.timed_iter("iter_notes", rows)
+        if options.exports:
+            output_folder = os.path.dirname(output_filespec)
+            sinks.extend(open_sinks(db, [os.path.join(output_folder, name) for name in options.exports], 
+                                    image_names, **note_filters))
+        note_links = None
+        if options.search:
+            # Paged reports fill in the page of each note as they are written
+            note_links = {}
+            search_script = output_filespec + SEARCH_SCRIPT_SUFFIX
+            sinks.append(SearchScriptSink(search_script, note_links))
+            render_options["search_script"] = os.path.basename(search_script)
+        if sinks:
+            rows = feed_sinks(rows, sinks)
+        if options.page_size or options.split_by_section:
+            write_paged_report(rows, db, output_filespec, page_size=options.page_size, 
+                               split_by_section=options.split_by_section, title=title, 
+                               note_links=note_links, **render_options)
+        else:
+            chunks = iter_contents(rows, db, title=title, **render_options)
+            write_chunks(output_filespec, chunks)
+        if embedded is not None:
+            print(embedded.summary())
+        finished = True
+    finally:
+        # Exports cut short by an error are dropped where the sink can do that
+        close_sinks(sinks, aborted=not finished)
+        if fragment_cache is not None:
+            close_fragment_cache(fragment_cache)
+        if size_cache is not None:
+            close_size_cache(size_cache)
+        db.close()
+
 def remove_file(f: str) -> None:
     try:
         os.remove(f)
     except:
         pass 
         
-def get_contents(rows: List[Tuple], db: sqlite3.Connection, 
+def get_contents(rows: Iterable[Tuple], db: sqlite3.Connection, 
                 image_folder: Optional[str] = None, 
                 photo_size: Optional[int] = None) -> str:
+    return "".join(iter_contents(rows, db, image_folder, photo_size))
+
+def iter_contents(rows: Iterable[Tuple], db: sqlite3.Connection, 
+                 image_folder: Optional[str] = None, 
+                 photo_size: Optional[int] = None,
+                 image_names: Optional[Dict[int, str]] = None,
+                 size_cache: Optional[sqlite3.Connection] = None,
+                 thumbnails: Optional[Dict[str, str]] = None,
+                 embedded: Optional[EmbeddedImages] = None,
+                 blob_images: Optional[BlobImages] = None,
+                 fragment_cache: Optional[sqlite3.Connection] = None,
+                 title: str = REPORT_TITLE,
+                 render_workers: int = 1,
+                 render_mode: str = "thread",
+                 prune_fragment_cache: bool = True,
+                 search_script: Optional[str] = None) -> Iterator[str]:
+    """Yield the report as one HTML document, one chunk per note.
+
+    With search_script, the name of a script written by SearchScriptSink,
+    the report starts with a search box linking to the notes found.
+    """
+    yield page_header(title)
+    if search_script is not None:
+        yield search_box(search_script)
+    for row, fragment in iter_note_fragments(rows, db, image_folder, photo_size, image_names=image_names, 
+                                             size_cache=size_cache, thumbnails=thumbnails, embedded=embedded, 
+                                             blob_images=blob_images, fragment_cache=fragment_cache, 
+                                             render_workers=render_workers, render_mode=render_mode, 
+                                             prune_fragment_cache=prune_fragment_cache):
+        if search_script is not None:
+            yield f"<div id=\"note-{row[0]}\">\n{fragment}</div>\n"
+        else:
+            yield fragment
+    yield PAGE_FOOTER
+
+def iter_note_fragments(rows: Iterable[Tuple], db: sqlite3.Connection, 
+                        image_folder: Optional[str] = None, 
+                        photo_size: Optional[int] = None,
+                        image_names: Optional[Dict[int, str]] = None,
+                        size_cache: Optional[sqlite3.Connection] = None,
+                        thumbnails: Optional[Dict[str, str]] = None,
+                        embedded: Optional[EmbeddedImages] = None,
+                        blob_images: Optional[BlobImages] = None,
+                        fragment_cache: Optional[sqlite3.Connection] = None,
+                        render_workers: int = 1,
+                        render_mode: str = "thread",
+                        prune_fragment_cache: bool = True) -> Iterator[Tuple[Tuple, str]]:
+    """Yield each row with its rendered HTML, in the order the rows are given.
+
+    With a fragment cache, notes that haven't changed since the last run,
+    and whose photos and thumbnails haven't either, are taken from the cache
+    instead of being rendered again. Fragments of notes that weren't given
+    are dropped from the cache unless prune_fragment_cache is False, as it
+    must be when the rows are only some of the notes. With more than one
+    render worker, notes are rendered on a pool of threads (each with its own
+    database connection) or processes, but still yielded in order; at most a
+    few notes per worker are in flight at once.
+    """
     if image_folder is None:
         image_folder = DEFAULT_CONFIG["image_folder"]
     if photo_size is None:
         photo_size = DEFAULT_CONFIG["photo_size"]
+    if image_names is None:
+        image_names = get_image_names(db)
         
-    s = " "
+    longitude_index = get_longitude_index(connection_for(db))
+    latitude_index = get_latitude_index(connection_for(db))
+    render_options = dict(longitude_index=longitude_index, latitude_index=latitude_index, 
+                          image_folder=image_folder, photo_size=photo_size, 
+                          image_names=image_names, thumbnails=thumbnails, blob_images=blob_images)
+    if embedded is not None and render_workers > 1 and render_mode == "process":
+        # The embedded thumbnails and their budget are shared between the notes
+        raise ValueError("Embedded thumbnails can only be rendered on threads")
+    executor, render_db = start_render_workers(db, render_workers, render_mode, render_options)
+
+    def render(row: Tuple) -> str:
+        return row_level(row, longitude_index, latitude_index, image_folder, photo_size, 
+                         custom_db=render_db, image_names=image_names, size_cache=size_cache, 
+                         thumbnails=thumbnails, embedded=embedded, blob_images=blob_images)
+
+    seen_ids = []
+    # Each entry is (row, digest, fragment or Future, whether it came from the cache)
+    pending: Deque[Tuple[Tuple, Optional[str], Any, bool]] = collections.deque()
+    window = render_workers * RENDER_WINDOW_PER_WORKER
+
+    def finish() -> Tuple[Tuple, str]:
+        row, digest, fragment, cached = pending.popleft()
+        if isinstance(fragment, Future):
+            fragment = fragment.result()
+        if fragment_cache is not None and not cached:
+            put_fragment(fragment_cache, row[0], digest, fragment)
+        return row, fragment
+
+    try:
+        for row in rows:
+            digest = None
+            fragment = None
+            if fragment_cache is not None:
+                images = note_image_state(to_note(row, longitude_index, latitude_index).forms, 
+                                          image_folder, image_names, thumbnails)
+                digest = row_digest(row, images)
+                fragment = get_fragment(fragment_cache, row[0], digest)
+                seen_ids.append(row[0])
+            if fragment is not None:
+                pending.append((row, digest, fragment, True))
+            elif executor is None:
+                pending.append((row, digest, render(row), False))
+            elif render_mode == "process":
+                pending.append((row, digest, executor.submit(render_in_worker, row), False))
+            else:
+                pending.append((row, digest, executor.submit(render, row), False))
+            # Hand back finished notes in order, waiting only when the window is full
+            while pending and (len(pending) > window or not isinstance(pending[0][2], Future)):
+                yield finish()
+        while pending:
+            yield finish()
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=True)
+        if render_db is not db:
+            render_db.close()
+    if fragment_cache is not None and prune_fragment_cache:
+        prune_fragments(fragment_cache, seen_ids)
+
+def note_image_state(forms: Optional[str], 
+                     image_folder: str, 
+                     image_names: Dict[int, str],
+                     thumbnails: Optional[Dict[str, str]] = None) -> List[Tuple[Any, ...]]:
+    """Return each photo of a note with the file it is shown from and that file's mtime.
+
+    A photo that is missing has no mtime, so the state changes once it is
+    extracted or its thumbnail is made.
+    """
+    try:
+        controls = load_controls(forms)
+    except (ValueError, KeyError, TypeError):
+        return []
+    state: List[Tuple[Any, ...]] = []
+    for control in controls:
+        if control.type != "pictures":
+            continue
+        for image_id in parse_image_ids(control.value):
+            if image_id not in image_names:
+                state.append((image_id,))
+                continue
+            image_spec = os.path.join(image_folder, image_names[image_id])
+            src_spec = thumbnails.get(image_spec, image_spec) if thumbnails is not None else image_spec
+            try:
+                mtime_ns = os.stat(src_spec).st_mtime_ns
+            except OSError:
+                mtime_ns = None
+            state.append((image_spec, src_spec, mtime_ns))
+    return state
+
+def database_path(db: sqlite3.Connection) -> str:
+    """Return the file behind a connection, or "" for an in-memory database."""
+    for _, name, path in db.execute("PRAGMA database_list"):
+        if name == "main":
+            return path or ""
+    return ""
+
+def start_render_workers(db: Union[sqlite3.Connection, ConnectionPool], 
+                         render_workers: int, 
+                         render_mode: str,
+                         render_options: Dict[str, Any]) -> Tuple[Optional[Executor], Any]:
+    """Return the executor for parallel rendering and the database the workers use.
+
+    Threads get a connection each from a pool; processes open their own
+    connection in render_worker_init. Without a database file to reopen, or
+    with a single worker, rendering stays on the calling thread.
+    """
+    if render_mode not in ("thread", "process"):
+        raise ValueError(f"Unknown render mode: {render_mode}")
+    if render_workers <= 1:
+        return None, db
+    if isinstance(db, ConnectionPool):
+        path = database_path(db.get())
+    else:
+        path = database_path(db)
+    if not path:
+        print("Rendering on one thread, the database has no file to reopen")
+        return None, db
+    if render_mode == "process":
+        executor = ProcessPoolExecutor(max_workers=render_workers, initializer=render_worker_init, 
+                                       initargs=(path, render_options))
+        return executor, db
+    if not isinstance(db, ConnectionPool):
+        db = open_pool(path, read_only=True)
+    return ThreadPoolExecutor(max_workers=render_workers), db
+
+# Set in each render process by render_worker_init
+_render_worker_state: Dict[str, Any] = {}
+
+def render_worker_init(dbfile: str, render_options: Dict[str, Any]) -> None:
+    _render_worker_state.update(render_options)
+    _render_worker_state["custom_db"] = open_db(dbfile, read_only=True)
+
+def render_in_worker(row: Tuple) -> str:
+    state = _render_worker_state
+    return row_level(row, state["longitude_index"], state["latitude_index"], state["image_folder"], 
+                     state["photo_size"], custom_db=state["custom_db"], 
+                     image_names=state["image_names"], thumbnails=state["thumbnails"], 
+                     blob_images=state["blob_images"])
+
+def page_header(title: str) -> str:
+    """Start a page; the title is plain text, e.g. from a file name, and is escaped here."""
+    return ("<!DOCTYPE html>\n<html>\n<head>\n<meta charset=\"utf-8\">\n"
+            f"<title>{escape(title)}</title>\n</head>\n<body>\n")
+
+def page_href(file_name: str) -> str:
+    """A link to a file next to the page, quoted for the URL and then for the attribute."""
+    return escape(quote(file_name))
+
+def page_file_name(output_file_name: str, page_number: int) -> str:
+    base, ext = os.path.splitext(os.path.basename(output_file_name))
+    return f"{base}_{page_number:04d}{ext or '.html'}"
+
+def write_paged_report(rows: Iterable[Tuple], db: sqlite3.Connection, 
+                       output_filespec: str,
+                       page_size: Optional[int] = None,
+                       split_by_section: bool = False,
+                       title: str = REPORT_TITLE,
+                       note_links: Optional[Dict[int, str]] = None,
+                       search_script: Optional[str] = None,
+                       **render_options: Any) -> List[str]:
+    """Write the notes over several pages, with an index page at output_filespec.
+
+    A new page is started every page_size notes and, with split_by_section,
+    whenever the section changes. The index lists each note's id, section,
+    timestamp and coordinates and links to the note on its page. Pages are
+    written as the notes are rendered, so only one note is held in memory.
+    The link to each note is also put in note_links, if given, and with
+    search_script the index page gets a search box. Returns the paths of the
+    pages written.
+    """
+    output_folder = os.path.dirname(output_filespec)
+    index_name = os.path.basename(output_filespec)
     longitude_index = get_longitude_index(db)
     latitude_index = get_latitude_index(db)
-    for row in rows:
-         s += row_level(row, longitude_index, latitude_index, image_folder, photo_size, custom_db=db)
+    page_specs: List[str] = []
+    page = None
+    page_notes = 0
+    page_section = None
 
-    return s
+    def close_page(has_next: bool) -> None:
+        links = [f"<a href=\"{page_href(index_name)}\">Index</a>"]
+        if len(page_specs) > 1:
+            links.append(f"<a href=\"{page_href(page_file_name(index_name, len(page_specs) - 1))}\">Previous</a>")
+        if has_next:
+            links.append(f"<a href=\"{page_href(page_file_name(index_name, len(page_specs) + 1))}\">Next</a>")
+        page.write("<p>" + " | ".join(links) + "</p>\n")
+        page.write(PAGE_FOOTER)
+        page.close()
 
-def get_latitude_index(db: sqlite3.Connection) -> Optional[int]:
+    with open(output_filespec, "w", encoding="utf-8", buffering=WRITE_BUFFER_SIZE) as index:
+        index.write(page_header(title))
+        index.write(f"<h1>{escape(title)}</h1>\n")
+        if search_script is not None:
+            index.write(search_box(search_script))
+        index.write("<table>\n")
+        index.write("<tr><th>Id</th><th>Section</th><th>Date</th><th>Coordinates</th></tr>\n")
+        try:
+            for row, fragment in iter_note_fragments(rows, db, **render_options):
+                id, section_name, timestamp_string, longitude, latitude = note_header(
+                    row, longitude_index, latitude_index)
+                new_section = split_by_section and page_notes > 0 and section_name != page_section
+                if page is None or new_section or (page_size and page_notes >= page_size):
+                    if page is not None:
+                        close_page(has_next=True)
+                    page_name = page_file_name(index_name, len(page_specs) + 1)
+                    page_specs.append(os.path.join(output_folder, page_name))
+                    page = open(page_specs[-1], "w", encoding="utf-8", buffering=WRITE_BUFFER_SIZE)
+                    page.write(page_header(f"{title} ({len(page_specs)})"))
+                    page.write(f"<p><a href=\"{page_href(index_name)}\">Index</a></p>\n")
+                    page_notes = 0
+                    page_section = section_name
+                    if split_by_section:
+                        index.write(f"<tr><th colspan=\"4\">{escape(section_name)}</th></tr>\n")
+                page.write(f"<div id=\"note-{id}\">\n{fragment}</div>\n")
+                page_notes += 1
+                if note_links is not None:
+                    note_links[row[0]] = f"{quote(page_name)}#note-{id}"
+                index.write(f"<tr><td><a href=\"{page_href(page_name)}#note-{id}\">{id}</a></td>"
+                            f"<td>{escape(section_name)}</td><td>{timestamp_string}</td>"
+                            f"<td>({longitude}, {latitude})</td></tr>\n")
+        finally:
+            if page is not None:
+                close_page(has_next=False)
+        index.write("</table>\n")
+        index.write(PAGE_FOOTER)
+    return page_specs
+
+def get_note_columns(db: sqlite3.Connection) -> List[str]:
+    """Return the column names of the notes table, without reading any notes."""
     cursor = db.cursor()
-    data = cursor.execute("SELECT * FROM notes")
-    i = -1
-    for columns in data.description:
-        i += 1
-        if columns[0].upper() == "LAT":
+    columns = [row[1] for row in cursor.execute("PRAGMA table_info(notes)")]
+    cursor.close()
+    return columns
+
+def get_note_schema(db: sqlite3.Connection, 
+                    columns: Optional[List[str]] = None) -> Dict[str, Optional[str]]:
+    """Map each field of Note to the notes column it is read from, or None if there isn't one."""
+    if columns is None:
+        columns = get_note_columns(db)
+    by_name = {column.upper(): column for column in columns}
+    schema: Dict[str, Optional[str]] = {}
+    for field, (names, position) in NOTE_FIELDS.items():
+        column = next((by_name[name.upper()] for name in names if name.upper() in by_name), None)
+        if column is None and position is not None and position < len(columns):
+            column = columns[position]
+        schema[field] = column
+    return schema
+
+def quote_column(column: str) -> str:
+    return '"' + column.replace('"', '""') + '"'
+
+def note_select_sql(schema: Dict[str, Optional[str]]) -> str:
+    """Build a SELECT of just the Note columns, in Note's field order."""
+    selected = [quote_column(column) if column is not None else "NULL" for column in schema.values()]
+    return "SELECT " + ", ".join(selected) + " FROM notes"
+
+def to_note(row_data: Tuple, 
+            longitude_index: Optional[int] = None, 
+            latitude_index: Optional[int] = None) -> Note:
+    """Return a Note for a row from iter_notes, or for a full SELECT * row."""
+    if isinstance(row_data, Note):
+        return row_data
+
+    def column(index: Optional[int]) -> Any:
+        if index is None:
+            return None
+        try:
+            return row_data[index]
+        except (IndexError, TypeError):
+            return None
+
+    return Note(id=column(NOTE_FIELDS["id"][1]), 
+                timestamp=column(NOTE_FIELDS["timestamp"][1]), 
+                section=column(NOTE_FIELDS["section"][1]), 
+                forms=column(NOTE_FIELDS["forms"][1]), 
+                lat=column(latitude_index), 
+                lon=column(longitude_index))
+
+def get_column_index(db: sqlite3.Connection, name: str) -> Optional[int]:
+    for i, column in enumerate(get_note_columns(db)):
+        if column.upper() == name.upper():
             return i
     return None
 
+def get_latitude_index(db: sqlite3.Connection) -> Optional[int]:
+    return get_column_index(db, "LAT")
+
 def get_longitude_index(db: sqlite3.Connection) -> Optional[int]:
-    cursor = db.cursor()
-    data = cursor.execute("SELECT * FROM notes")
-    i = -1
-    for columns in data.description:
-        i += 1
-        if columns[0].upper() == "LON":
-            return i
-    return None
+    return get_column_index(db, "LON")
 
+@timed("row_level")
 def row_level(row_data: Tuple, 
              longitude_index: Optional[int], 
              latitude_index: Optional[int], 
              image_folder: str, 
              photo_size: int,
-             custom_db: Optional[sqlite3.Connection] = None) -> str:
+             custom_db: Optional[sqlite3.Connection] = None,
+             image_names: Optional[Dict[int, str]] = None,
+             size_cache: Optional[sqlite3.Connection] = None,
+             thumbnails: Optional[Dict[str, str]] = None,
+             embedded: Optional[EmbeddedImages] = None,
+             blob_images: Optional[BlobImages] = None) -> str:
     try:
-        row_level_text = "<!DOCTYPE html>\n"
-        
-        # Extract data safely with error handling
-        try:
-            id = str(row_data[0])
-        except (IndexError, TypeError):
-            id = "Unknown"
-            
-        try:
-            forms = row_data[7]
-        except (IndexError, TypeError):
-            forms = None
-            
-        try:
-            section_name = str(row_data[6]) if row_data[6] is not None else "Unknown"
-        except (IndexError, TypeError):
-            section_name = "Unknown"
-            
-        # Handle timestamp safely
-        try:
-            timestamp = row_data[4]
-            date = datetime.datetime.fromtimestamp(timestamp / 1e3)
-            timestamp_string = str(date.strftime('%Y-%m-%d %H:%M:%S'))
-        except (IndexError, TypeError, ValueError, OverflowError):
-            timestamp_string = "Unknown Date"
-
-        # Handle coordinates safely
-        longitude = "Unknown"
-        latitude = "Unknown"
-        
-        if longitude_index is not None:
-            try:
-                longitude = str(round(row_data[longitude_index], 6))
-            except (IndexError, TypeError, ValueError):
-                pass
-
-        if latitude_index is not None:
-            try:
-                latitude = str(round(row_data[latitude_index], 6))
-            except (IndexError, TypeError, ValueError):
-                pass
+        note = to_note(row_data, longitude_index, latitude_index)
+        id, section_name, timestamp_string, longitude, latitude = note_header(note, None, None)
+        forms = note.forms
 
         # Build HTML output
-        row_level_text += f"<h2>{id} - {section_name}</h2>\n"  
-        row_level_text += f"<p>{timestamp_string} &nbsp({longitude}, {latitude})</p>\n"
+        parts = [f"<h2>{id} - {escape(section_name)}</h2>\n",
+                 f"<p>{timestamp_string} &nbsp({longitude}, {latitude})</p>\n"]
         
         # Process form items with error handling
         try:
-            row_level_text += form_items(forms, image_folder, photo_size, custom_db=custom_db)
+            parts.append(form_items(forms, image_folder, photo_size, custom_db=custom_db, 
+                                    image_names=image_names, size_cache=size_cache, 
+                                    thumbnails=thumbnails, embedded=embedded, blob_images=blob_images))
         except Exception as e:
             print(f"Error processing form items: {str(e)}")
-            row_level_text += "<p>Error processing form data</p>\n"
+            parts.append("<p>Error processing form data</p>\n")
             
-        return row_level_text
+        return "".join(parts)
         
     except Exception as e:
         print(f"Error in row_level: {str(e)}")
-        return f"<h2>Error processing row data</h2>\n<p>{str(e)}</p>\n"  
+        return f"<h2>Error processing row data</h2>\n<p>{escape(str(e))}</p>\n"  
+
+def note_header(row_data: Tuple, 
+               longitude_index: Optional[int], 
+               latitude_index: Optional[int]) -> Tuple[str, str, str, str, str]:
+    """Return the id, section, timestamp, longitude and latitude shown above a note."""
+    note = to_note(row_data, longitude_index, latitude_index)
+    id = str(note.id) if note.id is not None else "Unknown"
+    section_name = str(note.section) if note.section is not None else "Unknown"
+        
+    # Handle timestamp safely
+    try:
+        date = datetime.datetime.fromtimestamp(note.timestamp / 1e3)
+        timestamp_string = str(date.strftime('%Y-%m-%d %H:%M:%S'))
+    except (TypeError, ValueError, OverflowError, OSError):
+        timestamp_string = "Unknown Date"
+
+    # Handle coordinates safely
+    longitude = "Unknown"
+    latitude = "Unknown"
+    
+    try:
+        longitude = str(round(note.lon, 6))
+    except (TypeError, ValueError):
+        pass
+
+    try:
+        latitude = str(round(note.lat, 6))
+    except (TypeError, ValueError):
+        pass
 
+    return id, section_name, timestamp_string, longitude, latitude
+
+@timed("form_items")
 def form_items(form_data: Optional[str], 
               image_folder: Optional[str] = None, 
               photo_size: Optional[int] = None,
-              custom_db: Optional[sqlite3.Connection] = None) -> str:
+              custom_db: Optional[sqlite3.Connection] = None,
+              image_names: Optional[Dict[int, str]] = None,
+              size_cache: Optional[sqlite3.Connection] = None,
+              thumbnails: Optional[Dict[str, str]] = None,
+              embedded: Optional[EmbeddedImages] = None,
+              blob_images: Optional[BlobImages] = None) -> str:
     if image_folder is None:
         image_folder = DEFAULT_CONFIG["image_folder"]
     if photo_size is None:
@@ -165,117 +742,169 @@ def form_items(form_data: Optional[str],
     if form_data is None:
         form_name_level = " "
     else:
-        form_json = json.loads(form_data)
-        form_name_level = top_dictionary(form_json, image_folder, photo_size, custom_db=custom_db)
+        with profiling.stage("json.loads"):
+            form_json = form_json_loads(form_data)
+        profiling.add_bytes("json.loads", len(form_data))
+        form_name_level = top_dictionary(form_json, image_folder, photo_size, custom_db=custom_db, 
+                                         image_names=image_names, size_cache=size_cache, 
+                                         thumbnails=thumbnails, embedded=embedded, blob_images=blob_images)
 
     return form_name_level
 
 def top_dictionary(dict_items: Dict[str, Any], 
                   image_folder: Optional[str] = None, 
                   photo_size: Optional[int] = None,
-                  custom_db: Optional[sqlite3.Connection] = None) -> str:
-    if image_folder is None:
-        image_folder = DEFAULT_CONFIG["image_folder"]
-    if photo_size is None:
-        photo_size = DEFAULT_CONFIG["photo_size"]
-        
-    form_name_level = ""
-    page_name = " "
-    page_text = " "
-    json_items = dict_items["forms"]
-    for item in json_items:
-        page_text += lower_dict(item, image_folder, photo_size, custom_db=custom_db)
-    
-    form_name_level = page_text + "</ul>\n"
-    return form_name_level
+                  custom_db: Optional[sqlite3.Connection] = None,
+                  image_names: Optional[Dict[int, str]] = None,
+                  size_cache: Optional[sqlite3.Connection] = None,
+                  thumbnails: Optional[Dict[str, str]] = None,
+                  embedded: Optional[EmbeddedImages] = None,
+                  blob_images: Optional[BlobImages] = None) -> str:
+    return " " + render_controls(flatten_forms(dict_items), image_folder, photo_size, 
+                                 custom_db=custom_db, image_names=image_names, 
+                                 size_cache=size_cache, thumbnails=thumbnails, embedded=embedded, 
+                                 blob_images=blob_images) + "</ul>\n"
 
 def lower_dict(form_dict: Dict[str, Any], 
               image_folder: Optional[str] = None, 
               photo_size: Optional[int] = None,
-              custom_db: Optional[sqlite3.Connection] = None) -> str:
-    if image_folder is None:
-        image_folder = DEFAULT_CONFIG["image_folder"]
-    if photo_size is None:
-        photo_size = DEFAULT_CONFIG["photo_size"]
-        
-    start_list = ""
-    lower_dict_text = ""
-    form_values = " "
-    form_stuff = []
-    form_name = form_dict["formname"]
-    form_stuff = form_dict["formitems"]
-    form_values = control_list(form_name, form_stuff, image_folder, photo_size, custom_db=custom_db).lstrip()
-    if not form_values is None:
-        lower_dict_text = form_values
-    
-    return lower_dict_text 
-    
+              custom_db: Optional[sqlite3.Connection] = None,
+              image_names: Optional[Dict[int, str]] = None,
+              size_cache: Optional[sqlite3.Connection] = None,
+              thumbnails: Optional[Dict[str, str]] = None,
+              embedded: Optional[EmbeddedImages] = None,
+              blob_images: Optional[BlobImages] = None) -> str:
+    return render_controls(flatten_forms({"forms": [form_dict]}), image_folder, photo_size, 
+                           custom_db=custom_db, image_names=image_names, 
+                           size_cache=size_cache, thumbnails=thumbnails, embedded=embedded, blob_images=blob_images)
+
+def render_controls(controls: List[FormControl], 
+                    image_folder: Optional[str] = None, 
+                    photo_size: Optional[int] = None,
+                    custom_db: Optional[sqlite3.Connection] = None,
+                    image_names: Optional[Dict[int, str]] = None,
+                    size_cache: Optional[sqlite3.Connection] = None,
+                    thumbnails: Optional[Dict[str, str]] = None,
+                    embedded: Optional[EmbeddedImages] = None,
+                    blob_images: Optional[BlobImages] = None) -> str:
+    """Render flattened controls, one heading and list per form."""
+    parts = []
+    # Each form gets its own heading, even next to another form with the same name
+    for (_, form_name), form_controls in itertools.groupby(
+            controls, key=lambda control: (control.form_index, control.form)):
+        parts.append(render_form(form_name, form_controls, image_folder, photo_size, 
+                                 custom_db=custom_db, image_names=image_names, 
+                                 size_cache=size_cache, thumbnails=thumbnails, embedded=embedded, 
+                                 blob_images=blob_images))
+    return "".join(parts)
+
 def control_list(form_name: str, 
                 form_items: List[Dict[str, Any]], 
                 image_folder: Optional[str] = None, 
                 photo_size: Optional[int] = None,
-                custom_db: Optional[sqlite3.Connection] = None) -> str:
+                custom_db: Optional[sqlite3.Connection] = None,
+                image_names: Optional[Dict[int, str]] = None,
+                size_cache: Optional[sqlite3.Connection] = None,
+                thumbnails: Optional[Dict[str, str]] = None,
+                embedded: Optional[EmbeddedImages] = None,
+                blob_images: Optional[BlobImages] = None) -> str:
+    controls = flatten_forms({"forms": [{"formname": form_name, "formitems": form_items}]})
+    return render_form(form_name, controls, image_folder, photo_size, custom_db=custom_db, 
+                       image_names=image_names, size_cache=size_cache, thumbnails=thumbnails, embedded=embedded, 
+                       blob_images=blob_images)
+
+def render_form(form_name: str, 
+                controls: Iterable[FormControl], 
+                image_folder: Optional[str] = None, 
+                photo_size: Optional[int] = None,
+                custom_db: Optional[sqlite3.Connection] = None,
+                image_names: Optional[Dict[int, str]] = None,
+                size_cache: Optional[sqlite3.Connection] = None,
+                thumbnails: Optional[Dict[str, str]] = None,
+                embedded: Optional[EmbeddedImages] = None,
+                blob_images: Optional[BlobImages] = None) -> str:
+    """Render one form as a heading and a list of its controls, escaping the field data."""
     if image_folder is None:
         image_folder = DEFAULT_CONFIG["image_folder"]
     if photo_size is None:
         photo_size = DEFAULT_CONFIG["photo_size"]
         
     # Always include the form name in an h3 header
-    control_top = "<h3>" + form_name + "</h3>\n"
-    control_text = ""
-    control_info = " "
-    control: Dict[str, Any] = {}
-    for control in form_items:
-        if is_picture(control):
-            try:
-                photospec = get_image_name(control["value"], custom_db=custom_db)
-                control_text = ""
-                for images in photospec: 
-                    image_spec = os.path.join(image_folder, images)
-                    try:
-                        height, width = get_orientation(image_spec)
-                        scaled_height: int = 0
-                        scaled_width: int = 0
-                        if height > width:
-                            scale_factor = height / photo_size
-                            scaled_height = str(int(height / scale_factor))
-                            scaled_width = str(int(width / scale_factor))
-                        else:
-                            scale_factor = width / photo_size
-                            scaled_height = str(int(height / scale_factor))
-                            scaled_width = str(int(width / scale_factor))
-
-                        control_text += "<p><a href=\"" + "file:///" + image_spec + "\"><img width=\"" + scaled_width + "\" height=\"" + scaled_height + "\" src=\"" + "file:///" + image_spec + "\"/></a></p>\n"
-                    except Exception as e:
-                        # If there's an error processing the image, just add a text link instead
-                        control_text += "<p><a href=\"" + "file:///" + image_spec + "\">" + images + "</a></p>\n"
-            except Exception as e:
-                # If there's an error getting the image name, just continue
-                control_text += "<p>Error processing image: " + str(control["value"]) + "</p>\n"
-        else:
-            try:
-                control_info = str(control_data(control).strip())
-                if control_info[:1] == ":": 
-                    control_info = ""
-                else:
-                    if control_info[-1] == ":" or control_info[-1] == "-":
-                        pass
-                    else:
-                        # Check if there's a colon in the string before trying to find its index
-                        if ":" in control_info:
-                            split_position = control_info.index(":")
-                            control_value = "\t<li><em>" + control_info[:split_position + 2] + "</em><strong> " + control_info[split_position + 2:] + "</strong></li>\n"
-                            control_text += control_value
-                        else:
-                            # Handle case where there's no colon
-                            control_value = "\t<li><em>" + control_info + "</em></li>\n"
-                            control_text += control_value
-            except Exception as e:
-                # Log the exception for debugging
-                print(f"Error processing control data: {str(e)}")
-                pass
-    
-    return control_top + "<ul>\n" + control_text + "</ul>\n"
+    parts = [FORM_START.format(escape(form_name))]
+    for _, key, value, control_type, _ in controls:
+        if key is None:
+            # Stands in for a form without any controls
+            continue
+        if control_type == "pictures":
+            parts.extend(render_pictures(value, image_folder, photo_size, custom_db=custom_db, 
+                                         image_names=image_names, size_cache=size_cache, 
+                                         thumbnails=thumbnails, embedded=embedded, blob_images=blob_images))
+            continue
+        key = str(key).lstrip()
+        value = str(value).rstrip()
+        # Controls without a label, unanswered ones and ones left at a trailing ":" or "-" are skipped
+        if not key or key[0] == ":" or not value or value[-1] in ":-":
+            continue
+        parts.append(CONTROL_ITEM.format(escape_text(key), escape_text(value)))
+    parts.append(FORM_END)
+    return "".join(parts)
+
+def render_pictures(value: Any, 
+                    image_folder: str, 
+                    photo_size: int,
+                    custom_db: Optional[sqlite3.Connection] = None,
+                    image_names: Optional[Dict[int, str]] = None,
+                    size_cache: Optional[sqlite3.Connection] = None,
+                    thumbnails: Optional[Dict[str, str]] = None,
+                    embedded: Optional[EmbeddedImages] = None,
+                    blob_images: Optional[BlobImages] = None) -> List[str]:
+    """Return a paragraph for each photo of a pictures control."""
+    try:
+        photospec = lookup_image_names(value, image_names, custom_db=custom_db)
+    except Exception as e:
+        # If there's an error getting the image name, just continue
+        return [IMAGE_ERROR.format(escape(str(value)))]
+    image_sizes = blob_images.sizes if blob_images is not None else None
+    parts = []
+    for images in photospec:
+        image_spec = os.path.join(image_folder, images)
+        # Show the thumbnail when there is one, and link the original if it is on disk
+        src_spec = image_spec
+        if thumbnails is not None:
+            src_spec = thumbnails.get(image_spec, image_spec)
+        link_original = blob_images is None or blob_images.originals_written or src_spec == image_spec
+        href = escape(image_spec)
+        try:
+            height, width = get_orientation(src_spec, size_cache=size_cache, image_sizes=image_sizes)
+            scaled_width, scaled_height = scaled_size(width, height, photo_size)
+            # Only thumbnails are embedded, the originals would be far too big
+            data_uri = None
+            if embedded is not None and src_spec != image_spec:
+                data_uri = embedded.data_uri(src_spec)
+            if data_uri is not None:
+                parts.append(EMBEDDED_IMAGE_ITEM.format(escape(images), scaled_width, scaled_height, data_uri))
+            elif link_original:
+                parts.append(IMAGE_ITEM.format(href, scaled_width, scaled_height, escape(src_spec)))
+            else:
+                parts.append(THUMBNAIL_ITEM.format(scaled_width, scaled_height, escape(src_spec)))
+        except Exception as e:
+            # If there's an error processing the image, just add a text link instead
+            if link_original:
+                parts.append(IMAGE_LINK.format(href, escape(images)))
+            else:
+                parts.append(IMAGE_NAME.format(escape(images)))
+    return parts
+
+def escape_text(text: str) -> str:
+    """html.escape, skipped for the common case of text with nothing to escape."""
+    if needs_escape(text):
+        return escape(text)
+    return text
+
+def scaled_size(width: int, height: int, photo_size: int) -> Tuple[int, int]:
+    """Scale the longer side of a photo to photo_size, keeping its proportions."""
+    scale_factor = max(height, width) / photo_size
+    return int(width / scale_factor), int(height / scale_factor)
 
 def is_picture(control: Dict[str, Any]) -> bool:
     if control["type"] == "pictures":
@@ -283,9 +912,6 @@ def is_picture(control: Dict[str, Any]) -> bool:
     else:
         return False
 
-def maKe_picture_frames() -> None:
-    pass
-
 def control_data(control: Dict[str, Any]) -> str:
     try:
         control_name = control["key"]
@@ -296,26 +922,314 @@ def control_data(control: Dict[str, Any]) -> str:
     return control_name + ": " + str(control_value)
 
 def write_file(output_filespec: str, t: str) -> None:
-    f = open(output_filespec, "w")
-    f.write(t)
-    f.close()
+    write_chunks(output_filespec, [t])
 
-def open_db(custom_dbfile: Optional[str] = None) -> sqlite3.Connection:
+def write_chunks(output_filespec: str, chunks: Iterable[str], 
+                buffer_size: int = WRITE_BUFFER_SIZE) -> None:
+    """Write each chunk to the output file as soon as it is produced."""
+    with open(output_filespec, "w", encoding="utf-8", buffering=buffer_size) as f:
+        for chunk in chunks:
+            with profiling.stage("write_file"):
+                f.write(chunk)
+    if profiling.is_enabled():
+        profiling.add_bytes("write_file", os.path.getsize(output_filespec))
+
+@timed("open_db")
+def open_db(custom_dbfile: Optional[str] = None, 
+            read_only: bool = False,
+            immutable: bool = False,
+            mmap_size: Optional[int] = None,
+            cache_size: Optional[int] = None,
+            copy_to_memory: bool = False,
+            check_same_thread: bool = True) -> sqlite3.Connection:
+    """Open a GPAP database.
+
+    read_only opens it through a mode=ro URI so the field data can't be
+    changed or locked by the report, and immutable also tells SQLite the file
+    can't change underneath it, which skips locking altogether; only use it
+    when nothing else is writing to the database. mmap_size (bytes) and
+    cache_size (pages, or KiB if negative) set the matching pragmas.
+    copy_to_memory reads the whole database, image blobs included, into an
+    in-memory copy first, which suits small databases on slow USB drives.
+    """
     if custom_dbfile is None:
         # Use the default config if none is provided
         custom_dbfile = DEFAULT_CONFIG["dbfile"]
     
-    db = sqlite3.connect(custom_dbfile) 
+    if read_only or immutable or copy_to_memory:
+        uri = pathlib.Path(custom_dbfile).resolve().as_uri() + "?mode=ro"
+        if immutable:
+            uri += "&immutable=1"
+        db = sqlite3.connect(uri, uri=True, check_same_thread=check_same_thread)
+    else:
+        db = sqlite3.connect(custom_dbfile, check_same_thread=check_same_thread) 
+    
+    if copy_to_memory:
+        memory_db = sqlite3.connect(":memory:", check_same_thread=check_same_thread)
+        db.backup(memory_db)
+        db.close()
+        db = memory_db
+    
+    if mmap_size is not None:
+        db.execute(f"PRAGMA mmap_size = {int(mmap_size)}")
+    if cache_size is not None:
+        db.execute(f"PRAGMA cache_size = {int(cache_size)}")
     return db
 
-def get_notes(db: sqlite3.Connection) -> List[Tuple]:
+@timed("get_notes")
+def get_notes(db: Union[sqlite3.Connection, ConnectionPool], 
+              iterator: bool = False, 
+              batch_size: int = NOTE_BATCH_SIZE,
+              start: Optional[Union[datetime.date, float]] = None,
+              end: Optional[Union[datetime.date, float]] = None,
+              section: Optional[str] = None,
+              bbox: Optional[Tuple[float, float, float, float]] = None,
+              id_range: Optional[Tuple[int, int]] = None) -> Union[List[Tuple], Iterator[Tuple]]:
+    """Return the full rows of the notes matching the filters.
+
+    With iterator=True the rows are yielded batch_size at a time instead of
+    being fetched all at once. See note_filter_sql for the filters.
+    """
+    db = connection_for(db)
+    where, params = note_filter_sql(get_note_schema(db), start, end, section, bbox, id_range)
+    sql = "SELECT * FROM notes" + where
+    if iterator:
+        return iter_rows(db, sql, params, batch_size)
     cursor = db.cursor()
-    cursor.execute("SELECT * FROM notes")
+    cursor.execute(sql, params)
     rows = cursor.fetchall()
     cursor.close()
     return rows
 
-def get_image_name(image_ids: str, custom_db: Optional[sqlite3.Connection] = None) -> List[str]:
+def iter_notes(db: Union[sqlite3.Connection, ConnectionPool], 
+               order_by_section: bool = False,
+               batch_size: int = NOTE_BATCH_SIZE,
+               start: Optional[Union[datetime.date, float]] = None,
+               end: Optional[Union[datetime.date, float]] = None,
+               section: Optional[str] = None,
+               bbox: Optional[Tuple[float, float, float, float]] = None,
+               id_range: Optional[Tuple[int, int]] = None,
+               radius: Optional[Tuple[float, float, float]] = None,
+               polygon: Optional[List[Tuple[float, float]]] = None,
+               nearest: Optional[Tuple[float, float, int]] = None,
+               note_ids: Optional[Iterable[int]] = None,
+               text: Optional[str] = None) -> Iterator[Note]:
+    """Yield a Note per row straight from the cursor instead of fetching them all.
+
+    Only the columns the report reads are selected, so the other columns of
+    the notes table are never decoded. See note_filter_sql for the filters;
+    bbox, radius (lon, lat, metres), polygon [(lon, lat), ...] and nearest
+    (lon, lat, count) are looked up in the spatial index, see spatial_note_ids,
+    and text in the search index, see search_notes.
+    """
+    db = connection_for(db)
+    schema = get_note_schema(db)
+    where, params = note_filter_where(db, schema, start, end, section, bbox=bbox, id_range=id_range, 
+                                      radius=radius, polygon=polygon, nearest=nearest, note_ids=note_ids, 
+                                      text=text)
+    sql = note_select_sql(schema) + where
+    if order_by_section:
+        order = [schema[field] for field in ("section", "id") if schema[field] is not None]
+        if order:
+            sql += " ORDER BY " + ", ".join(quote_column(column) for column in order)
+    for row in iter_rows(db, sql, params, batch_size):
+        yield Note._make(row)
+
+def note_filter_where(db: sqlite3.Connection, 
+                      schema: Dict[str, Optional[str]],
+                      start: Optional[Union[datetime.date, float]] = None,
+                      end: Optional[Union[datetime.date, float]] = None,
+                      section: Optional[str] = None,
+                      bbox: Optional[Tuple[float, float, float, float]] = None,
+                      id_range: Optional[Tuple[int, int]] = None,
+                      radius: Optional[Tuple[float, float, float]] = None,
+                      polygon: Optional[List[Tuple[float, float]]] = None,
+                      nearest: Optional[Tuple[float, float, int]] = None,
+                      note_ids: Optional[Iterable[int]] = None,
+                      text: Optional[str] = None) -> Tuple[str, List[Any]]:
+    """The WHERE clause and parameters for all of iter_notes' filters.
+
+    The text and spatial filters are looked up in their indexes first and
+    passed on to note_filter_sql as note ids.
+    """
+    if text is not None:
+        text_ids = sorted(note_id for note_id, _ in search_notes(db, text, limit=None))
+        if note_ids is not None:
+            text_ids = sorted(set(text_ids).intersection(note_ids))
+        note_ids = text_ids
+    if bbox is not None or radius is not None or polygon is not None or nearest is not None:
+        spatial_ids = spatial_note_ids(db, bbox=bbox, radius=radius, polygon=polygon, nearest=nearest)
+        if note_ids is not None:
+            spatial_ids = sorted(set(spatial_ids).intersection(note_ids))
+        note_ids = spatial_ids
+    return note_filter_sql(schema, start, end, section, id_range=id_range, note_ids=note_ids)
+
+def iter_rows(db: sqlite3.Connection, sql: str, params: List[Any], 
+              batch_size: int = NOTE_BATCH_SIZE) -> Iterator[Tuple]:
+    """Run a query and yield its rows, fetching batch_size rows at a time."""
+    cursor = db.cursor()
+    try:
+        cursor.execute(sql, params)
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            yield from rows
+    finally:
+        cursor.close()
+
+def iter_note_points(db: sqlite3.Connection) -> Iterator[Tuple[int, float, float]]:
+    """Yield the id, longitude and latitude of every note with a position."""
+    schema = get_note_schema(db)
+    for field in ("id", "lon", "lat"):
+        if schema[field] is None:
+            raise ValueError(f"The notes table has no {field} column to filter on")
+    id_column, lon_column, lat_column = (quote_column(schema[field]) for field in ("id", "lon", "lat"))
+    yield from iter_rows(db, f"SELECT {id_column}, {lon_column}, {lat_column} FROM notes "
+                             f"WHERE {lon_column} IS NOT NULL AND {lat_column} IS NOT NULL", [])
+
+def open_note_index(db: sqlite3.Connection) -> sqlite3.Connection:
+    """Open the spatial index of a database, kept next to it and rebuilt when it changes.
+
+    A database without a file, or in a folder that can't be written to, gets
+    an index in memory for as long as it is open.
+    """
+    path = database_path(db)
+    load_points = lambda: iter_note_points(db)
+    if path:
+        stat = os.stat(path)
+        try:
+            return open_spatial_index(path + SPATIAL_INDEX_SUFFIX, f"{stat.st_size}:{stat.st_mtime_ns}", 
+                                      load_points)
+        except sqlite3.Error as e:
+            print(f"Could not write the spatial index, keeping it in memory: {str(e)}")
+    return open_spatial_index(":memory:", "", load_points)
+
+def spatial_note_ids(db: Union[sqlite3.Connection, ConnectionPool], 
+                     bbox: Optional[Tuple[float, float, float, float]] = None,
+                     radius: Optional[Tuple[float, float, float]] = None,
+                     polygon: Optional[List[Tuple[float, float]]] = None,
+                     nearest: Optional[Tuple[float, float, int]] = None) -> List[int]:
+    """Return the ids of the notes matching all of the spatial filters given, in id order."""
+    index = open_note_index(connection_for(db))
+    try:
+        matches: List[set] = []
+        if bbox is not None:
+            matches.append(set(ids_in_bbox(index, bbox)))
+        if radius is not None:
+            matches.append(set(ids_within_radius(index, *radius)))
+        if polygon is not None:
+            matches.append(set(ids_in_polygon(index, polygon)))
+        if nearest is not None:
+            matches.append({note_id for note_id, _ in nearest_notes(index, *nearest)})
+    finally:
+        index.close()
+    if not matches:
+        return []
+    return sorted(set.intersection(*matches))
+
+def iter_note_text(db: sqlite3.Connection) -> Iterator[Tuple[int, Optional[str], Optional[str]]]:
+    """Yield the id, section and forms of every note."""
+    schema = get_note_schema(db)
+    if schema["id"] is None or schema["forms"] is None:
+        raise ValueError("The notes table has no id or forms column to search")
+    section = quote_column(schema["section"]) if schema["section"] is not None else "NULL"
+    yield from iter_rows(db, f"SELECT {quote_column(schema['id'])}, {section}, "
+                             f"{quote_column(schema['forms'])} FROM notes", [])
+
+def open_note_search(db: sqlite3.Connection) -> sqlite3.Connection:
+    """Open the search index of a database, kept next to it and updated when it changes.
+
+    Only the notes that changed since the last update are indexed again. A
+    database without a file, or in a folder that can't be written to, gets
+    an index in memory for as long as it is open.
+    """
+    path = database_path(db)
+    load_notes = lambda: iter_note_text(db)
+    if path:
+        stat = os.stat(path)
+        try:
+            index = open_search_index(path + SEARCH_INDEX_SUFFIX)
+            update_search_index(index, f"{stat.st_size}:{stat.st_mtime_ns}", load_notes)
+            return index
+        except sqlite3.Error as e:
+            print(f"Could not write the search index, keeping it in memory: {str(e)}")
+    index = open_search_index(":memory:")
+    update_search_index(index, "", load_notes)
+    return index
+
+def search_notes(db: Union[sqlite3.Connection, ConnectionPool], 
+                 text: str, 
+                 limit: Optional[int] = 50,
+                 raw: bool = False) -> List[Tuple[int, str]]:
+    """Return the (id, snippet) of the notes whose section or forms match text, best first.
+
+    Every word must match, the last one also as the start of a word; with
+    raw, text is an FTS5 query. A limit of None returns every match.
+    """
+    index = open_note_search(connection_for(db))
+    try:
+        return search_text(index, text, -1 if limit is None else limit, raw=raw)
+    finally:
+        index.close()
+
+def to_epoch_ms(value: Union[datetime.date, float]) -> float:
+    """Convert a date or datetime (local time) to the milliseconds Smash stores."""
+    if isinstance(value, datetime.datetime):
+        return value.timestamp() * 1e3
+    if isinstance(value, datetime.date):
+        return datetime.datetime(value.year, value.month, value.day).timestamp() * 1e3
+    return value
+
+def note_filter_sql(schema: Dict[str, Optional[str]],
+                    start: Optional[Union[datetime.date, float]] = None,
+                    end: Optional[Union[datetime.date, float]] = None,
+                    section: Optional[str] = None,
+                    bbox: Optional[Tuple[float, float, float, float]] = None,
+                    id_range: Optional[Tuple[int, int]] = None,
+                    note_ids: Optional[Iterable[int]] = None) -> Tuple[str, List[Any]]:
+    """Build the WHERE clause and parameters for the note filters.
+
+    start and end are dates, datetimes or epoch milliseconds, with end
+    excluded, so start=yesterday, end=today gives yesterday's notes. bbox is
+    (min_lon, min_lat, max_lon, max_lat) and id_range is (first_id, last_id),
+    both inclusive. note_ids limits the notes to a list of ids.
+    """
+    clauses: List[str] = []
+    params: List[Any] = []
+
+    def column(field: str) -> str:
+        if schema.get(field) is None:
+            raise ValueError(f"The notes table has no {field} column to filter on")
+        return quote_column(schema[field])
+
+    if start is not None:
+        clauses.append(f"{column('timestamp')} >= ?")
+        params.append(to_epoch_ms(start))
+    if end is not None:
+        clauses.append(f"{column('timestamp')} < ?")
+        params.append(to_epoch_ms(end))
+    if section is not None:
+        clauses.append(f"{column('section')} = ?")
+        params.append(section)
+    if bbox is not None:
+        min_lon, min_lat, max_lon, max_lat = bbox
+        clauses.append(f"{column('lon')} BETWEEN ? AND ? AND {column('lat')} BETWEEN ? AND ?")
+        params.extend([min_lon, max_lon, min_lat, max_lat])
+    if id_range is not None:
+        clauses.append(f"{column('id')} BETWEEN ? AND ?")
+        params.extend(id_range)
+    if note_ids is not None:
+        # One JSON parameter instead of a variable per id, which SQLite limits
+        clauses.append(f"{column('id')} IN (SELECT value FROM json_each(?))")
+        params.append(json.dumps(list(note_ids)))
+    if not clauses:
+        return "", params
+    return " WHERE " + " AND ".join(clauses), params
+
+@timed("get_image_name")
+def get_image_name(image_ids: str, 
+                   custom_db: Optional[Union[sqlite3.Connection, ConnectionPool]] = None) -> List[str]:
     try:
         # Handle empty or None input
         if not image_ids:
@@ -323,22 +1237,15 @@ def get_image_name(image_ids: str, custom_db: Optional[sqlite3.Connection] = Non
             
         image_ids = image_ids.replace(";", ",")
         
-        # Use the provided database connection or create a new one
-        close_db = False
+        # Use the provided database connection, or this thread's connection
+        # to the default database
         if custom_db is None:
-            db = sqlite3.connect(DEFAULT_CONFIG["dbfile"])
-            close_db = True
+            db = default_pool(DEFAULT_CONFIG["dbfile"]).get()
         else:
-            db = custom_db
+            db = connection_for(custom_db)
         
         # Validate image_ids format to prevent SQL injection
-        id_list = []
-        for id_str in image_ids.split(','):
-            try:
-                id_int = int(id_str.strip())
-                id_list.append(str(id_int))
-            except ValueError:
-                continue
+        id_list = [str(id_int) for id_int in parse_image_ids(image_ids)]
                 
         if not id_list:
             return [DEFAULT_CONFIG["dummy_imagespec"]]
@@ -351,10 +1258,6 @@ def get_image_name(image_ids: str, custom_db: Optional[sqlite3.Connection] = Non
         rows = cursor.fetchall()
         cursor.close()
         
-        # Only close the connection if we created it
-        if close_db:
-            db.close()
-        
         image_names: List[str] = []
         for row in rows:
             image_names.append(row[1])
@@ -366,20 +1269,109 @@ def get_image_name(image_ids: str, custom_db: Optional[sqlite3.Connection] = Non
         print(f"Error in get_image_name: {str(e)}")
         return [DEFAULT_CONFIG["dummy_imagespec"]]
 
-def rotate_image(image_name: str) -> None:
-    pass
+def open_pool(dbfile: str, **options: Any) -> ConnectionPool:
+    """Return a pool giving each thread its own connection, opened with open_db's options."""
+    return ConnectionPool(lambda: open_db(dbfile, check_same_thread=False, **options))
+
+def default_pool(dbfile: str) -> ConnectionPool:
+    """Return the read-only pool shared by every caller that doesn't pass a connection."""
+    return shared_pool(dbfile, lambda: open_db(dbfile, read_only=True, check_same_thread=False))
 
-def get_orientation(image_spec: str) -> Tuple[int, int]:
+def parse_image_ids(image_ids: Optional[str]) -> List[int]:
+    """Split the value of a pictures control ("1,2" or "1;2") into image ids."""
+    id_list: List[int] = []
+    if not image_ids:
+        return id_list
+    for id_str in str(image_ids).replace(";", ",").split(','):
+        try:
+            id_list.append(int(id_str.strip()))
+        except ValueError:
+            continue
+    return id_list
+
+def collect_image_ids(db: sqlite3.Connection, **note_filters: Any) -> List[int]:
+    """Return every image id referenced by a pictures control in the notes matching note_filters."""
+    found = set()
+    schema = get_note_schema(db)
+    forms_column = schema["forms"]
+    if forms_column is None:
+        return []
+    forms_column = quote_column(forms_column)
+    where, params = note_filter_where(db, schema, **note_filters)
+    # Notes without a pictures control can't reference an image
+    where += (" AND " if where else " WHERE ") + f"{forms_column} LIKE '%pictures%'"
+    cursor = db.cursor()
     try:
-        # Check if file exists before attempting to open it
-        if not os.path.exists(image_spec):
-            print(f"Image file not found: {image_spec}")
-            return 200, 100  # Default height, width
-            
-        # Use a context manager to ensure the image is properly closed
-        with Image.open(image_spec) as image:
-            width, height = image.size
-            return height, width
+        cursor.execute(f"SELECT {forms_column} FROM notes{where}", params)
+        for (forms,) in cursor:
+            try:
+                for control in flatten_forms(form_json_loads(forms)):
+                    if control.type == "pictures":
+                        found.update(parse_image_ids(control.value))
+            except (ValueError, KeyError, TypeError):
+                continue
+    finally:
+        cursor.close()
+    return sorted(found)
+
+def resolve_image_names(db: sqlite3.Connection, image_ids: Iterable[int], 
+                       chunk_size: int = SQLITE_MAX_VARIABLES) -> Dict[int, str]:
+    """Look up the file names of many images, a chunk of ids per query."""
+    id_list = list(image_ids)
+    image_names: Dict[int, str] = {}
+    cursor = db.cursor()
+    try:
+        for start in range(0, len(id_list), chunk_size):
+            chunk = id_list[start:start + chunk_size]
+            placeholders = ','.join(['?'] * len(chunk))
+            sql = f"SELECT _id, text FROM images WHERE _id IN({placeholders})"
+            for image_id, text in cursor.execute(sql, chunk):
+                image_names[image_id] = text
+    finally:
+        cursor.close()
+    return image_names
+
+@timed("get_image_names")
+def get_image_names(db: Union[sqlite3.Connection, ConnectionPool], **note_filters: Any) -> Dict[int, str]:
+    """Resolve the names of the images used in the notes before rendering starts.
+
+    With note_filters (see iter_notes) only the images of the matching notes
+    are resolved, so thumbnails aren't made for notes that aren't shown.
+    """
+    db = connection_for(db)
+    try:
+        return resolve_image_names(db, collect_image_ids(db, **note_filters))
+    except sqlite3.Error as e:
+        print(f"Error in get_image_names: {str(e)}")
+        return {}
+
+def lookup_image_names(image_ids: str, 
+                       image_names: Optional[Dict[int, str]] = None, 
+                       custom_db: Optional[sqlite3.Connection] = None) -> List[str]:
+    """Find image names in the prepass map, querying the database only for misses."""
+    if image_names is not None:
+        id_list = parse_image_ids(image_ids)
+        if id_list and all(image_id in image_names for image_id in id_list):
+            return [image_names[image_id] for image_id in id_list]
+    return get_image_name(image_ids, custom_db=custom_db)
+
+@timed("get_orientation")
+def get_orientation(image_spec: str, 
+                   size_cache: Optional[sqlite3.Connection] = None,
+                   image_sizes: Optional[Dict[str, Tuple[int, int]]] = None) -> Tuple[int, int]:
+    """Return (height, width) of an image; image_sizes holds sizes already known, e.g. read from the blobs."""
+    try:
+        # Only the image header is read, and not even that if the size is cached
+        if image_sizes is not None and image_spec in image_sizes:
+            width, height = image_sizes[image_spec]
+        elif size_cache is not None:
+            width, height = cached_image_size(size_cache, image_spec)
+        else:
+            width, height = get_image_size(image_spec)
+        return height, width
+    except FileNotFoundError:
+        print(f"Image file not found: {image_spec}")
+        return 200, 100  # Default height, width
     except Exception as e:
         print(f"Error getting image orientation: {str(e)}")
         # Return default values if there's an error
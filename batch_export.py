@@ -0,0 +1,144 @@
+# ACM
+"""
+batch_export.py
+===============
+
+Renders an inspection report for every GPAP file in a folder (or matching a
+glob pattern) on a process pool, and writes a summary page linking to the
+reports with the time each one took and any that failed.
+"""
+import os
+import sys
+import glob
+import time
+import sqlite3
+import pathlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, List, Optional
+
+import ExportInspections_gpap as exp
+
+SUMMARY_FILE_NAME = "batch_summary.html"
+
+
+def find_databases(source: str) -> List[str]:
+    """Return the .gpap files in a folder, or the files matching a glob pattern."""
+    if os.path.isdir(source):
+        source = os.path.join(source, "*.gpap")
+    return sorted(glob.glob(source))
+
+
+def count_notes(dbfile: str) -> Optional[int]:
+    try:
+        db = sqlite3.connect(dbfile)
+        try:
+            return db.execute("SELECT COUNT(*) FROM notes").fetchone()[0]
+        finally:
+            db.close()
+    except sqlite3.Error:
+        return None
+
+
+def export_one(job: Dict[str, Any]) -> Dict[str, Any]:
+    """Render one database; failures are recorded in the result instead of raised."""
+    dbfile = job["dbfile"]
+    image_folder = job["image_folder"] or os.path.dirname(os.path.abspath(dbfile))
+    output_file_name = os.path.splitext(os.path.basename(dbfile))[0] + ".html"
+    result = {
+        "dbfile": dbfile,
+        "output": os.path.join(image_folder, output_file_name),
+        "notes": None,
+        "seconds": 0.0,
+        "error": None,
+    }
+    start = time.perf_counter()
+    try:
+        result["notes"] = count_notes(dbfile)
+        # Thumbnails are made in this process, the batch already uses every core
+        exp.generate_inspection_report(dbfile=dbfile,
+                                       image_folder=image_folder,
+                                       output_file_name=output_file_name,
+                                       auto_open=False,
+                                       workers=1,
+                                       **job["options"])
+    except Exception as e:
+        result["error"] = f"{type(e).__name__}: {str(e)}"
+    result["seconds"] = time.perf_counter() - start
+    return result
+
+
+def export_batch(source: str,
+                 image_folder: Optional[str] = None,
+                 summary_folder: Optional[str] = None,
+                 workers: Optional[int] = None,
+                 **options: Any) -> List[Dict[str, Any]]:
+    """Render a report for each database in source in parallel.
+
+    Each report is written next to its database unless image_folder is given.
+    Extra keyword arguments are passed on to generate_inspection_report.
+    Returns one result per database, in file name order.
+    """
+    dbfiles = find_databases(source)
+    if not dbfiles:
+        print(f"No databases found for {source}")
+        return []
+    jobs = [{"dbfile": dbfile, "image_folder": image_folder, "options": options} for dbfile in dbfiles]
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = min(workers, len(jobs))
+    if workers <= 1:
+        results = [export_one(job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(export_one, jobs))
+
+    for result in results:
+        status = "failed: " + result["error"] if result["error"] else "ok"
+        print(f"{result['dbfile']}: {result['notes']} notes, {result['seconds']:.2f}s, {status}")
+
+    if summary_folder is None:
+        summary_folder = os.path.dirname(os.path.abspath(dbfiles[0]))
+    write_summary(os.path.join(summary_folder, SUMMARY_FILE_NAME), results)
+    return results
+
+
+def report_href(output_spec: str) -> str:
+    """A file:// URL for a report, quoted for the URL and then for the attribute."""
+    return exp.escape(pathlib.Path(os.path.abspath(output_spec)).as_uri())
+
+
+def write_summary(summary_spec: str, results: List[Dict[str, Any]]) -> None:
+    total_notes = sum(result["notes"] or 0 for result in results)
+    total_seconds = sum(result["seconds"] for result in results)
+    failed = sum(1 for result in results if result["error"])
+    parts = [exp.page_header("Batch Summary"),
+             "<h1>Batch Summary</h1>\n",
+             f"<p>{len(results)} databases, {total_notes} notes, {failed} failed, "
+             f"{total_seconds:.2f}s total</p>\n",
+             "<table>\n<tr><th>Database</th><th>Notes</th><th>Seconds</th><th>Status</th></tr>\n"]
+    for result in results:
+        name = exp.escape(os.path.basename(result["dbfile"]))
+        if result["error"]:
+            link = name
+            status = "Failed: " + exp.escape(result["error"])
+        else:
+            link = f"<a href=\"{report_href(result['output'])}\">{name}</a>"
+            status = "OK"
+        notes = "" if result["notes"] is None else str(result["notes"])
+        parts.append(f"<tr><td>{link}</td><td>{notes}</td>"
+                     f"<td>{result['seconds']:.2f}</td><td>{status}</td></tr>\n")
+    parts.append("</table>\n")
+    parts.append(exp.PAGE_FOOTER)
+    exp.write_file(summary_spec, "".join(parts))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Render an inspection report for each GPAP file.")
+    parser.add_argument("source", help="folder of .gpap files or a glob pattern")
+    parser.add_argument("--image-folder", default=None, help="folder holding the photos of every database")
+    parser.add_argument("--workers", type=int, default=None, help="number of databases rendered at once")
+    args = parser.parse_args()
+    results = export_batch(args.source, image_folder=args.image_folder, workers=args.workers)
+    sys.exit(1 if any(result["error"] for result in results) else 0)
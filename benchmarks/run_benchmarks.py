@@ -0,0 +1,146 @@
+# ACM
+"""
+run_benchmarks.py
+=================
+
+Times each stage of the inspection report against a synthetic GPAP file and
+appends the results, with the current git commit, to a JSON file so that
+runs can be compared across commits.
+
+    python benchmarks/run_benchmarks.py --notes 500 --pictures 3
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import datetime
+import platform
+import tempfile
+import subprocess
+from typing import Any, Callable, Dict, List
+
+# Add the parent directory to the Python path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ExportInspections_gpap as exp
+import form_json
+from benchmarks.synthetic_gpap import make_synthetic_gpap
+
+DEFAULT_RESULTS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results.json")
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return ""
+
+
+def best_time(stage: Callable[[], Any], repeat: int) -> float:
+    """Run a stage repeat times and return the fastest run in seconds."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        stage()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def time_stages(dbfile: str, image_folder: str, photo_size: int = 400, repeat: int = 3) -> Dict[str, float]:
+    db = exp.open_db(dbfile)
+    rows = exp.get_notes(db)
+    forms = [json.loads(row[7]) for row in rows if row[7]]
+    picture_values = [control["value"] for form_json in forms for form in form_json["forms"]
+                      for control in form["formitems"] if exp.is_picture(control)]
+    image_names = exp.get_image_names(db)
+    image_specs = [os.path.join(image_folder, name) for name in image_names.values()]
+    output_filespec = os.path.join(image_folder, "benchmark.html")
+    text = exp.get_contents(rows, db, image_folder, photo_size)
+
+    def get_image_name_per_control() -> None:
+        for value in picture_values:
+            exp.get_image_name(value, custom_db=db)
+
+    def get_orientation() -> None:
+        for image_spec in image_specs:
+            exp.get_orientation(image_spec)
+
+    def full_report() -> None:
+        exp.generate_inspection_report(dbfile=dbfile, image_folder=image_folder,
+                                       output_file_name="benchmark_report.html",
+                                       photo_size=photo_size, auto_open=False)
+
+    stages = {
+        "get_notes": lambda: exp.get_notes(db),
+        "json_parse": lambda: [json.loads(row[7]) for row in rows if row[7]],
+        # form_json.loads uses orjson or ujson when one is installed
+        "json_parse_fast": lambda: [form_json.loads(row[7]) for row in rows if row[7]],
+        "flatten_forms": lambda: [form_json.flatten_forms(form) for form in forms],
+        "get_image_name": get_image_name_per_control,
+        "get_image_names": lambda: exp.get_image_names(db),
+        "get_orientation": get_orientation,
+        "render": lambda: exp.get_contents(rows, db, image_folder, photo_size),
+        "write_file": lambda: exp.write_file(output_filespec, text),
+        "full_report": full_report,
+    }
+    results = {name: best_time(stage, repeat) for name, stage in stages.items()}
+    db.close()
+    return results
+
+
+def record_results(results_file: str, entry: Dict[str, Any]) -> None:
+    entries: List[Dict[str, Any]] = []
+    if os.path.exists(results_file):
+        with open(results_file, "r", encoding="utf-8") as f:
+            entries = json.load(f)
+    entries.append(entry)
+    with open(results_file, "w", encoding="utf-8") as f:
+        json.dump(entries, f, indent=2)
+
+
+def run_benchmark(notes: int = 100, forms_per_note: int = 2, items_per_form: int = 10,
+                  pictures_per_note: int = 2, image_width: int = 1600, image_height: int = 1200,
+                  repeat: int = 3, results_file: str = DEFAULT_RESULTS_FILE) -> Dict[str, Any]:
+    work_folder = tempfile.mkdtemp(prefix="gpap_benchmark_")
+    try:
+        dbfile = os.path.join(work_folder, "synthetic.gpap")
+        start = time.perf_counter()
+        params = make_synthetic_gpap(dbfile, work_folder, notes=notes, forms_per_note=forms_per_note,
+                                     items_per_form=items_per_form, pictures_per_note=pictures_per_note,
+                                     image_width=image_width, image_height=image_height)
+        generate_seconds = time.perf_counter() - start
+        entry = {
+            "commit": git_commit(),
+            "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "params": params,
+            "repeat": repeat,
+            "generate_seconds": generate_seconds,
+            "stages": time_stages(dbfile, work_folder, repeat=repeat),
+        }
+    finally:
+        shutil.rmtree(work_folder, ignore_errors=True)
+    if results_file:
+        record_results(results_file, entry)
+    return entry
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the inspection report on a synthetic GPAP file.")
+    parser.add_argument("--notes", type=int, default=100)
+    parser.add_argument("--forms", type=int, default=2, help="forms per note")
+    parser.add_argument("--items", type=int, default=10, help="items per form")
+    parser.add_argument("--pictures", type=int, default=2, help="pictures per note")
+    parser.add_argument("--width", type=int, default=1600, help="image width in pixels")
+    parser.add_argument("--height", type=int, default=1200, help="image height in pixels")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per stage, the fastest is kept")
+    parser.add_argument("--results", default=DEFAULT_RESULTS_FILE, help="JSON file the results are added to")
+    args = parser.parse_args()
+    entry = run_benchmark(args.notes, args.forms, args.items, args.pictures, args.width, args.height,
+                          args.repeat, args.results)
+    for name, seconds in entry["stages"].items():
+        print(f"{name:<16} {seconds * 1000:10.1f} ms")
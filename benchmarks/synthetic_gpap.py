@@ -0,0 +1,99 @@
+# ACM
+"""
+synthetic_gpap.py
+=================
+
+Builds GPAP files of any size with the notes/images/imagedata tables that
+ExportInspections_gpap.py reads, for benchmarking. Photos are written both
+as imagedata blobs and as files in the image folder, like a survey whose
+images have been extracted with scratch/save_imageblobs.py.
+"""
+import io
+import os
+import json
+import random
+import sqlite3
+from typing import Dict, Any
+from PIL import Image
+
+FIELD_TYPES = ["string", "text", "double", "integer", "boolean", "stringcombo", "date"]
+
+
+def make_photo(width: int, height: int) -> bytes:
+    # A gradient compresses like a real photo far better than random noise would
+    image = Image.linear_gradient("L").resize((width, height)).convert("RGB")
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=85)
+    return buffer.getvalue()
+
+
+def make_forms(note_id: int, forms_per_note: int, items_per_form: int, image_ids: list,
+               rng: random.Random) -> str:
+    forms = []
+    for form_number in range(forms_per_note):
+        items = []
+        for item_number in range(items_per_form):
+            field_type = FIELD_TYPES[item_number % len(FIELD_TYPES)]
+            items.append({"key": f"field {form_number}.{item_number}",
+                          "value": f"value {rng.randint(0, 10000)} for note {note_id}",
+                          "type": field_type})
+        if form_number == 0 and image_ids:
+            items.append({"key": "photos", "value": ";".join(str(i) for i in image_ids),
+                          "type": "pictures"})
+        forms.append({"formname": f"Form {form_number}", "formitems": items})
+    return json.dumps({"sectionname": "Plot", "forms": forms})
+
+
+def make_synthetic_gpap(dbfile: str,
+                        image_folder: str,
+                        notes: int = 100,
+                        forms_per_note: int = 2,
+                        items_per_form: int = 10,
+                        pictures_per_note: int = 2,
+                        image_width: int = 1600,
+                        image_height: int = 1200,
+                        seed: int = 1) -> Dict[str, Any]:
+    """Write a synthetic GPAP database and its photos, returning the parameters used."""
+    rng = random.Random(seed)
+    os.makedirs(image_folder, exist_ok=True)
+    if os.path.exists(dbfile):
+        os.remove(dbfile)
+    # Every photo has the same size, so one landscape and one portrait encoding is enough
+    photos = [make_photo(image_width, image_height), make_photo(image_height, image_width)]
+
+    db = sqlite3.connect(dbfile)
+    db.execute('''
+        CREATE TABLE notes (
+            _id INTEGER PRIMARY KEY, title TEXT, content TEXT, created INTEGER, modified INTEGER,
+            color INTEGER, section TEXT, forms TEXT, lat REAL, lon REAL
+        )
+    ''')
+    db.execute("CREATE TABLE images (_id INTEGER PRIMARY KEY, text TEXT, imagedata_id INTEGER)")
+    db.execute("CREATE TABLE imagedata (_id INTEGER PRIMARY KEY, data BLOB)")
+
+    start_ms = 1727900000000
+    image_id = 0
+    note_rows = []
+    with db:
+        for note_id in range(1, notes + 1):
+            image_ids = []
+            for _ in range(pictures_per_note):
+                image_id += 1
+                name = f"IMG_{image_id:06d}.jpg"
+                data = photos[image_id % 2]
+                db.execute("INSERT INTO imagedata (_id, data) VALUES (?, ?)", (image_id, data))
+                db.execute("INSERT INTO images (_id, text, imagedata_id) VALUES (?, ?, ?)",
+                           (image_id, name, image_id))
+                with open(os.path.join(image_folder, name), "wb") as f:
+                    f.write(data)
+                image_ids.append(image_id)
+            timestamp = start_ms + note_id * 60000
+            note_rows.append((note_id, f"Note {note_id}", "", timestamp, timestamp, 1,
+                              f"Section {note_id % 5}",
+                              make_forms(note_id, forms_per_note, items_per_form, image_ids, rng),
+                              -33.0 - rng.random(), 148.0 + rng.random()))
+        db.executemany("INSERT INTO notes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", note_rows)
+    db.close()
+    return {"notes": notes, "forms_per_note": forms_per_note, "items_per_form": items_per_form,
+            "pictures_per_note": pictures_per_note, "image_width": image_width,
+            "image_height": image_height, "seed": seed}
@@ -0,0 +1,75 @@
+"""
+connection_pool.py
+==================
+
+A sqlite3 connection can only be used by the thread that opened it, so
+rendering notes or extracting images on several threads needs a connection
+per thread. ConnectionPool opens one for each thread the first time it asks,
+hands the same one back after that, and closes them all at the end.
+"""
+import sqlite3
+import threading
+from typing import Callable, Dict, List, Union
+
+
+class ConnectionPool:
+    def __init__(self, connect: Callable[[], sqlite3.Connection]):
+        """connect opens a new connection; it should pass check_same_thread=False
+        so that close() can close the connections of other threads."""
+        self._connect = connect
+        self._local = threading.local()
+        self._connections: List[sqlite3.Connection] = []
+        self._lock = threading.Lock()
+
+    def get(self) -> sqlite3.Connection:
+        """Return the calling thread's connection, opening it on first use."""
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = self._connect()
+            self._local.db = db
+            with self._lock:
+                self._connections.append(db)
+        return db
+
+    def close(self) -> None:
+        with self._lock:
+            for db in self._connections:
+                db.close()
+            self._connections = []
+            self._local = threading.local()
+
+    def __len__(self) -> int:
+        return len(self._connections)
+
+    def __enter__(self) -> "ConnectionPool":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+def connection_for(db: Union[sqlite3.Connection, ConnectionPool]) -> sqlite3.Connection:
+    """Accept either a connection or a pool wherever a connection is needed."""
+    if isinstance(db, ConnectionPool):
+        return db.get()
+    return db
+
+
+_pools: Dict[str, ConnectionPool] = {}
+_pools_lock = threading.Lock()
+
+
+def shared_pool(key: str, connect: Callable[[], sqlite3.Connection]) -> ConnectionPool:
+    """Return the pool registered under key, creating it with connect the first time."""
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = _pools[key] = ConnectionPool(connect)
+        return pool
+
+
+def close_shared_pools() -> None:
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.close()
+        _pools.clear()
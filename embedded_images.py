@@ -0,0 +1,93 @@
+"""
+embedded_images.py
+==================
+
+Inlines the thumbnails into the report as base64 data URIs, so that a report
+sent to someone else still shows its photos once the file:/// links to the
+photo folder no longer resolve. Each thumbnail is read and encoded once, and
+photos with the same content share one encoded copy, though every use of a
+photo still writes it into the report in full. A budget caps the bytes the
+thumbnails add to the report; photos past it are linked as before, without
+being read.
+"""
+import os
+import base64
+import hashlib
+import threading
+from typing import Dict, Optional, Set
+
+# Most mail servers refuse attachments much larger than this
+EMBED_BUDGET = 20 * 1024 * 1024
+
+MIME_TYPES = {".jpg": "image/jpeg", ".jpeg": "image/jpeg", ".webp": "image/webp",
+              ".png": "image/png", ".gif": "image/gif"}
+
+
+def base64_length(size: int) -> int:
+    return 4 * ((size + 2) // 3)
+
+
+class EmbeddedImages:
+    def __init__(self, budget: Optional[int] = EMBED_BUDGET):
+        """budget is the most bytes of data URIs to add to the report, None for no limit."""
+        self.budget = budget
+        self.used = 0
+        self.embedded = 0
+        self.skipped = 0
+        self._hashes: Dict[str, str] = {}
+        self._uris: Dict[str, str] = {}
+        self._embedded_hashes: Set[str] = set()
+        self._lock = threading.Lock()
+
+    def data_uri(self, image_spec: str) -> Optional[str]:
+        """Return the image as a data URI, or None if it can't be read or is over the budget.
+
+        The length of the URI follows from the file size, so a photo over the
+        budget is never read, and only photos that are embedded are kept.
+        """
+        mime_type = MIME_TYPES.get(os.path.splitext(image_spec)[1].lower())
+        if mime_type is None:
+            return None
+        prefix = f"data:{mime_type};base64,"
+        try:
+            length = len(prefix) + base64_length(os.stat(image_spec).st_size)
+        except OSError:
+            return None
+        with self._lock:
+            # Every use of a photo is written out in full, so each one counts
+            if self.budget is not None and self.used + length > self.budget:
+                self.skipped += 1
+                return None
+            self.used += length
+            digest = self._hashes.get(image_spec)
+            uri = self._uris.get(digest) if digest is not None else None
+        if uri is None:
+            try:
+                with open(image_spec, "rb") as f:
+                    data = f.read()
+            except OSError:
+                with self._lock:
+                    self.used -= length
+                return None
+            digest = hashlib.sha1(data).hexdigest()
+            with self._lock:
+                self._hashes[image_spec] = digest
+                uri = self._uris.get(digest)
+                if uri is None:
+                    uri = self._uris[digest] = prefix + base64.b64encode(data).decode("ascii")
+        with self._lock:
+            # The file may have changed since it was measured
+            self.used += len(uri) - length
+            self.embedded += 1
+            self._embedded_hashes.add(digest)
+        return uri
+
+    def unique_images(self) -> int:
+        return len(self._embedded_hashes)
+
+    def summary(self) -> str:
+        text = (f"Embedded {self.embedded} thumbnails ({self.unique_images()} distinct, "
+                f"{self.used} bytes)")
+        if self.skipped:
+            text += f", {self.skipped} over the budget were linked instead"
+        return text
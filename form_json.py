@@ -0,0 +1,95 @@
+"""
+form_json.py
+============
+
+Decodes the forms column of the notes table. orjson or ujson is used when
+installed, since the stdlib decoder is a noticeable part of the time spent on
+surveys with large forms, and flatten_forms turns the nested forms of a note
+into one list of controls so they only have to be walked once.
+"""
+import json
+from collections import namedtuple
+from typing import Any, Callable, Dict, List, Optional, Union
+
+# form_index tells apart neighbouring forms of a note that have the same name
+FormControl = namedtuple("FormControl", ["form", "key", "value", "type", "form_index"], defaults=(0,))
+
+
+def _stdlib_loads(text: Union[str, bytes]) -> Any:
+    return json.loads(text)
+
+
+def _load_decoders() -> Dict[str, Callable[[Union[str, bytes]], Any]]:
+    decoders: Dict[str, Callable[[Union[str, bytes]], Any]] = {}
+    try:
+        import orjson
+        decoders["orjson"] = orjson.loads
+    except ImportError:
+        pass
+    try:
+        import ujson
+        decoders["ujson"] = ujson.loads
+    except ImportError:
+        pass
+    decoders["json"] = _stdlib_loads
+    return decoders
+
+
+DECODERS = _load_decoders()
+
+# The first of orjson, ujson and json that is installed
+_decoder_name = next(iter(DECODERS))
+
+
+def decoder_name() -> str:
+    return _decoder_name
+
+
+def set_decoder(name: str) -> None:
+    """Choose the decoder used by loads, e.g. to compare them or to rule one out."""
+    global _decoder_name
+    if name not in DECODERS:
+        raise ValueError(f"JSON decoder not available: {name}")
+    _decoder_name = name
+
+
+def loads(text: Union[str, bytes]) -> Any:
+    """Decode with the chosen decoder, falling back to json for anything it rejects.
+
+    orjson refuses some input json accepts, such as NaN or integers wider than
+    64 bits, so those notes still decode the way they always have.
+    """
+    if _decoder_name == "json":
+        return json.loads(text)
+    try:
+        return DECODERS[_decoder_name](text)
+    except (ValueError, OverflowError):
+        return json.loads(text)
+
+
+def flatten_forms(form_json: Dict[str, Any]) -> List[FormControl]:
+    """Return the controls of every form in a note as (form, key, value, type, form_index) tuples.
+
+    A control without a key gets an empty one and a control without a value
+    is left out. A form without any controls is kept as a single control with
+    no key, so that its heading is still shown.
+    """
+    controls: List[FormControl] = []
+    for form_index, form in enumerate(form_json["forms"]):
+        form_name = form["formname"]
+        start = len(controls)
+        for control in form["formitems"]:
+            if "value" not in control:
+                continue
+            controls.append(FormControl(form_name, control.get("key", ""), control["value"],
+                                        control.get("type", ""), form_index))
+        if len(controls) == start:
+            controls.append(FormControl(form_name, None, None, "", form_index))
+    return controls
+
+
+def load_controls(form_data: Optional[Union[str, bytes]]) -> List[FormControl]:
+    """Decode a forms column value straight into its flattened controls."""
+    if not form_data:
+        return []
+    return flatten_forms(loads(form_data))
@@ -0,0 +1,70 @@
+"""
+fragment_cache.py
+=================
+
+Keeps the rendered HTML of each note in a small SQLite file next to the
+report, so that re-running the report on a growing database only renders the
+notes that were added or changed since the last run.
+"""
+import hashlib
+import sqlite3
+from typing import Any, Iterable, Optional, Sequence, Tuple
+
+FRAGMENT_CACHE_SUFFIX = ".fragments.sqlite"
+
+
+def open_fragment_cache(cache_spec: str, settings: str) -> sqlite3.Connection:
+    """Open the cache, emptying it if it was written with different report settings."""
+    cache = sqlite3.connect(cache_spec)
+    cache.execute("CREATE TABLE IF NOT EXISTS settings (value TEXT)")
+    cache.execute(
+        "CREATE TABLE IF NOT EXISTS fragments ("
+        "note_id INTEGER PRIMARY KEY, digest TEXT, fragment TEXT)")
+    row = cache.execute("SELECT value FROM settings").fetchone()
+    if row is None or row[0] != settings:
+        cache.execute("DELETE FROM fragments")
+        cache.execute("DELETE FROM settings")
+        cache.execute("INSERT INTO settings (value) VALUES (?)", (settings,))
+    return cache
+
+
+def close_fragment_cache(cache: sqlite3.Connection) -> None:
+    cache.commit()
+    cache.close()
+
+
+def row_digest(row: Tuple, images: Sequence[Any] = ()) -> str:
+    """Hash every column of a note, so edits to the forms, section or position all count.
+
+    images describes the photo files the note shows, so a note is also
+    rendered again when one of its photos or thumbnails appears or changes.
+    """
+    return hashlib.sha1(repr((row, tuple(images))).encode("utf-8")).hexdigest()
+
+
+def get_fragment(cache: sqlite3.Connection, note_id: int, digest: str) -> Optional[str]:
+    row = cache.execute(
+        "SELECT fragment FROM fragments WHERE note_id = ? AND digest = ?",
+        (note_id, digest)).fetchone()
+    if row is None:
+        return None
+    return row[0]
+
+
+def put_fragment(cache: sqlite3.Connection, note_id: int, digest: str, fragment: str) -> None:
+    cache.execute(
+        "INSERT OR REPLACE INTO fragments (note_id, digest, fragment) VALUES (?, ?, ?)",
+        (note_id, digest, fragment))
+
+
+def prune_fragments(cache: sqlite3.Connection, note_ids: Iterable[int]) -> None:
+    """Forget the fragments of notes that are no longer in the database.
+
+    note_ids must be every note in the database, so don't prune after a run
+    that only rendered some of them.
+    """
+    cache.execute("CREATE TEMP TABLE IF NOT EXISTS seen (note_id INTEGER PRIMARY KEY)")
+    cache.execute("DELETE FROM seen")
+    cache.executemany("INSERT OR IGNORE INTO seen (note_id) VALUES (?)",
+                      ((note_id,) for note_id in note_ids))
+    cache.execute("DELETE FROM fragments WHERE note_id NOT IN (SELECT note_id FROM seen)")
@@ -0,0 +1,241 @@
+"""
+geopackage.py
+=============
+
+Writes a point layer to an OGC GeoPackage with nothing but sqlite3, so the
+notes can be opened in QGIS or read with geopandas. The layer is written in
+one transaction with batched executemany inserts, to a partial file that is
+renamed when it is complete, and the R*Tree spatial index is filled once at
+the end instead of by a trigger per row.
+
+Positions are WGS 84 longitude and latitude (EPSG:4326).
+"""
+import os
+import struct
+import sqlite3
+import datetime
+from typing import Any, Iterable, List, Optional, Sequence, Tuple
+
+# "GPKG" and version 1.3.0, as set by GDAL
+GPKG_APPLICATION_ID = 0x47504B47
+GPKG_USER_VERSION = 10300
+
+WGS84_SRS_ID = 4326
+
+WGS84_DEFINITION = (
+    'GEOGCS["WGS 84",DATUM["WGS_1984",SPHEROID["WGS 84",6378137,298.257223563,'
+    'AUTHORITY["EPSG","7030"]],AUTHORITY["EPSG","6326"]],PRIMEM["Greenwich",0,'
+    'AUTHORITY["EPSG","8901"]],UNIT["degree",0.0174532925199433,AUTHORITY["EPSG","9122"]],'
+    'AXIS["Latitude",NORTH],AXIS["Longitude",EAST],AUTHORITY["EPSG","4326"]]')
+
+# Features written with each executemany
+GPKG_BATCH_SIZE = 5000
+
+PARTIAL_SUFFIX = ".part"
+
+# GeoPackage binary header: magic, version 0, flags (little endian, no envelope), srs id;
+# then a little endian WKB point
+POINT_HEADER = b"GP\x00\x01" + struct.pack("<i", WGS84_SRS_ID) + b"\x01" + struct.pack("<I", 1)
+point_struct = struct.Struct("<dd")
+
+GEOMETRY_COLUMN = "geom"
+
+METADATA_TABLES = """
+CREATE TABLE gpkg_spatial_ref_sys (
+    srs_name TEXT NOT NULL, srs_id INTEGER NOT NULL PRIMARY KEY, organization TEXT NOT NULL,
+    organization_coordsys_id INTEGER NOT NULL, definition TEXT NOT NULL, description TEXT);
+CREATE TABLE gpkg_contents (
+    table_name TEXT NOT NULL PRIMARY KEY, data_type TEXT NOT NULL, identifier TEXT UNIQUE,
+    description TEXT DEFAULT '', last_change DATETIME NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%fZ','now')),
+    min_x DOUBLE, min_y DOUBLE, max_x DOUBLE, max_y DOUBLE, srs_id INTEGER,
+    CONSTRAINT fk_gc_r_srs_id FOREIGN KEY (srs_id) REFERENCES gpkg_spatial_ref_sys(srs_id));
+CREATE TABLE gpkg_geometry_columns (
+    table_name TEXT NOT NULL, column_name TEXT NOT NULL, geometry_type_name TEXT NOT NULL,
+    srs_id INTEGER NOT NULL, z TINYINT NOT NULL, m TINYINT NOT NULL,
+    CONSTRAINT pk_geom_cols PRIMARY KEY (table_name, column_name),
+    CONSTRAINT fk_gc_tn FOREIGN KEY (table_name) REFERENCES gpkg_contents(table_name),
+    CONSTRAINT fk_gc_srs FOREIGN KEY (srs_id) REFERENCES gpkg_spatial_ref_sys (srs_id));
+CREATE TABLE gpkg_extensions (
+    table_name TEXT, column_name TEXT, extension_name TEXT NOT NULL, definition TEXT NOT NULL,
+    scope TEXT NOT NULL, CONSTRAINT ge_tce UNIQUE (table_name, column_name, extension_name));
+"""
+
+# The triggers that keep the R*Tree up to date when the layer is edited later, e.g. in QGIS,
+# from the GeoPackage R*Tree extension; the ST_ functions are provided by the GIS opening the file
+RTREE_TRIGGERS = """
+CREATE TRIGGER "rtree_{t}_{c}_insert" AFTER INSERT ON "{t}"
+WHEN (new."{c}" NOT NULL AND NOT ST_IsEmpty(NEW."{c}"))
+BEGIN
+  INSERT OR REPLACE INTO "rtree_{t}_{c}" VALUES (NEW."{i}",
+    ST_MinX(NEW."{c}"), ST_MaxX(NEW."{c}"), ST_MinY(NEW."{c}"), ST_MaxY(NEW."{c}"));
+END;
+CREATE TRIGGER "rtree_{t}_{c}_update1" AFTER UPDATE OF "{c}" ON "{t}"
+WHEN OLD."{i}" = NEW."{i}" AND (NEW."{c}" NOTNULL AND NOT ST_IsEmpty(NEW."{c}"))
+BEGIN
+  INSERT OR REPLACE INTO "rtree_{t}_{c}" VALUES (NEW."{i}",
+    ST_MinX(NEW."{c}"), ST_MaxX(NEW."{c}"), ST_MinY(NEW."{c}"), ST_MaxY(NEW."{c}"));
+END;
+CREATE TRIGGER "rtree_{t}_{c}_update2" AFTER UPDATE OF "{c}" ON "{t}"
+WHEN OLD."{i}" = NEW."{i}" AND (NEW."{c}" IS NULL OR ST_IsEmpty(NEW."{c}"))
+BEGIN
+  DELETE FROM "rtree_{t}_{c}" WHERE id = OLD."{i}";
+END;
+CREATE TRIGGER "rtree_{t}_{c}_update3" AFTER UPDATE ON "{t}"
+WHEN OLD."{i}" != NEW."{i}" AND (NEW."{c}" NOTNULL AND NOT ST_IsEmpty(NEW."{c}"))
+BEGIN
+  DELETE FROM "rtree_{t}_{c}" WHERE id = OLD."{i}";
+  INSERT OR REPLACE INTO "rtree_{t}_{c}" VALUES (NEW."{i}",
+    ST_MinX(NEW."{c}"), ST_MaxX(NEW."{c}"), ST_MinY(NEW."{c}"), ST_MaxY(NEW."{c}"));
+END;
+CREATE TRIGGER "rtree_{t}_{c}_update4" AFTER UPDATE ON "{t}"
+WHEN OLD."{i}" != NEW."{i}" AND (NEW."{c}" IS NULL OR ST_IsEmpty(NEW."{c}"))
+BEGIN
+  DELETE FROM "rtree_{t}_{c}" WHERE id IN (OLD."{i}", NEW."{i}");
+END;
+CREATE TRIGGER "rtree_{t}_{c}_delete" AFTER DELETE ON "{t}"
+WHEN old."{c}" NOT NULL
+BEGIN
+  DELETE FROM "rtree_{t}_{c}" WHERE id = OLD."{i}";
+END;
+"""
+
+
+def point_geometry(lon: Optional[float], lat: Optional[float]) -> Optional[bytes]:
+    """Return a GeoPackage point geometry, or None for a note without a position."""
+    if lon is None or lat is None:
+        return None
+    return POINT_HEADER + point_struct.pack(lon, lat)
+
+
+def quote_identifier(name: str) -> str:
+    return "\"" + name.replace("\"", "\"\"") + "\""
+
+
+def gpkg_timestamp(epoch_ms: Optional[float]) -> Optional[str]:
+    """Format epoch milliseconds as the UTC DATETIME text GeoPackage uses."""
+    try:
+        date = datetime.datetime.fromtimestamp(epoch_ms / 1e3, datetime.timezone.utc)
+    except (TypeError, ValueError, OverflowError, OSError):
+        return None
+    return date.strftime("%Y-%m-%dT%H:%M:%S.") + f"{date.microsecond // 1000:03d}Z"
+
+
+def unique_column_names(names: Iterable[str], reserved: Sequence[str] = ()) -> List[str]:
+    """Make column names unique ignoring case, as SQLite compares them, by numbering repeats."""
+    seen = {name.lower() for name in reserved}
+    unique = []
+    for name in names:
+        candidate = name
+        number = 2
+        while candidate.lower() in seen:
+            candidate = f"{name}_{number}"
+            number += 1
+        seen.add(candidate.lower())
+        unique.append(candidate)
+    return unique
+
+
+class PointLayerWriter:
+    """Write features to a new GeoPackage with a single point layer.
+
+    columns are (name, SQLite type) pairs. Each feature given to add is
+    (lon, lat, values) with a value for each column. Nothing is visible at
+    output_spec until close has written the spatial index.
+    """
+
+    def __init__(self, output_spec: str, layer_name: str, columns: List[Tuple[str, str]],
+                 fid_column: str = "fid", batch_size: int = GPKG_BATCH_SIZE, description: str = ""):
+        self.output_spec = output_spec
+        self.layer_name = layer_name
+        self.fid_column = fid_column
+        self._batch_size = batch_size
+        self._batch: List[Tuple[Any, ...]] = []
+        self._extent = [float("inf"), float("inf"), float("-inf"), float("-inf")]
+        self._partial_spec = output_spec + PARTIAL_SUFFIX
+        if os.path.exists(self._partial_spec):
+            os.remove(self._partial_spec)
+        self._db = sqlite3.connect(self._partial_spec, isolation_level=None)
+        # The file is renamed into place only once complete, so it needs no journal
+        self._db.execute("PRAGMA journal_mode = OFF")
+        self._db.execute("PRAGMA synchronous = OFF")
+        self._db.execute(f"PRAGMA application_id = {GPKG_APPLICATION_ID}")
+        self._db.execute(f"PRAGMA user_version = {GPKG_USER_VERSION}")
+        self._db.execute("BEGIN")
+        for statement in METADATA_TABLES.split(";"):
+            if statement.strip():
+                self._db.execute(statement)
+        self._db.executemany(
+            "INSERT INTO gpkg_spatial_ref_sys VALUES (?, ?, ?, ?, ?, ?)",
+            [("Undefined cartesian SRS", -1, "NONE", -1, "undefined", "undefined cartesian coordinate reference system"),
+             ("Undefined geographic SRS", 0, "NONE", 0, "undefined", "undefined geographic coordinate reference system"),
+             ("WGS 84 geodetic", WGS84_SRS_ID, "EPSG", WGS84_SRS_ID, WGS84_DEFINITION,
+              "longitude/latitude coordinates in decimal degrees on the WGS 84 spheroid")])
+        definitions = [f"{quote_identifier(fid_column)} INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL",
+                       f"{quote_identifier(GEOMETRY_COLUMN)} POINT"]
+        definitions += [f"{quote_identifier(name)} {column_type}" for name, column_type in columns]
+        self._db.execute(f"CREATE TABLE {quote_identifier(layer_name)} ({', '.join(definitions)})")
+        self._db.execute("INSERT INTO gpkg_contents (table_name, data_type, identifier, description, srs_id) "
+                         "VALUES (?, 'features', ?, ?, ?)", (layer_name, layer_name, description, WGS84_SRS_ID))
+        self._db.execute("INSERT INTO gpkg_geometry_columns VALUES (?, ?, 'POINT', ?, 0, 0)",
+                         (layer_name, GEOMETRY_COLUMN, WGS84_SRS_ID))
+        names = [quote_identifier(name) for name in [GEOMETRY_COLUMN] + [name for name, _ in columns]]
+        self._insert_sql = (f"INSERT INTO {quote_identifier(layer_name)} ({', '.join(names)}) "
+                            f"VALUES ({', '.join('?' * len(names))})")
+
+    def add(self, lon: Optional[float], lat: Optional[float], values: Sequence[Any]) -> None:
+        geometry = point_geometry(lon, lat)
+        if geometry is not None:
+            extent = self._extent
+            extent[0] = min(extent[0], lon)
+            extent[1] = min(extent[1], lat)
+            extent[2] = max(extent[2], lon)
+            extent[3] = max(extent[3], lat)
+        self._batch.append((geometry, *values))
+        if len(self._batch) >= self._batch_size:
+            self._flush()
+
+    def _flush(self) -> None:
+        if self._batch:
+            self._db.executemany(self._insert_sql, self._batch)
+            self._batch = []
+
+    def _create_spatial_index(self) -> None:
+        """Fill the R*Tree in one statement from the points just written."""
+        table = self.layer_name
+        rtree = quote_identifier(f"rtree_{table}_{GEOMETRY_COLUMN}")
+        self._db.execute(f"CREATE VIRTUAL TABLE {rtree} USING rtree(id, minx, maxx, miny, maxy)")
+        points = list(self._iter_points())
+        self._db.executemany(f"INSERT INTO {rtree} VALUES (?, ?, ?, ?, ?)",
+                             ((fid, x, x, y, y) for fid, x, y in points))
+        self._db.execute("INSERT INTO gpkg_extensions VALUES (?, ?, 'gpkg_rtree_index', "
+                         "'http://www.geopackage.org/spec120/#extension_rtree', 'write-only')",
+                         (table, GEOMETRY_COLUMN))
+        for statement in RTREE_TRIGGERS.format(t=table, c=GEOMETRY_COLUMN, i=self.fid_column).split("END;"):
+            if statement.strip():
+                self._db.execute(statement + "END;")
+
+    def _iter_points(self) -> Iterable[Tuple[int, float, float]]:
+        """Read back the fid and x, y of each point, which follow the header in its geometry."""
+        cursor = self._db.execute(f"SELECT {quote_identifier(self.fid_column)}, "
+                                  f"{quote_identifier(GEOMETRY_COLUMN)} FROM {quote_identifier(self.layer_name)} "
+                                  f"WHERE {quote_identifier(GEOMETRY_COLUMN)} IS NOT NULL")
+        header_size = len(POINT_HEADER)
+        for fid, geometry in cursor:
+            yield (fid, *point_struct.unpack_from(geometry, header_size))
+
+    def close(self) -> None:
+        try:
+            self._flush()
+            self._create_spatial_index()
+            if self._extent[0] <= self._extent[2]:
+                self._db.execute("UPDATE gpkg_contents SET min_x = ?, min_y = ?, max_x = ?, max_y = ? "
+                                 "WHERE table_name = ?", (*self._extent, self.layer_name))
+            self._db.execute("COMMIT")
+        finally:
+            self._db.close()
+        os.replace(self._partial_spec, self.output_spec)
+
+    def abort(self) -> None:
+        """Drop everything written so far, leaving any earlier file at output_spec alone."""
+        self._db.close()
+        os.remove(self._partial_spec)
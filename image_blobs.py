@@ -0,0 +1,245 @@
+"""
+image_blobs.py
+==============
+
+Reads the photos straight from the imagedata table of a GPAP file, so that a
+survey can be reviewed without first extracting every photo to disk. Image
+sizes and thumbnails are read from the blobs a chunk at a time where the
+sqlite3 module supports incremental blob I/O, and an original is only written
+out when something asks for it.
+"""
+import io
+import os
+import sqlite3
+import pathlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import BinaryIO, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from PIL import Image
+from image_size import get_image_size, read_stream_size
+from thumbnails import THUMBNAIL_FORMATS, thumbnail_name, write_thumbnail
+
+# Bytes read from a blob and written to disk at a time
+BLOB_CHUNK_SIZE = 1024 * 1024
+
+# Suffix for files that are still being written, so an interrupted run is redone
+PARTIAL_SUFFIX = ".part"
+
+# Older SQLite builds allow at most 999 host parameters in one statement
+SQLITE_MAX_VARIABLES = 999
+
+
+class BlobImages(NamedTuple):
+    """What rendering needs to know about photos read from the imagedata table."""
+    # Sizes of the originals shown without a thumbnail, read from the blobs
+    sizes: Dict[str, Tuple[int, int]]
+    # Whether every original was written out, so that thumbnails can link to it
+    originals_written: bool
+
+
+def open_readonly(dbfile: str) -> sqlite3.Connection:
+    # Worker connections may be closed by the thread that started the pool
+    return sqlite3.connect(pathlib.Path(dbfile).resolve().as_uri() + "?mode=ro", uri=True,
+                           check_same_thread=False)
+
+
+def open_blob(db: sqlite3.Connection, imagedata_id: int) -> Optional[BinaryIO]:
+    """Return the image data as a seekable file-like object, or None if there is none.
+
+    With Python 3.11+ this reads the blob incrementally, so only the parts
+    of the image that are asked for are read from the database.
+    """
+    if hasattr(db, "blobopen"):
+        try:
+            return db.blobopen("imagedata", "data", imagedata_id, readonly=True)
+        except sqlite3.OperationalError:
+            return None
+    row = db.execute("SELECT data FROM imagedata WHERE _id = ?", (imagedata_id,)).fetchone()
+    if row is None or row[0] is None:
+        return None
+    return io.BytesIO(row[0])
+
+
+def blob_image_size(db: sqlite3.Connection, imagedata_id: int) -> Tuple[int, int]:
+    """Return (width, height) of a stored image from its header, falling back to PIL."""
+    blob = open_blob(db, imagedata_id)
+    if blob is None:
+        raise FileNotFoundError(f"No image data with id {imagedata_id}")
+    with blob:
+        size = read_stream_size(blob)
+        if size is not None and size[0] > 0 and size[1] > 0:
+            return size
+        blob.seek(0)
+        with Image.open(blob) as image:
+            return image.size
+
+
+def read_blob_sizes(dbfile: str, image_blobs: Dict[str, int]) -> Dict[str, Tuple[int, int]]:
+    """Return the (width, height) of the images in image_blobs, a map of image path to imagedata id.
+
+    Images whose size can't be read are left out.
+    """
+    sizes: Dict[str, Tuple[int, int]] = {}
+    if not image_blobs:
+        return sizes
+    db = open_readonly(dbfile)
+    try:
+        # Read the blobs in storage order
+        for image_spec, imagedata_id in sorted(image_blobs.items(), key=lambda item: item[1]):
+            try:
+                sizes[image_spec] = blob_image_size(db, imagedata_id)
+            except Exception as e:
+                print(f"Error reading the size of image data {imagedata_id}: {str(e)}")
+    finally:
+        db.close()
+    return sizes
+
+
+def thumbnail_fits(db: sqlite3.Connection, thumb_spec: str, imagedata_id: int, photo_size: int) -> bool:
+    """Whether a thumbnail already on disk was made at photo_size.
+
+    Its longest side is photo_size, or the original's if that is smaller;
+    only in that case is the header of the original read.
+    """
+    try:
+        longest = max(get_image_size(thumb_spec))
+        if longest == photo_size:
+            return True
+        return longest < photo_size and longest == max(blob_image_size(db, imagedata_id))
+    except Exception:
+        return False
+
+
+def write_blob(db: sqlite3.Connection, imagedata_id: int, output_spec: str,
+               chunk_size: int = BLOB_CHUNK_SIZE) -> bool:
+    """Copy one image to a file a chunk at a time; returns False if there is no image data."""
+    blob = open_blob(db, imagedata_id)
+    if blob is None:
+        return False
+    partial_spec = output_spec + PARTIAL_SUFFIX
+    with blob, open(partial_spec, "wb") as f:
+        while True:
+            chunk = blob.read(chunk_size)
+            if not chunk:
+                break
+            f.write(chunk)
+    os.replace(partial_spec, output_spec)
+    return True
+
+
+def resolve_image_blobs(db: sqlite3.Connection, image_ids: Iterable[int],
+                        chunk_size: int = SQLITE_MAX_VARIABLES) -> Dict[int, int]:
+    """Map image ids to the id of their imagedata row, a chunk of ids per query."""
+    ids = list(image_ids)
+    blobs: Dict[int, int] = {}
+    for start in range(0, len(ids), chunk_size):
+        chunk = ids[start:start + chunk_size]
+        placeholders = ",".join("?" * len(chunk))
+        for image_id, imagedata_id in db.execute(
+                f"SELECT _id, imagedata_id FROM images WHERE _id IN ({placeholders}) "
+                "AND imagedata_id IS NOT NULL", chunk):
+            blobs[image_id] = imagedata_id
+    return blobs
+
+
+# Set in each thumbnail process by _init_blob_worker
+_worker_db: List[sqlite3.Connection] = []
+
+
+def _init_blob_worker(dbfile: str) -> None:
+    _worker_db.append(open_readonly(dbfile))
+
+
+def make_blob_thumbnail(job: Tuple[int, str, int, str]) -> Optional[str]:
+    """Write one thumbnail from a blob; the job is (imagedata_id, thumb_spec, photo_size, format)."""
+    imagedata_id, thumb_spec, photo_size, thumbnail_format = job
+    try:
+        blob = open_blob(_worker_db[0], imagedata_id)
+        if blob is None:
+            return None
+        with blob:
+            write_thumbnail(blob, thumb_spec, photo_size, thumbnail_format)
+        return thumb_spec
+    except Exception as e:
+        print(f"Error making thumbnail for image data {imagedata_id}: {str(e)}")
+        return None
+
+
+def make_blob_thumbnails(dbfile: str,
+                         image_blobs: Dict[str, int],
+                         thumbnail_folder: str,
+                         photo_size: int,
+                         thumbnail_format: str = "jpeg",
+                         workers: Optional[int] = None) -> Dict[str, str]:
+    """Make thumbnails for the images in image_blobs, a map of image path to imagedata id.
+
+    Returns a map of image path to thumbnail path, like make_thumbnails. The
+    photos in a GPAP file don't change once taken, so a thumbnail that is
+    already in the folder is kept if it was made at photo_size.
+    """
+    if thumbnail_format not in THUMBNAIL_FORMATS:
+        raise ValueError(f"Unknown thumbnail format: {thumbnail_format}")
+    os.makedirs(thumbnail_folder, exist_ok=True)
+    existing = set(os.listdir(thumbnail_folder))
+
+    thumbnails: Dict[str, str] = {}
+    jobs: List[Tuple[int, str, int, str]] = []
+    specs: List[str] = []
+    db = open_readonly(dbfile) if existing else None
+    try:
+        # Read the blobs in storage order
+        for image_spec, imagedata_id in sorted(image_blobs.items(), key=lambda item: item[1]):
+            name = thumbnail_name(image_spec, thumbnail_format)
+            thumb_spec = os.path.join(thumbnail_folder, name)
+            if name in existing and thumbnail_fits(db, thumb_spec, imagedata_id, photo_size):
+                thumbnails[image_spec] = thumb_spec
+            else:
+                jobs.append((imagedata_id, thumb_spec, photo_size, thumbnail_format))
+                specs.append(image_spec)
+    finally:
+        if db is not None:
+            db.close()
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers <= 1 or len(jobs) < 2:
+        _init_blob_worker(dbfile)
+        try:
+            results = [make_blob_thumbnail(job) for job in jobs]
+        finally:
+            _worker_db.pop().close()
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_blob_worker,
+                                 initargs=(dbfile,)) as executor:
+            results = list(executor.map(make_blob_thumbnail, jobs, chunksize=8))
+
+    for image_spec, thumb_spec in zip(specs, results):
+        if thumb_spec is not None:
+            thumbnails[image_spec] = thumb_spec
+    return thumbnails
+
+
+def extract_originals(dbfile: str, image_blobs: Dict[str, int], workers: int = 4) -> int:
+    """Write out the images in image_blobs that aren't on disk yet; returns how many were written."""
+    missing = sorted(((imagedata_id, image_spec) for image_spec, imagedata_id in image_blobs.items()
+                      if not os.path.exists(image_spec)))
+    if not missing:
+        return 0
+    folders = {os.path.dirname(image_spec) for _, image_spec in missing}
+    for folder in folders:
+        os.makedirs(folder, exist_ok=True)
+    connections: List[sqlite3.Connection] = []
+
+    def write_range(part: List[Tuple[int, str]]) -> int:
+        db = open_readonly(dbfile)
+        connections.append(db)
+        return sum(1 for imagedata_id, image_spec in part if write_blob(db, imagedata_id, image_spec))
+
+    # Each thread takes every n-th image, still in storage order, on its own connection
+    parts = [missing[start::workers] for start in range(max(1, min(workers, len(missing))))]
+    try:
+        with ThreadPoolExecutor(max_workers=len(parts)) as executor:
+            return sum(executor.map(write_range, parts))
+    finally:
+        for db in connections:
+            db.close()
@@ -0,0 +1,140 @@
+"""
+image_size.py
+=============
+
+Reads photo dimensions from the JPEG SOF / PNG IHDR header bytes instead of
+decoding the image, and keeps the results in a small SQLite cache next to the
+photos so that unchanged images are never read again.
+"""
+import os
+import struct
+import sqlite3
+import threading
+from typing import BinaryIO, Optional, Tuple
+from PIL import Image
+
+SIZE_CACHE_NAME = ".image_sizes.sqlite"
+
+# Notes rendered on several threads share one cache connection
+_cache_lock = threading.Lock()
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+# JPEG start-of-frame markers; C4 (DHT), C8 (JPG) and CC (DAC) are not frames
+JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7,
+                    0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+# JPEG markers that stand alone without a length field
+JPEG_STANDALONE_MARKERS = {0x01, 0xD0, 0xD1, 0xD2, 0xD3, 0xD4, 0xD5, 0xD6, 0xD7, 0xD8}
+
+
+def read_image_size(image_spec: str) -> Optional[Tuple[int, int]]:
+    """Return (width, height) from the file header, or None if it can't be parsed."""
+    with open(image_spec, "rb") as f:
+        return read_stream_size(f)
+
+
+def read_stream_size(f: BinaryIO) -> Optional[Tuple[int, int]]:
+    """read_image_size for an open file or blob, positioned at the start of the image."""
+    head = f.read(24)
+    if head.startswith(PNG_SIGNATURE) and head[12:16] == b"IHDR":
+        width, height = struct.unpack(">II", head[16:24])
+        return width, height
+    if head[:2] == b"\xff\xd8":
+        f.seek(2)
+        return _read_jpeg_size(f)
+    return None
+
+
+def _read_jpeg_size(f) -> Optional[Tuple[int, int]]:
+    while True:
+        byte = f.read(1)
+        if not byte:
+            return None
+        if byte != b"\xff":
+            continue
+        marker = f.read(1)
+        # Any number of 0xFF fill bytes may precede a marker
+        while marker == b"\xff":
+            marker = f.read(1)
+        if not marker:
+            return None
+        code = marker[0]
+        if code in JPEG_STANDALONE_MARKERS or code == 0x00:
+            continue
+        if code == 0xD9 or code == 0xDA:
+            # End of image, or start of scan data before any frame header
+            return None
+        length_bytes = f.read(2)
+        if len(length_bytes) < 2:
+            return None
+        length = struct.unpack(">H", length_bytes)[0]
+        if code in JPEG_SOF_MARKERS:
+            frame = f.read(5)
+            if len(frame) < 5:
+                return None
+            height, width = struct.unpack(">xHH", frame)
+            return width, height
+        # Skip the segment (e.g. a large EXIF block) without reading it
+        f.seek(length - 2, os.SEEK_CUR)
+
+
+def get_image_size(image_spec: str) -> Tuple[int, int]:
+    """Return (width, height), falling back to PIL when the header probe fails."""
+    size = None
+    try:
+        size = read_image_size(image_spec)
+    except FileNotFoundError:
+        raise
+    except (OSError, struct.error):
+        pass
+    if size is not None and size[0] > 0 and size[1] > 0:
+        return size
+    with Image.open(image_spec) as image:
+        return image.size
+
+
+def open_size_cache(image_folder: str) -> sqlite3.Connection:
+    # In autocommit mode lookups don't hold a lock on the cache between statements
+    cache = sqlite3.connect(os.path.join(image_folder, SIZE_CACHE_NAME), isolation_level=None,
+                            check_same_thread=False)
+    cache.execute(
+        "CREATE TABLE IF NOT EXISTS image_sizes ("
+        "path TEXT PRIMARY KEY, mtime_ns INTEGER, file_size INTEGER, "
+        "width INTEGER, height INTEGER)")
+    # New sizes are kept in a temp table until the cache is closed, so several
+    # reports can share one cache without holding a write lock while rendering
+    cache.execute("CREATE TEMP TABLE pending AS SELECT * FROM image_sizes WHERE 0")
+    return cache
+
+
+def close_size_cache(cache: sqlite3.Connection) -> None:
+    try:
+        cache.execute("BEGIN IMMEDIATE")
+        cache.execute("INSERT OR REPLACE INTO image_sizes SELECT * FROM pending")
+        cache.execute("COMMIT")
+    except sqlite3.OperationalError as e:
+        print(f"Could not update the image size cache: {str(e)}")
+    finally:
+        cache.close()
+
+
+def cached_image_size(cache: sqlite3.Connection, image_spec: str) -> Tuple[int, int]:
+    """Return (width, height), reading the image only if it changed since it was cached."""
+    stat = os.stat(image_spec)
+    with _cache_lock:
+        rows = cache.execute(
+            "SELECT mtime_ns, file_size, width, height FROM pending WHERE path = ? "
+            "UNION ALL SELECT mtime_ns, file_size, width, height FROM image_sizes WHERE path = ?",
+            (image_spec, image_spec)).fetchall()
+    for row in rows:
+        if row[0] == stat.st_mtime_ns and row[1] == stat.st_size:
+            return row[2], row[3]
+
+    width, height = get_image_size(image_spec)
+    with _cache_lock:
+        cache.execute(
+            "INSERT OR REPLACE INTO pending (path, mtime_ns, file_size, width, height) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (image_spec, stat.st_mtime_ns, stat.st_size, width, height))
+    return width, height
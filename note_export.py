@@ -0,0 +1,278 @@
+# ACM
+"""
+note_export.py
+==============
+
+Writes the collected form data as JSON Lines, CSV, Parquet or GeoPackage, so
+it can be loaded into pandas or QGIS without parsing the forms JSON again. The notes are read
+and their forms flattened the same way as for the HTML report.
+
+JSON Lines has one object per note with its controls. CSV and Parquet are
+wide, with one row per note and a "form.key" column for every form key found
+in the survey; Parquet needs pyarrow. GeoPackage has the same columns on a
+point layer of the note positions.
+
+    python note_export.py survey.gpap survey.parquet
+"""
+import os
+import csv
+import sys
+import json
+import datetime
+import argparse
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+import ExportInspections_gpap as exp
+from form_json import FormControl, load_controls
+from geopackage import PointLayerWriter, gpkg_timestamp, unique_column_names
+
+EXPORT_FORMATS = {".jsonl": "jsonl", ".csv": "csv", ".parquet": "parquet", ".gpkg": "gpkg"}
+
+BASE_COLUMNS = ["id", "timestamp", "section", "lat", "lon"]
+
+# Notes held in memory before a batch is written to a Parquet file
+PARQUET_BATCH_SIZE = 1000
+
+GPKG_LAYER_NAME = "notes"
+
+GPKG_BASE_TYPES = {"id": "INTEGER", "timestamp": "DATETIME", "section": "TEXT", "lat": "DOUBLE", "lon": "DOUBLE"}
+
+
+def note_timestamp(note: exp.Note) -> Optional[datetime.datetime]:
+    try:
+        return datetime.datetime.fromtimestamp(note.timestamp / 1e3)
+    except (TypeError, ValueError, OverflowError, OSError):
+        return None
+
+
+def control_column(control: FormControl) -> str:
+    return f"{control.form}.{control.key}"
+
+
+def note_controls(note: exp.Note) -> List[FormControl]:
+    """Return the labelled controls of a note, or none if its forms can't be read."""
+    try:
+        controls = load_controls(note.forms)
+    except (ValueError, KeyError, TypeError):
+        return []
+    return [control for control in controls if control.key]
+
+
+def picture_names(value: Any, image_names: Dict[int, str]) -> List[str]:
+    return [image_names[image_id] for image_id in exp.parse_image_ids(value) if image_id in image_names]
+
+
+def wide_row(note: exp.Note, image_names: Dict[int, str]) -> Dict[str, Any]:
+    """One note as a row of its base columns and form values; a repeated key keeps its last value."""
+    row: Dict[str, Any] = {"id": note.id, "timestamp": note_timestamp(note), "section": note.section,
+                           "lat": note.lat, "lon": note.lon}
+    for control in note_controls(note):
+        if control.type == "pictures":
+            row[control_column(control)] = ";".join(picture_names(control.value, image_names))
+        elif control.value is None:
+            row[control_column(control)] = None
+        else:
+            row[control_column(control)] = str(control.value)
+    return row
+
+
+def collect_columns(notes: Iterable[exp.Note]) -> List[str]:
+    """Return the base columns and then every form column, in the order they are first seen."""
+    columns = dict.fromkeys(BASE_COLUMNS)
+    for note in notes:
+        for control in note_controls(note):
+            columns.setdefault(control_column(control))
+    return list(columns)
+
+
+class JsonLinesSink:
+    needs_columns = False
+
+    def __init__(self, output_spec: str, image_names: Dict[int, str]):
+        self._image_names = image_names
+        self._file = open(output_spec, "w", encoding="utf-8", buffering=exp.WRITE_BUFFER_SIZE)
+
+    def add(self, note: exp.Note) -> None:
+        timestamp = note_timestamp(note)
+        controls = []
+        for control in note_controls(note):
+            item = {"form": control.form, "key": control.key, "value": control.value, "type": control.type}
+            if control.type == "pictures":
+                item["images"] = picture_names(control.value, self._image_names)
+            controls.append(item)
+        record = {"id": note.id, "timestamp": timestamp.isoformat() if timestamp else None,
+                  "section": note.section, "lat": note.lat, "lon": note.lon, "controls": controls}
+        self._file.write(json.dumps(record, ensure_ascii=False, default=str))
+        self._file.write("\n")
+
+    def close(self) -> None:
+        self._file.close()
+
+
+class CsvSink:
+    needs_columns = True
+
+    def __init__(self, output_spec: str, image_names: Dict[int, str], columns: List[str]):
+        self._image_names = image_names
+        self._file = open(output_spec, "w", encoding="utf-8", newline="", buffering=exp.WRITE_BUFFER_SIZE)
+        self._writer = csv.DictWriter(self._file, fieldnames=columns, extrasaction="ignore")
+        self._writer.writeheader()
+
+    def add(self, note: exp.Note) -> None:
+        row = wide_row(note, self._image_names)
+        if row["timestamp"] is not None:
+            row["timestamp"] = row["timestamp"].isoformat()
+        self._writer.writerow(row)
+
+    def close(self) -> None:
+        self._file.close()
+
+
+class ParquetSink:
+    needs_columns = True
+
+    def __init__(self, output_spec: str, image_names: Dict[int, str], columns: List[str],
+                 batch_size: int = PARQUET_BATCH_SIZE):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError("Writing Parquet needs pyarrow: pip install pyarrow")
+        self._pa = pyarrow
+        self._image_names = image_names
+        self._columns = columns
+        self._batch_size = batch_size
+        base_types = {"id": pyarrow.int64(), "timestamp": pyarrow.timestamp("ms"),
+                      "section": pyarrow.string(), "lat": pyarrow.float64(), "lon": pyarrow.float64()}
+        self._schema = pyarrow.schema([(column, base_types.get(column, pyarrow.string()))
+                                       for column in columns])
+        self._writer = pyarrow.parquet.ParquetWriter(output_spec, self._schema)
+        self._batch: Dict[str, List[Any]] = {column: [] for column in columns}
+        self._batch_rows = 0
+
+    def add(self, note: exp.Note) -> None:
+        row = wide_row(note, self._image_names)
+        for column in self._columns:
+            self._batch[column].append(row.get(column))
+        self._batch_rows += 1
+        if self._batch_rows >= self._batch_size:
+            self._flush()
+
+    def _flush(self) -> None:
+        if self._batch_rows:
+            self._writer.write_table(self._pa.Table.from_pydict(self._batch, schema=self._schema))
+            self._batch = {column: [] for column in self._columns}
+            self._batch_rows = 0
+
+    def close(self) -> None:
+        self._flush()
+        self._writer.close()
+
+
+class GeoPackageSink:
+    needs_columns = True
+
+    def __init__(self, output_spec: str, image_names: Dict[int, str], columns: List[str]):
+        self._image_names = image_names
+        self._columns = columns
+        # SQLite column names ignore case, and the layer has its own fid and geom
+        names = unique_column_names(columns, reserved=("fid", "geom"))
+        self._writer = PointLayerWriter(output_spec, GPKG_LAYER_NAME,
+                                        [(name, GPKG_BASE_TYPES.get(column, "TEXT"))
+                                         for name, column in zip(names, columns)],
+                                        description="Notes and form answers")
+
+    def add(self, note: exp.Note) -> None:
+        row = wide_row(note, self._image_names)
+        row["timestamp"] = gpkg_timestamp(note.timestamp)
+        self._writer.add(note.lon, note.lat, [row.get(column) for column in self._columns])
+
+    def close(self) -> None:
+        self._writer.close()
+
+    def abort(self) -> None:
+        self._writer.abort()
+
+
+SINKS = {"jsonl": JsonLinesSink, "csv": CsvSink, "parquet": ParquetSink, "gpkg": GeoPackageSink}
+
+
+def export_format_for(output_spec: str) -> str:
+    extension = os.path.splitext(output_spec)[1].lower()
+    if extension not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format for {output_spec}, use one of {', '.join(EXPORT_FORMATS)}")
+    return EXPORT_FORMATS[extension]
+
+
+def open_sinks(db: Any, output_specs: Iterable[str], image_names: Dict[int, str],
+               **note_filters: Any) -> List[Any]:
+    """Open a sink for each output file, reading the form columns first if any sink needs them."""
+    formats = [(output_spec, export_format_for(output_spec)) for output_spec in output_specs]
+    columns = None
+    if any(SINKS[export_format].needs_columns for _, export_format in formats):
+        columns = collect_columns(exp.iter_notes(db, **note_filters))
+    sinks = []
+    try:
+        for output_spec, export_format in formats:
+            sink_class = SINKS[export_format]
+            if sink_class.needs_columns:
+                sinks.append(sink_class(output_spec, image_names, columns))
+            else:
+                sinks.append(sink_class(output_spec, image_names))
+    except Exception:
+        close_sinks(sinks, aborted=True)
+        raise
+    return sinks
+
+
+def feed_sinks(notes: Iterable[exp.Note], sinks: List[Any]) -> Iterator[exp.Note]:
+    """Pass each note to the sinks on its way through, so another writer can use the same notes."""
+    for note in notes:
+        for sink in sinks:
+            sink.add(note)
+        yield note
+
+
+def close_sinks(sinks: List[Any], aborted: bool = False) -> None:
+    """Close the sinks; after an error, sinks that can drop what they wrote do so instead."""
+    for sink in sinks:
+        if aborted and hasattr(sink, "abort"):
+            sink.abort()
+        else:
+            sink.close()
+
+
+def export_notes(dbfile: str, output_specs: List[str],
+                 db_options: Optional[Dict[str, Any]] = None,
+                 **note_filters: Any) -> int:
+    """Write the notes to each output file, in the format given by its extension.
+
+    note_filters are passed on to iter_notes and db_options to open_db.
+    Returns the number of notes written.
+    """
+    db = exp.open_db(dbfile, **{"read_only": True, **(db_options or {})})
+    try:
+        image_names = exp.get_image_names(db, **note_filters)
+        sinks = open_sinks(db, output_specs, image_names, **note_filters)
+        count = 0
+        finished = False
+        try:
+            for _ in feed_sinks(exp.iter_notes(db, **note_filters), sinks):
+                count += 1
+            finished = True
+        finally:
+            close_sinks(sinks, aborted=not finished)
+    finally:
+        db.close()
+    return count
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Export the form data of a GPAP file.")
+    parser.add_argument("dbfile", help="the .gpap file")
+    parser.add_argument("outputs", nargs="+", help="files to write, ending in .jsonl, .csv, .parquet or .gpkg")
+    parser.add_argument("--section", default=None, help="only export notes of this section")
+    args = parser.parse_args()
+    count = export_notes(args.dbfile, args.outputs, section=args.section)
+    print(f"Exported {count} notes")
+    sys.exit(0)
@@ -0,0 +1,371 @@
+# ACM
+"""
+note_store.py
+=============
+
+Holds the notes of a survey in memory as columns, for analysis across a
+whole season without keeping a decoded forms dictionary per note. Sections,
+form names, keys, control types and values repeat across thousands of notes,
+so each is stored once in a StringTable and the columns hold integer codes.
+Ids, timestamps and coordinates are kept in typed arrays, and the controls of
+all notes are kept in one set of parallel arrays, with each note's controls
+being a slice of them.
+
+Filters return a mask with one byte per note, which can be combined with
+mask_and and mask_or; the aggregations take an optional mask. When NumPy is
+installed the filters and mask operations run on NumPy views of the columns,
+otherwise they loop over the arrays in Python.
+
+    python note_store.py survey.gpap
+"""
+import sys
+import math
+import json
+import argparse
+import datetime
+import operator
+from array import array
+from collections import Counter
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Union
+
+import ExportInspections_gpap as exp
+from form_json import FormControl, load_controls
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+Mask = bytearray
+
+MISSING = float("nan")
+
+COLUMNS = ["ids", "timestamps", "lats", "lons", "sections", "control_start", "control_note",
+           "control_form", "control_key", "control_type", "control_value", "control_number"]
+
+
+class StringTable:
+    """Gives each distinct string an integer code, so a column of strings can be an array of codes."""
+
+    def __init__(self):
+        self.strings: List[str] = []
+        self._codes: Dict[str, int] = {}
+
+    def code(self, text: str) -> int:
+        code = self._codes.get(text)
+        if code is None:
+            code = len(self.strings)
+            self._codes[text] = code
+            self.strings.append(text)
+        return code
+
+    def find(self, text: str) -> Optional[int]:
+        """Return the code of a string without adding it, or None if it was never stored."""
+        return self._codes.get(text)
+
+    def __getitem__(self, code: int) -> str:
+        return self.strings[code]
+
+    def __len__(self) -> int:
+        return len(self.strings)
+
+
+def value_text(value: Any) -> str:
+    """The stored form of a control value; lists and dictionaries are kept as JSON."""
+    if isinstance(value, str):
+        return value
+    if isinstance(value, (list, dict)):
+        return json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+    return str(value)
+
+
+def value_number(value: Any) -> float:
+    """Return the value as a number for min/max, or NaN if it isn't one."""
+    if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+        return MISSING
+    try:
+        number = float(value)
+    except (ValueError, OverflowError):
+        return MISSING
+    return number if math.isfinite(number) else MISSING
+
+
+def optional_float(value: Any) -> float:
+    try:
+        return float(value) if value is not None else MISSING
+    except (TypeError, ValueError):
+        return MISSING
+
+
+def column_view(column: array) -> Any:
+    """A NumPy array sharing the memory of an array column; needs numpy."""
+    return numpy.frombuffer(column, dtype=column.typecode)
+
+
+def mask_view(mask: Mask) -> Any:
+    return numpy.frombuffer(mask, dtype=numpy.uint8)
+
+
+def to_mask(selected: Any) -> Mask:
+    """Turn a NumPy array of booleans into a mask."""
+    return bytearray(selected.astype(numpy.uint8).tobytes())
+
+
+def mask_and(*masks: Mask) -> Mask:
+    if numpy is not None:
+        return to_mask(numpy.logical_and.reduce([mask_view(mask) for mask in masks]))
+    result = masks[0]
+    for mask in masks[1:]:
+        result = bytearray(map(operator.and_, result, mask))
+    return result
+
+
+def mask_or(*masks: Mask) -> Mask:
+    if numpy is not None:
+        return to_mask(numpy.logical_or.reduce([mask_view(mask) for mask in masks]))
+    result = masks[0]
+    for mask in masks[1:]:
+        result = bytearray(map(operator.or_, result, mask))
+    return result
+
+
+def mask_not(mask: Mask) -> Mask:
+    if numpy is not None:
+        return to_mask(mask_view(mask) == 0)
+    return bytearray(1 - selected for selected in mask)
+
+
+class NoteStore:
+    """The notes of a survey as columns; build one with load_note_store or from_notes."""
+
+    def __init__(self):
+        self.strings = StringTable()
+        self.values = StringTable()
+        # One entry per note
+        self.ids = array("q")
+        self.timestamps = array("d")
+        self.lats = array("d")
+        self.lons = array("d")
+        self.sections = array("i")
+        # Controls of note n are control_start[n]:control_start[n + 1] of the control columns,
+        # and control_note holds the n of each control
+        self.control_start = array("i", [0])
+        self.control_note = array("i")
+        self.control_form = array("i")
+        self.control_key = array("i")
+        self.control_type = array("i")
+        # Codes into values, -1 for no value; control_number is NaN unless the value is a number
+        self.control_value = array("i")
+        self.control_number = array("d")
+        # The controls of each key code, so a key is found without scanning every control
+        self._key_controls: Dict[int, array] = {}
+
+    @classmethod
+    def from_notes(cls, notes: Iterable[exp.Note]) -> "NoteStore":
+        store = cls()
+        for note in notes:
+            store.add(note)
+        return store
+
+    def add(self, note: exp.Note) -> None:
+        strings = self.strings
+        row = len(self.ids)
+        self.ids.append(note.id)
+        self.timestamps.append(optional_float(note.timestamp))
+        self.lats.append(optional_float(note.lat))
+        self.lons.append(optional_float(note.lon))
+        self.sections.append(strings.code(note.section) if note.section is not None else -1)
+        try:
+            controls = load_controls(note.forms)
+        except (ValueError, KeyError, TypeError):
+            controls = []
+        for control in controls:
+            if not control.key:
+                continue
+            key_code = strings.code(str(control.key))
+            self._key_controls.setdefault(key_code, array("i")).append(len(self.control_key))
+            self.control_note.append(row)
+            self.control_form.append(strings.code(str(control.form)))
+            self.control_key.append(key_code)
+            self.control_type.append(strings.code(str(control.type)))
+            if control.value is None:
+                self.control_value.append(-1)
+                self.control_number.append(MISSING)
+            else:
+                self.control_value.append(self.values.code(value_text(control.value)))
+                self.control_number.append(value_number(control.value))
+        self.control_start.append(len(self.control_key))
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def section(self, row: int) -> Optional[str]:
+        code = self.sections[row]
+        return self.strings[code] if code >= 0 else None
+
+    def controls(self, row: int) -> List[FormControl]:
+        """Return the controls of the note in a row, with their values as stored."""
+        strings = self.strings
+        return [FormControl(strings[self.control_form[i]], strings[self.control_key[i]],
+                            self.values[self.control_value[i]] if self.control_value[i] >= 0 else None,
+                            strings[self.control_type[i]])
+                for i in range(self.control_start[row], self.control_start[row + 1])]
+
+    def columns(self) -> Dict[str, array]:
+        return {name: getattr(self, name) for name in COLUMNS}
+
+    def memory_size(self) -> int:
+        """Return the approximate bytes held by the columns and string tables."""
+        columns = [*self.columns().values(), *self._key_controls.values()]
+        size = sum(column.itemsize * len(column) for column in columns)
+        return size + sum(sys.getsizeof(text) for table in (self.strings, self.values) for text in table.strings)
+
+    # Filters
+
+    def all(self) -> Mask:
+        return bytearray(b"\x01" * len(self))
+
+    def selected_ids(self, mask: Mask) -> List[int]:
+        return [note_id for note_id, selected in zip(self.ids, mask) if selected]
+
+    def where_section(self, section: str) -> Mask:
+        code = self.strings.find(section)
+        if code is None:
+            return bytearray(len(self))
+        if numpy is not None:
+            return to_mask(column_view(self.sections) == code)
+        return bytearray(section_code == code for section_code in self.sections)
+
+    def where_time(self, start: Optional[Union[datetime.date, float]] = None,
+                   end: Optional[Union[datetime.date, float]] = None) -> Mask:
+        """Notes taken from start up to (not including) end, as dates or epoch milliseconds."""
+        low = exp.to_epoch_ms(start) if start is not None else -math.inf
+        high = exp.to_epoch_ms(end) if end is not None else math.inf
+        if numpy is not None:
+            timestamps = column_view(self.timestamps)
+            return to_mask((low <= timestamps) & (timestamps < high))
+        return bytearray(low <= timestamp < high for timestamp in self.timestamps)
+
+    def where_bbox(self, bbox: Tuple[float, float, float, float]) -> Mask:
+        """Notes in (min_lon, min_lat, max_lon, max_lat), inclusive; notes without a position never match."""
+        min_lon, min_lat, max_lon, max_lat = bbox
+        if numpy is not None:
+            lons, lats = column_view(self.lons), column_view(self.lats)
+            return to_mask((min_lon <= lons) & (lons <= max_lon) & (min_lat <= lats) & (lats <= max_lat))
+        return bytearray(min_lon <= lon <= max_lon and min_lat <= lat <= max_lat
+                         for lon, lat in zip(self.lons, self.lats))
+
+    def _controls_of(self, key: str, form: Optional[str] = None) -> List[int]:
+        key_code = self.strings.find(key)
+        if key_code is None or key_code not in self._key_controls:
+            return []
+        positions = self._key_controls[key_code]
+        if form is None:
+            return list(positions)
+        form_code = self.strings.find(form)
+        return [i for i in positions if self.control_form[i] == form_code]
+
+    def where_key(self, key: str, form: Optional[str] = None) -> Mask:
+        """Notes with an answer for a key, in any form or only in form."""
+        mask = bytearray(len(self))
+        positions = [i for i in self._controls_of(key, form) if self.control_value[i] >= 0]
+        for i in positions:
+            mask[self.control_note[i]] = 1
+        return mask
+
+    def where_value(self, key: str, value: Any, form: Optional[str] = None) -> Mask:
+        """Notes where a key has the given value, compared as stored text."""
+        mask = bytearray(len(self))
+        value_code = self.values.find(value_text(value))
+        if value_code is None:
+            return mask
+        positions = [i for i in self._controls_of(key, form) if self.control_value[i] == value_code]
+        for i in positions:
+            mask[self.control_note[i]] = 1
+        return mask
+
+    def where_range(self, key: str, low: float = -math.inf, high: float = math.inf,
+                    form: Optional[str] = None) -> Mask:
+        """Notes where a key has a number from low to high, inclusive."""
+        mask = bytearray(len(self))
+        positions = [i for i in self._controls_of(key, form) if low <= self.control_number[i] <= high]
+        for i in positions:
+            mask[self.control_note[i]] = 1
+        return mask
+
+    # Aggregations
+
+    def _selected_controls(self, key: str, form: Optional[str], mask: Optional[Mask]) -> List[int]:
+        positions = self._controls_of(key, form)
+        if mask is not None:
+            positions = [i for i in positions if mask[self.control_note[i]]]
+        return positions
+
+    def key_counts(self, mask: Optional[Mask] = None) -> Dict[Tuple[str, str], int]:
+        """Return how many answers each (form, key) has, in the order the keys were first seen."""
+        counts: Counter = Counter()
+        for row, form_code, key_code, value_code in zip(self.control_note, self.control_form,
+                                                        self.control_key, self.control_value):
+            if value_code >= 0 and (mask is None or mask[row]):
+                counts[form_code, key_code] += 1
+        return {(self.strings[form_code], self.strings[key_code]): count
+                for (form_code, key_code), count in counts.items()}
+
+    def value_counts(self, key: str, form: Optional[str] = None,
+                     mask: Optional[Mask] = None) -> Dict[str, int]:
+        """Return how often each value of a key occurs, most common first."""
+        counts = Counter(self.control_value[i] for i in self._selected_controls(key, form, mask))
+        counts.pop(-1, None)
+        return {self.values[value_code]: count for value_code, count in counts.most_common()}
+
+    def distinct_values(self, key: str, form: Optional[str] = None,
+                        mask: Optional[Mask] = None) -> List[str]:
+        return sorted(self.value_counts(key, form, mask))
+
+    def value_range(self, key: str, form: Optional[str] = None,
+                    mask: Optional[Mask] = None) -> Optional[Tuple[float, float]]:
+        """Return the smallest and largest numeric value of a key, or None if it has none."""
+        numbers = [number for number in (self.control_number[i] for i in self._selected_controls(key, form, mask))
+                   if not math.isnan(number)]
+        if not numbers:
+            return None
+        return min(numbers), max(numbers)
+
+    def summary(self, mask: Optional[Mask] = None) -> List[Dict[str, Any]]:
+        """Return the count, distinct values and numeric range of every (form, key)."""
+        rows = []
+        for (form, key), count in self.key_counts(mask).items():
+            value_range = self.value_range(key, form, mask)
+            rows.append({"form": form, "key": key, "count": count,
+                         "distinct": len(self.value_counts(key, form, mask)),
+                         "min": value_range[0] if value_range else None,
+                         "max": value_range[1] if value_range else None})
+        return rows
+
+    def to_numpy(self) -> Dict[str, Any]:
+        """Return the columns as NumPy arrays sharing the store's memory; needs numpy."""
+        if numpy is None:
+            raise ImportError("NumPy columns need numpy: pip install numpy")
+        return {name: column_view(column) for name, column in self.columns().items()}
+
+
+def load_note_store(db: Any, **note_filters: Any) -> NoteStore:
+    """Read the notes of a database into a NoteStore; note_filters are passed on to iter_notes."""
+    return NoteStore.from_notes(exp.iter_notes(db, **note_filters))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Summarise the form data of a GPAP file.")
+    parser.add_argument("dbfile", help="the .gpap file")
+    parser.add_argument("--section", default=None, help="only read notes of this section")
+    args = parser.parse_args()
+    db = exp.open_db(args.dbfile, read_only=True)
+    try:
+        store = load_note_store(db, section=args.section)
+    finally:
+        db.close()
+    print(f"{len(store)} notes, {len(store.control_key)} answers, {store.memory_size() / 1e6:.1f} MB")
+    for row in store.summary():
+        value_range = f" {row['min']:g} to {row['max']:g}" if row["min"] is not None else ""
+        print(f"{row['form']}.{row['key']}: {row['count']} answers, {row['distinct']} distinct{value_range}")
+    sys.exit(0)
@@ -0,0 +1,130 @@
+"""
+profiling.py
+============
+
+Opt-in timing of the stages of a report run. Stages are timed with the
+timed decorator or the stage context manager, which cost next to nothing
+until enable() is called. summary() reports call counts, cumulative and p95
+latencies and bytes read or written for each stage.
+"""
+import json
+import math
+import time
+import functools
+from contextlib import contextmanager, nullcontext
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional
+
+_enabled = False
+_latencies: Dict[str, List[float]] = {}
+_bytes: Dict[str, int] = {}
+
+
+def enable() -> None:
+    global _enabled
+    _enabled = True
+
+
+def disable() -> None:
+    global _enabled
+    _enabled = False
+
+
+def is_enabled() -> bool:
+    return _enabled
+
+
+def reset() -> None:
+    _latencies.clear()
+    _bytes.clear()
+
+
+def record(name: str, seconds: float) -> None:
+    _latencies.setdefault(name, []).append(seconds)
+
+
+def add_bytes(name: str, count: int) -> None:
+    if _enabled:
+        _bytes[name] = _bytes.get(name, 0) + count
+
+
+@contextmanager
+def _timed_block(name: str) -> Iterator[None]:
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - start)
+
+
+def stage(name: str):
+    """Context manager timing the enclosed block as one call of the stage."""
+    if not _enabled:
+        return nullcontext()
+    return _timed_block(name)
+
+
+def timed(name: str) -> Callable[[Callable], Callable]:
+    """Decorator timing every call of the function as a call of the stage."""
+    def decorate(func: Callable) -> Callable:
+        @functools.wraps(func)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            if not _enabled:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                record(name, time.perf_counter() - start)
+        return wrapper
+    return decorate
+
+
+def timed_iter(name: str, items: Iterable[Any]) -> Iterator[Any]:
+    """Time each step of an iterator, such as fetching rows from a cursor."""
+    iterator = iter(items)
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        if _enabled:
+            record(name, time.perf_counter() - start)
+        yield item
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+def summary() -> Dict[str, Dict[str, Any]]:
+    stages: Dict[str, Dict[str, Any]] = {}
+    for name in sorted(set(_latencies) | set(_bytes)):
+        latencies = _latencies.get(name, [])
+        total = sum(latencies)
+        stages[name] = {
+            "calls": len(latencies),
+            "total_seconds": total,
+            "mean_seconds": total / len(latencies) if latencies else 0.0,
+            "p95_seconds": percentile(latencies, 0.95) if latencies else 0.0,
+            "bytes": _bytes.get(name, 0),
+        }
+    return stages
+
+
+def format_summary() -> str:
+    lines = [f"{'Stage':<20} {'Calls':>8} {'Total s':>10} {'Mean ms':>10} {'p95 ms':>10} {'Bytes':>12}"]
+    for name, stats in summary().items():
+        lines.append(f"{name:<20} {stats['calls']:>8} {stats['total_seconds']:>10.3f} "
+                     f"{stats['mean_seconds'] * 1000:>10.3f} {stats['p95_seconds'] * 1000:>10.3f} "
+                     f"{stats['bytes']:>12}")
+    return "\n".join(lines)
+
+
+def dump_json(json_spec: str, extra: Optional[Dict[str, Any]] = None) -> None:
+    data = {"stages": summary()}
+    if extra:
+        data.update(extra)
+    with open(json_spec, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=2)
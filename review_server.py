@@ -0,0 +1,405 @@
+# ACM
+"""
+review_server.py
+================
+
+A local web server for reviewing a GPAP file page by page, instead of
+rendering the whole survey into one HTML file first. Notes are rendered
+when a page asks for them, with the same code as the report, and kept in an
+LRU cache keyed on the note id and its modified time. Thumbnails are made
+for the photos of each page as it is shown and served with ETag and
+Last-Modified headers, so the browser only fetches them once.
+
+    python review_server.py survey.gpap photos_folder --port 8000
+"""
+import os
+import re
+import sys
+import html
+import argparse
+import threading
+import webbrowser
+import email.utils
+from collections import OrderedDict
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+from typing import Any, Dict, Hashable, List, Optional, Tuple
+
+import ExportInspections_gpap as exp
+from connection_pool import connection_for
+from form_json import flatten_forms, loads as form_json_loads
+from image_blobs import open_blob, resolve_image_blobs, make_blob_thumbnails
+from image_size import open_size_cache, close_size_cache
+from thumbnails import make_thumbnails, thumbnail_folder
+
+PAGE_SIZE = 50
+
+# Rendered notes kept in memory
+RENDER_CACHE_SIZE = 2000
+
+CONTENT_TYPES = {".jpg": "image/jpeg", ".jpeg": "image/jpeg", ".webp": "image/webp",
+                 ".png": "image/png", ".gif": "image/gif"}
+
+BLOB_CHUNK_SIZE = 256 * 1024
+
+
+class LRUCache:
+    def __init__(self, maxsize: int = RENDER_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._items: "OrderedDict[Hashable, Any]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            value = self._items.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: Hashable, value: Any) -> None:
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+
+class ReviewApp:
+    """Everything the request handlers share: the database, the caches and the settings."""
+
+    def __init__(self, dbfile: str, image_folder: str,
+                 photo_size: int = 400,
+                 page_size: int = PAGE_SIZE,
+                 thumbnail_format: str = "jpeg",
+                 image_source: str = "folder",
+                 cache_size: int = RENDER_CACHE_SIZE):
+        if image_source not in ("folder", "blobs"):
+            raise ValueError(f"Unknown image source: {image_source}")
+        self.dbfile = dbfile
+        self.image_folder = image_folder
+        self.photo_size = photo_size
+        self.page_size = page_size
+        self.thumbnail_format = thumbnail_format
+        self.image_source = image_source
+        self.thumbnail_folder = thumbnail_folder(image_folder, photo_size)
+        self.title = os.path.splitext(os.path.basename(dbfile))[0]
+        # Request threads each get their own read-only connection
+        self.pool = exp.open_pool(dbfile, read_only=True)
+        db = self.pool.get()
+        self.longitude_index = exp.get_longitude_index(db)
+        self.latitude_index = exp.get_latitude_index(db)
+        self.image_names = exp.get_image_names(db)
+        self.image_specs = {name: os.path.join(image_folder, name) for name in self.image_names.values()}
+        self.image_blobs: Dict[str, int] = {}
+        if image_source == "blobs":
+            self.image_blobs = {self.image_names[image_id]: imagedata_id for image_id, imagedata_id
+                                in resolve_image_blobs(db, self.image_names).items()}
+        try:
+            self.size_cache = open_size_cache(image_folder)
+        except Exception as e:
+            print(f"Could not open the image size cache: {str(e)}")
+            self.size_cache = None
+        self.thumbnails: Dict[str, str] = {}
+        # Guards thumbnails and the thumbnails being made; each request makes the ones it claimed
+        self.thumbnail_lock = threading.Lock()
+        self.thumbnails_in_progress: Dict[str, threading.Event] = {}
+        # The file:/// links of rendered notes, and where the server serves them instead
+        self.link_patterns = []
+        for folder, route in ((self.thumbnail_folder, "/thumb/"), (image_folder, "/photo/")):
+            prefix = "\"file:///" + exp.escape(os.path.join(folder, ""))
+            self.link_patterns.append((re.compile(re.escape(prefix) + "([^\"]*)\""), route))
+        self.render_cache = LRUCache(cache_size)
+
+    def close(self) -> None:
+        if self.size_cache is not None:
+            close_size_cache(self.size_cache)
+        self.pool.close()
+
+    def note_ids(self) -> List[int]:
+        db = self.pool.get()
+        id_column = exp.get_note_schema(db)["id"]
+        return [row[0] for row in db.execute(f"SELECT {exp.quote_column(id_column)} FROM notes "
+                                             f"ORDER BY {exp.quote_column(id_column)}")]
+
+    def page_count(self, note_count: int) -> int:
+        return max(1, -(-note_count // self.page_size))
+
+    def notes(self, note_ids: List[int]) -> List[exp.Note]:
+        return list(exp.iter_notes(self.pool, note_ids=note_ids))
+
+    def ensure_thumbnails(self, notes: List[exp.Note]) -> None:
+        """Make the thumbnails of the photos in these notes that haven't been made yet."""
+        names = set()
+        for note in notes:
+            try:
+                controls = flatten_forms(form_json_loads(note.forms)) if note.forms else []
+            except (ValueError, KeyError, TypeError):
+                continue
+            for control in controls:
+                if control.type == "pictures":
+                    names.update(self.image_names[image_id] for image_id in exp.parse_image_ids(control.value)
+                                 if image_id in self.image_names)
+        claimed: List[str] = []
+        waiting: List[threading.Event] = []
+        with self.thumbnail_lock:
+            for name in names:
+                if self.image_specs[name] in self.thumbnails:
+                    continue
+                event = self.thumbnails_in_progress.get(name)
+                if event is not None:
+                    # Another request is making it
+                    waiting.append(event)
+                else:
+                    self.thumbnails_in_progress[name] = threading.Event()
+                    claimed.append(name)
+        made: Dict[str, str] = {}
+        try:
+            if claimed:
+                made = self.make_thumbnails(claimed)
+        finally:
+            with self.thumbnail_lock:
+                self.thumbnails.update(made)
+                for name in claimed:
+                    self.thumbnails_in_progress.pop(name).set()
+        for event in waiting:
+            event.wait()
+
+    def make_thumbnails(self, names: List[str]) -> Dict[str, str]:
+        if self.image_source == "blobs":
+            blobs = {self.image_specs[name]: self.image_blobs[name] for name in names
+                     if name in self.image_blobs}
+            return make_blob_thumbnails(self.dbfile, blobs, self.thumbnail_folder, self.photo_size,
+                                        self.thumbnail_format, workers=1)
+        return make_thumbnails([self.image_specs[name] for name in names], self.thumbnail_folder,
+                               self.photo_size, self.thumbnail_format, workers=1)
+
+    def render_note(self, note: exp.Note) -> str:
+        """Render a note through row_level, or take it from the cache if it hasn't changed."""
+        key = (note.id, note.timestamp)
+        fragment = self.render_cache.get(key)
+        if fragment is None:
+            fragment = exp.row_level(note, self.longitude_index, self.latitude_index, self.image_folder,
+                                     self.photo_size, custom_db=connection_for(self.pool),
+                                     image_names=self.image_names, size_cache=self.size_cache,
+                                     thumbnails=self.thumbnails)
+            fragment = self.localize_links(fragment)
+            self.render_cache.put(key, fragment)
+        return fragment
+
+    def localize_links(self, fragment: str) -> str:
+        """Point the file:/// links of a rendered note at the server, with the file names URL-quoted."""
+        # The thumbnail folder is inside the image folder, so its links are replaced first
+        for pattern, route in self.link_patterns:
+            fragment = pattern.sub(lambda match: f"\"{route}{exp.page_href(html.unescape(match.group(1)))}\"",
+                                   fragment)
+        return fragment
+
+    def render_page(self, page_number: int) -> Optional[str]:
+        note_ids = self.note_ids()
+        page_count = self.page_count(len(note_ids))
+        if page_number < 1 or page_number > page_count:
+            return None
+        start = (page_number - 1) * self.page_size
+        notes = self.notes(note_ids[start:start + self.page_size])
+        self.ensure_thumbnails(notes)
+        links = []
+        if page_number > 1:
+            links.append(f"<a href=\"/?page={page_number - 1}\">Previous</a>")
+        links.append(f"Page {page_number} of {page_count} ({len(note_ids)} notes)")
+        if page_number < page_count:
+            links.append(f"<a href=\"/?page={page_number + 1}\">Next</a>")
+        navigation = "<p>" + " | ".join(links) + "</p>\n"
+        parts = [exp.page_header(f"{self.title} ({page_number})"), navigation]
+        for note in notes:
+            parts.append(f"<div id=\"note-{note.id}\">\n{self.render_note(note)}</div>\n")
+        parts.append(navigation)
+        parts.append(exp.PAGE_FOOTER)
+        return "".join(parts)
+
+    def render_single_note(self, note_id: int) -> Optional[str]:
+        notes = self.notes([note_id])
+        if not notes:
+            return None
+        self.ensure_thumbnails(notes)
+        return "".join([exp.page_header(f"{self.title} - {note_id}"),
+                        "<p><a href=\"/\">Index</a></p>\n", self.render_note(notes[0]), exp.PAGE_FOOTER])
+
+
+def file_validators(stat: os.stat_result) -> Tuple[str, str]:
+    """Return the ETag and Last-Modified header values for a file."""
+    return f"\"{stat.st_mtime_ns:x}-{stat.st_size:x}\"", email.utils.formatdate(stat.st_mtime, usegmt=True)
+
+
+class ReviewHandler(BaseHTTPRequestHandler):
+    server_version = "GpapReview/1.0"
+
+    @property
+    def app(self) -> ReviewApp:
+        return self.server.app
+
+    def log_message(self, format: str, *args: Any) -> None:
+        # Keep the console for errors rather than a line per thumbnail
+        pass
+
+    def do_GET(self) -> None:
+        url = urlsplit(self.path)
+        path = unquote(url.path)
+        try:
+            if path == "/":
+                page = parse_qs(url.query).get("page", ["1"])[0]
+                self.send_html(self.app.render_page(int(page)) if page.isdigit() else None)
+            elif path.startswith("/note/") and path[6:].isdigit():
+                self.send_html(self.app.render_single_note(int(path[6:])))
+            elif path.startswith("/thumb/"):
+                self.send_thumbnail(path[7:])
+            elif path.startswith("/photo/"):
+                self.send_photo(path[7:])
+            else:
+                self.send_error(HTTPStatus.NOT_FOUND)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def send_html(self, text: Optional[str]) -> None:
+        if text is None:
+            self.send_error(HTTPStatus.NOT_FOUND)
+            return
+        body = text.encode("utf-8")
+        self.send_response(HTTPStatus.OK)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def not_modified(self, etag: str, last_modified: str) -> bool:
+        """Answer 304 if the browser's copy is current; If-None-Match wins over If-Modified-Since."""
+        if_none_match = self.headers.get("If-None-Match")
+        if if_none_match is not None:
+            current = if_none_match.strip() == "*" or etag in [tag.strip() for tag in if_none_match.split(",")]
+        else:
+            current = self.headers.get("If-Modified-Since") == last_modified
+        if current:
+            self.send_response(HTTPStatus.NOT_MODIFIED)
+            self.send_header("ETag", etag)
+            self.send_header("Last-Modified", last_modified)
+            self.end_headers()
+        return current
+
+    def send_file(self, file_spec: str) -> None:
+        try:
+            stat = os.stat(file_spec)
+        except OSError:
+            self.send_error(HTTPStatus.NOT_FOUND)
+            return
+        etag, last_modified = file_validators(stat)
+        if self.not_modified(etag, last_modified):
+            return
+        self.send_response(HTTPStatus.OK)
+        self.send_header("Content-Type", CONTENT_TYPES.get(os.path.splitext(file_spec)[1].lower(),
+                                                           "application/octet-stream"))
+        self.send_header("Content-Length", str(stat.st_size))
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", last_modified)
+        # Let the browser keep the file but check back with the validators
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        with open(file_spec, "rb") as f:
+            while True:
+                chunk = f.read(BLOB_CHUNK_SIZE)
+                if not chunk:
+                    break
+                self.wfile.write(chunk)
+
+    def send_thumbnail(self, name: str) -> None:
+        # Only plain file names in the thumbnail folder
+        if name != os.path.basename(name) or name.startswith("."):
+            self.send_error(HTTPStatus.NOT_FOUND)
+            return
+        self.send_file(os.path.join(self.app.thumbnail_folder, name))
+
+    def send_photo(self, name: str) -> None:
+        app = self.app
+        image_spec = app.image_specs.get(name)
+        if image_spec is None:
+            self.send_error(HTTPStatus.NOT_FOUND)
+            return
+        if os.path.exists(image_spec) or name not in app.image_blobs:
+            self.send_file(image_spec)
+            return
+        # Originals that were never extracted are streamed from the database
+        stat = os.stat(app.dbfile)
+        etag = f"\"blob-{app.image_blobs[name]}-{stat.st_mtime_ns:x}\""
+        last_modified = email.utils.formatdate(stat.st_mtime, usegmt=True)
+        if self.not_modified(etag, last_modified):
+            return
+        blob = open_blob(connection_for(app.pool), app.image_blobs[name])
+        if blob is None:
+            self.send_error(HTTPStatus.NOT_FOUND)
+            return
+        with blob:
+            blob.seek(0, os.SEEK_END)
+            size = blob.tell()
+            blob.seek(0)
+            self.send_response(HTTPStatus.OK)
+            self.send_header("Content-Type", CONTENT_TYPES.get(os.path.splitext(name)[1].lower(),
+                                                               "application/octet-stream"))
+            self.send_header("Content-Length", str(size))
+            self.send_header("ETag", etag)
+            self.send_header("Last-Modified", last_modified)
+            self.send_header("Cache-Control", "no-cache")
+            self.end_headers()
+            while True:
+                chunk = blob.read(BLOB_CHUNK_SIZE)
+                if not chunk:
+                    break
+                self.wfile.write(chunk)
+
+
+def make_server(app: ReviewApp, host: str = "127.0.0.1", port: int = 8000) -> ThreadingHTTPServer:
+    """Return a server for the app; port 0 picks a free port."""
+    server = ThreadingHTTPServer((host, port), ReviewHandler)
+    server.daemon_threads = True
+    server.app = app
+    return server
+
+
+def serve(dbfile: str, image_folder: str, host: str = "127.0.0.1", port: int = 8000,
+          open_browser: bool = True, **options: Any) -> None:
+    """Serve a GPAP file until interrupted; options are passed on to ReviewApp."""
+    app = ReviewApp(dbfile, image_folder, **options)
+    server = make_server(app, host, port)
+    url = f"http://{host}:{server.server_address[1]}/"
+    print(f"Reviewing {dbfile} at {url}")
+    if open_browser:
+        webbrowser.open(url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        app.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Review a GPAP file in the browser.")
+    parser.add_argument("dbfile", help="the .gpap file")
+    parser.add_argument("image_folder", help="folder with the photos, and for the thumbnails")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--page-size", type=int, default=PAGE_SIZE)
+    parser.add_argument("--photo-size", type=int, default=400)
+    parser.add_argument("--blobs", action="store_true", help="read the photos from the database")
+    parser.add_argument("--no-browser", action="store_true")
+    args = parser.parse_args()
+    serve(args.dbfile, args.image_folder, port=args.port, open_browser=not args.no_browser,
+          page_size=args.page_size, photo_size=args.photo_size,
+          image_source="blobs" if args.blobs else "folder")
+    sys.exit(0)
@@ -1,26 +1,108 @@
 import sqlite3
 import os
 import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 
 # Add the parent directory to the Python path
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from config import DEFAULT_CONFIG
+from connection_pool import ConnectionPool
+from image_blobs import BLOB_CHUNK_SIZE, open_readonly, write_blob
 
 def get_image_ids(dbfile):
+    return list(iter_image_records(dbfile))
+
+def iter_image_records(dbfile):
+    """
+    Yield (_id, text, imagedata_id) for every image that has image data,
+    ordered by imagedata_id so the blobs are read in storage order.
+    """
     db = sqlite3.connect(dbfile)
     cursor = db.cursor()
-    cursor.execute("SELECT _id, text, imagedata_id FROM images")
-    rows = cursor.fetchall()
-    cursor.close()
-    db.close()
-    return rows
+    try:
+        cursor.execute("SELECT images._id, images.text, images.imagedata_id FROM images "
+                       "JOIN imagedata ON imagedata._id = images.imagedata_id "
+                       "ORDER BY images.imagedata_id")
+        for row in cursor:
+            yield row
+    finally:
+        cursor.close()
+        db.close()
+
+def copy_blob(db, imagedata_id, output_file_path, chunk_size=BLOB_CHUNK_SIZE):
+    """
+    Copy one imagedata blob to a file, a chunk at a time where the
+    sqlite3 module supports incremental blob I/O.
+
+    Returns False if there is no image data with that id.
+    """
+    return write_blob(db, imagedata_id, output_file_path, chunk_size)
+
+def extract_images(dbfile, image_records, image_folder, skip_existing=True, workers=4):
+    """
+    Write the image blobs for the given records to image_folder.
+
+    Args:
+        dbfile: Path to the database file
+        image_records: Iterable of (_id, text, imagedata_id) tuples
+        image_folder: Folder the images are written to
+        skip_existing: Leave images that are already in the folder alone
+        workers: Number of threads writing images at the same time
+
+    Returns:
+        The number of images written
+    """
+    os.makedirs(image_folder, exist_ok=True)
+    # List the folder once rather than checking every file
+    existing = set(os.listdir(image_folder)) if skip_existing else set()
+
+    # Each worker thread reads through its own read-only connection
+    pool = ConnectionPool(lambda: open_readonly(dbfile))
+    saved_lock = threading.Lock()
+
+    def save(img_name, imagedata_id):
+        output_file_path = os.path.join(image_folder, img_name)
+        try:
+            db = pool.get()
+            if copy_blob(db, imagedata_id, output_file_path):
+                return True
+            print(f"Image data for {img_name} (ID: {imagedata_id}) not found")
+        except Exception as e:
+            print(f"Error saving {output_file_path}: {str(e)}")
+        return False
+
+    # Bound the queued writes so a large database isn't read ahead into memory
+    pending = threading.BoundedSemaphore(workers * 2)
+    saved = [0]
+
+    def done(future):
+        # The slot is given back even if the write failed, or later submits would block forever
+        try:
+            if future.result():
+                with saved_lock:
+                    saved[0] += 1
+        finally:
+            pending.release()
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for img_record in image_records:
+                img_name = img_record[1]
+                if img_name in existing:
+                    continue
+                pending.acquire()
+                executor.submit(save, img_name, img_record[2]).add_done_callback(done)
+    finally:
+        pool.close()
+    return saved[0]
 
 def save_specific_images(dbfile, image_ids):
     """
     Save specific images by their IDs without loading all images.
-    
+
     Args:
         dbfile: Path to the database file
         image_ids: List of image IDs to save
@@ -28,40 +110,10 @@ def save_specific_images(dbfile, image_ids):
     if not image_ids:
         print("No image IDs provided")
         return
-        
-    db = sqlite3.connect(dbfile)
-    cursor = db.cursor()
-                    
-    image_folder = DEFAULT_CONFIG["image_folder"].replace('\\', '/').replace('//', '/')
-    
-    try:
-        # Process each image ID individually to minimize memory usage
-        for img_record in image_ids:
-            # Each img_record is a tuple with (_id, text, imagedata_id)
-            img_name = img_record[1]
-            imagedata_id = img_record[2]
-            
-            # Query just one image at a time
-            cursor.execute("SELECT _id, data FROM imagedata WHERE _id = ?", (imagedata_id,))
-            row = cursor.fetchone()
-            
-            if row:
-                # Create a filename using the image name from the images table
-                output_file_path = os.path.join(image_folder, f"{img_name}")
-                
-                if not os.path.exists(output_file_path):
-                    with open(output_file_path, "wb") as f:
-                        f.write(row[1])  # row[1] contains the image blob data
-                    print(f"Saved {output_file_path}")# Normalize path separators in config paths
-                else:
-                    print(f"{output_file_path} already exists")
-            else:
-                print(f"Image data for {img_name} (ID: {imagedata_id}) not found")
 
-    finally:
-        cursor.close()
-        db.close()
+    image_folder = DEFAULT_CONFIG["image_folder"].replace('\\', '/').replace('//', '/')
+    saved = extract_images(dbfile, image_ids, image_folder)
+    print(f"Saved {saved} images to {image_folder}")
 
 if __name__ == "__main__":
-    image_ids = get_image_ids(DEFAULT_CONFIG["dbfile"])
-    save_specific_images(DEFAULT_CONFIG["dbfile"], image_ids)         
\ No newline at end of file
+    save_specific_images(DEFAULT_CONFIG["dbfile"], iter_image_records(DEFAULT_CONFIG["dbfile"]))
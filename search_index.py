@@ -0,0 +1,197 @@
+"""
+search_index.py
+===============
+
+Full-text search over the form values of the notes. An SQLite FTS5 index is
+kept in a small file next to the database for searching from Python, and
+updated incrementally: only notes whose section or forms changed since the
+last update are indexed again. For the HTML report, SearchScriptSink writes
+a compact inverted index as a script next to the report, which the search
+box in the report looks words up in.
+"""
+import re
+import html
+import json
+import hashlib
+import sqlite3
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from form_json import load_controls
+
+SEARCH_INDEX_SUFFIX = ".search.sqlite"
+
+SEARCH_SCRIPT_SUFFIX = ".search.js"
+
+# Words are runs of letters and digits, the same in Python and in the report's script
+WORD_PATTERN = re.compile(r"[^\W_]+")
+
+SEARCH_LIMIT = 50
+
+
+def note_text(section: Optional[str], forms: Optional[str]) -> Tuple[str, str, str, str]:
+    """Return the section, form names, keys and values of a note as four blocks of text."""
+    try:
+        controls = [control for control in load_controls(forms) if control.key is not None]
+    except (ValueError, KeyError, TypeError):
+        controls = []
+    form_names = dict.fromkeys(control.form for control in controls)
+    return (section or "",
+            "\n".join(str(name) for name in form_names),
+            "\n".join(str(control.key) for control in controls),
+            "\n".join(str(control.value) for control in controls if control.value is not None))
+
+
+def note_digest(section: Optional[str], forms: Optional[str]) -> str:
+    return hashlib.sha1(repr((section, forms)).encode("utf-8")).hexdigest()
+
+
+def open_search_index(index_spec: str) -> sqlite3.Connection:
+    index = sqlite3.connect(index_spec)
+    index.execute("CREATE TABLE IF NOT EXISTS source (stamp TEXT)")
+    index.execute("CREATE TABLE IF NOT EXISTS indexed (note_id INTEGER PRIMARY KEY, digest TEXT)")
+    index.execute("CREATE VIRTUAL TABLE IF NOT EXISTS note_text USING fts5("
+                  "section, forms, keys, vals, tokenize = 'unicode61 remove_diacritics 2')")
+    return index
+
+
+def update_search_index(index: sqlite3.Connection,
+                        source_stamp: str,
+                        load_notes: Callable[[], Iterable[Tuple[int, Optional[str], Optional[str]]]]) -> int:
+    """Bring the index up to date with the notes; returns the number of notes indexed again.
+
+    source_stamp identifies the state of the database, and nothing is read
+    if it hasn't changed. Otherwise load_notes gives the (id, section,
+    forms) of every note; notes are indexed again only if those changed.
+    """
+    row = index.execute("SELECT stamp FROM source").fetchone()
+    if row is not None and row[0] == source_stamp:
+        return 0
+    digests = dict(index.execute("SELECT note_id, digest FROM indexed"))
+    changed = 0
+    with index:
+        for note_id, section, forms in load_notes():
+            digest = note_digest(section, forms)
+            if digests.pop(note_id, None) == digest:
+                continue
+            index.execute("DELETE FROM note_text WHERE rowid = ?", (note_id,))
+            index.execute("INSERT INTO note_text (rowid, section, forms, keys, vals) VALUES (?, ?, ?, ?, ?)",
+                          (note_id, *note_text(section, forms)))
+            index.execute("INSERT OR REPLACE INTO indexed (note_id, digest) VALUES (?, ?)", (note_id, digest))
+            changed += 1
+        # Notes that were deleted from the database
+        for note_id in digests:
+            index.execute("DELETE FROM note_text WHERE rowid = ?", (note_id,))
+            index.execute("DELETE FROM indexed WHERE note_id = ?", (note_id,))
+        index.execute("DELETE FROM source")
+        index.execute("INSERT INTO source (stamp) VALUES (?)", (source_stamp,))
+    return changed
+
+
+def to_fts_query(text: str) -> str:
+    """Turn what a reviewer types into an FTS5 query: every word must match, the last as a prefix."""
+    words = WORD_PATTERN.findall(text)
+    if not words:
+        return ""
+    terms = [f"\"{word}\"" for word in words]
+    terms[-1] += "*"
+    return " ".join(terms)
+
+
+def search(index: sqlite3.Connection, text: str, limit: int = SEARCH_LIMIT,
+           raw: bool = False) -> List[Tuple[int, str]]:
+    """Return the (note id, snippet) of the best matching notes, best first.
+
+    With raw the text is passed to FTS5 as it is, so column filters such as
+    "keys: species" and operators like OR and NEAR can be used.
+    """
+    query = text if raw else to_fts_query(text)
+    if not query:
+        return []
+    return index.execute(
+        "SELECT rowid, snippet(note_text, -1, '[', ']', '...', 12) FROM note_text "
+        "WHERE note_text MATCH ? ORDER BY rank LIMIT ?", (query, limit)).fetchall()
+
+
+def index_words(text: str) -> List[str]:
+    return WORD_PATTERN.findall(text.lower())
+
+
+class SearchScriptSink:
+    """Collect the words of each note and write them as a script the report can search.
+
+    The script sets SEARCH_INDEX to {"terms": {word: [note ids]}, "notes":
+    {note id: [label, link]}}. links maps note ids to where the report shows
+    them; it may be filled in while the report is written, and notes not in
+    it link to #note-<id> on the same page.
+    """
+
+    def __init__(self, script_spec: str, links: Optional[Dict[int, str]] = None):
+        self.script_spec = script_spec
+        self.links = links
+        self._terms: Dict[str, List[int]] = {}
+        self._labels: Dict[int, str] = {}
+
+    def add(self, note: Any) -> None:
+        for word in set(index_words(" ".join(note_text(note.section, note.forms)))):
+            self._terms.setdefault(word, []).append(note.id)
+        self._labels[note.id] = f"{note.id} - {note.section or 'Unknown'}"
+
+    def close(self) -> None:
+        notes = {}
+        for note_id, label in self._labels.items():
+            link = f"#note-{note_id}"
+            if self.links is not None and note_id in self.links:
+                link = self.links[note_id]
+            notes[note_id] = [label, link]
+        data = json.dumps({"terms": self._terms, "notes": notes}, ensure_ascii=False, separators=(",", ":"))
+        with open(self.script_spec, "w", encoding="utf-8") as f:
+            f.write("var SEARCH_INDEX = ")
+            f.write(data)
+            f.write(";\n")
+
+
+# The search box of the report; the script is loaded with a script tag because
+# browsers don't let a page opened from disk fetch files next to it
+SEARCH_BOX = """<p><input id="note-search" type="search" placeholder="Search notes" size="40"></p>
+<ul id="note-search-results"></ul>
+<script src="{script}"></script>
+<script>
+(function () {{
+  var input = document.getElementById("note-search");
+  var results = document.getElementById("note-search-results");
+  var terms = Object.keys(SEARCH_INDEX.terms);
+  function lookup(word, prefix) {{
+    var ids = new Set(SEARCH_INDEX.terms[word] || []);
+    if (prefix) {{
+      terms.forEach(function (term) {{
+        if (term.startsWith(word)) {{ SEARCH_INDEX.terms[term].forEach(function (id) {{ ids.add(id); }}); }}
+      }});
+    }}
+    return ids;
+  }}
+  input.addEventListener("input", function () {{
+    var words = input.value.toLowerCase().match(/[\\p{{L}}\\p{{N}}]+/gu) || [];
+    results.textContent = "";
+    if (!words.length) {{ return; }}
+    var found = null;
+    words.forEach(function (word, i) {{
+      var ids = lookup(word, i === words.length - 1);
+      found = found === null ? ids : new Set(Array.from(found).filter(function (id) {{ return ids.has(id); }}));
+    }});
+    Array.from(found).sort(function (a, b) {{ return a - b; }}).slice(0, {limit}).forEach(function (id) {{
+      var note = SEARCH_INDEX.notes[id];
+      var item = document.createElement("li");
+      var link = document.createElement("a");
+      link.href = note[1];
+      link.textContent = note[0];
+      item.appendChild(link);
+      results.appendChild(item);
+    }});
+  }});
+}})();
+</script>
+"""
+
+
+def search_box(script_name: str, limit: int = SEARCH_LIMIT) -> str:
+    return SEARCH_BOX.format(script=html.escape(script_name), limit=limit)
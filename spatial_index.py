@@ -0,0 +1,165 @@
+"""
+spatial_index.py
+================
+
+Keeps an SQLite R*Tree of the note positions in a small file next to the
+database, so that notes can be found by bounding box, radius, polygon or
+distance without reading every row of the notes table. The index is built
+once and rebuilt only when the database file changes.
+
+Positions are (longitude, latitude) in degrees and distances are in metres.
+Searches don't wrap around the antimeridian.
+"""
+import math
+import sqlite3
+from typing import Callable, Iterable, List, Optional, Sequence, Tuple
+
+SPATIAL_INDEX_SUFFIX = ".spatial.sqlite"
+
+EARTH_RADIUS_M = 6371008.8
+
+# Metres per degree of latitude, and of longitude at the equator
+METRES_PER_DEGREE = math.pi * EARTH_RADIUS_M / 180
+
+# Half-width in degrees of the first window searched for the nearest notes
+NEAREST_START_DEGREES = 0.001
+
+
+def open_spatial_index(index_spec: str,
+                       source_stamp: str,
+                       load_points: Callable[[], Iterable[Tuple[int, float, float]]]) -> sqlite3.Connection:
+    """Open the index, rebuilding it if it was built from a different version of the notes.
+
+    source_stamp identifies the state of the database (e.g. its size and
+    mtime) and load_points returns the (id, lon, lat) of every located note.
+    """
+    index = sqlite3.connect(index_spec)
+    columns = [row[1] for row in index.execute("PRAGMA table_info(source)")]
+    if columns and "min_lon" not in columns:
+        # Written before the extent was kept; dropping it makes the index be rebuilt
+        index.execute("DROP TABLE source")
+    index.execute("CREATE TABLE IF NOT EXISTS source ("
+                  "stamp TEXT, min_lon REAL, min_lat REAL, max_lon REAL, max_lat REAL)")
+    row = index.execute("SELECT stamp FROM source").fetchone()
+    if row is None or row[0] != source_stamp:
+        extent = build_spatial_index(index, load_points())
+        with index:
+            index.execute("DELETE FROM source")
+            index.execute("INSERT INTO source (stamp, min_lon, min_lat, max_lon, max_lat) VALUES (?, ?, ?, ?, ?)",
+                          (source_stamp, *extent))
+    return index
+
+
+def build_spatial_index(index: sqlite3.Connection,
+                        points: Iterable[Tuple[int, float, float]]) -> Tuple[Optional[float], ...]:
+    """Fill the index with the points; returns their extent (min_lon, min_lat, max_lon, max_lat)."""
+    with index:
+        index.execute("DROP TABLE IF EXISTS note_rtree")
+        # The R*Tree boxes are 32-bit floats, so the exact position is kept alongside
+        try:
+            index.execute("CREATE VIRTUAL TABLE note_rtree USING rtree("
+                          "id, min_lon, max_lon, min_lat, max_lat, +lon, +lat)")
+        except sqlite3.OperationalError:
+            # SQLite built without R*Tree; a table indexed on longitude answers the same queries
+            index.execute("CREATE TABLE note_rtree (id INTEGER PRIMARY KEY, "
+                          "min_lon REAL, max_lon REAL, min_lat REAL, max_lat REAL, lon REAL, lat REAL)")
+            index.execute("CREATE INDEX note_rtree_lon ON note_rtree (min_lon, min_lat)")
+        index.executemany(
+            "INSERT INTO note_rtree (id, min_lon, max_lon, min_lat, max_lat, lon, lat) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            ((note_id, lon, lon, lat, lat, lon, lat) for note_id, lon, lat in points
+             if lon is not None and lat is not None))
+    # Read once here so that searches don't have to scan every point for it
+    return index.execute("SELECT MIN(lon), MIN(lat), MAX(lon), MAX(lat) FROM note_rtree").fetchone()
+
+
+def points_in_bbox(index: sqlite3.Connection,
+                   bbox: Tuple[float, float, float, float]) -> List[Tuple[int, float, float]]:
+    """Return the (id, lon, lat) of the notes in (min_lon, min_lat, max_lon, max_lat), inclusive."""
+    min_lon, min_lat, max_lon, max_lat = bbox
+    # The boxes overlapping the search pick the candidates, their exact positions decide
+    return index.execute(
+        "SELECT id, lon, lat FROM note_rtree "
+        "WHERE max_lon >= ? AND min_lon <= ? AND max_lat >= ? AND min_lat <= ? "
+        "AND lon BETWEEN ? AND ? AND lat BETWEEN ? AND ? ORDER BY id",
+        (min_lon, max_lon, min_lat, max_lat, min_lon, max_lon, min_lat, max_lat)).fetchall()
+
+
+def ids_in_bbox(index: sqlite3.Connection, bbox: Tuple[float, float, float, float]) -> List[int]:
+    return [note_id for note_id, _, _ in points_in_bbox(index, bbox)]
+
+
+def distance_m(lon1: float, lat1: float, lon2: float, lat2: float) -> float:
+    """Great-circle distance between two positions."""
+    phi1 = math.radians(lat1)
+    phi2 = math.radians(lat2)
+    a = (math.sin((phi2 - phi1) / 2) ** 2
+         + math.cos(phi1) * math.cos(phi2) * math.sin(math.radians(lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_M * math.asin(min(1.0, math.sqrt(a)))
+
+
+def radius_bbox(lon: float, lat: float, radius_m: float) -> Tuple[float, float, float, float]:
+    """The bounding box of a circle, widened in longitude for the latitude."""
+    lat_delta = radius_m / METRES_PER_DEGREE
+    cos_lat = math.cos(math.radians(min(89.9, abs(lat) + lat_delta)))
+    lon_delta = radius_m / (METRES_PER_DEGREE * cos_lat)
+    if lon_delta >= 180:
+        return -180.0, lat - lat_delta, 180.0, lat + lat_delta
+    return lon - lon_delta, lat - lat_delta, lon + lon_delta, lat + lat_delta
+
+
+def ids_within_radius(index: sqlite3.Connection, lon: float, lat: float, radius_m: float) -> List[int]:
+    """Return the notes within radius_m of a position, checking only those in its bounding box."""
+    return [note_id for note_id, note_lon, note_lat in points_in_bbox(index, radius_bbox(lon, lat, radius_m))
+            if distance_m(lon, lat, note_lon, note_lat) <= radius_m]
+
+
+def point_in_polygon(lon: float, lat: float, polygon: Sequence[Tuple[float, float]]) -> bool:
+    """Ray casting test; the polygon is a list of (lon, lat) vertices, closed or not."""
+    inside = False
+    previous_lon, previous_lat = polygon[-1]
+    for vertex_lon, vertex_lat in polygon:
+        if (vertex_lat > lat) != (previous_lat > lat):
+            crossing = vertex_lon + (lat - vertex_lat) * (previous_lon - vertex_lon) / (previous_lat - vertex_lat)
+            if lon < crossing:
+                inside = not inside
+        previous_lon, previous_lat = vertex_lon, vertex_lat
+    return inside
+
+
+def ids_in_polygon(index: sqlite3.Connection, polygon: Sequence[Tuple[float, float]]) -> List[int]:
+    """Return the notes inside a polygon, checking only those in its bounding box."""
+    if len(polygon) < 3:
+        raise ValueError("A polygon needs at least three vertices")
+    lons = [vertex[0] for vertex in polygon]
+    lats = [vertex[1] for vertex in polygon]
+    bbox = (min(lons), min(lats), max(lons), max(lats))
+    return [note_id for note_id, note_lon, note_lat in points_in_bbox(index, bbox)
+            if point_in_polygon(note_lon, note_lat, polygon)]
+
+
+def nearest_notes(index: sqlite3.Connection, lon: float, lat: float,
+                  count: int = 1) -> List[Tuple[int, float]]:
+    """Return the (id, distance) of the count notes closest to a position, closest first.
+
+    The search window doubles until it holds count notes, then the circle
+    reaching the furthest of them is searched, so only nearby notes are read.
+    """
+    extent = index.execute("SELECT min_lon, min_lat, max_lon, max_lat FROM source").fetchone()
+    if extent is None or extent[0] is None or count <= 0:
+        return []
+    half_width = NEAREST_START_DEGREES
+    while True:
+        bbox = (lon - half_width, lat - half_width, lon + half_width, lat + half_width)
+        points = points_in_bbox(index, bbox)
+        covers_all = (bbox[0] <= extent[0] and bbox[1] <= extent[1]
+                      and bbox[2] >= extent[2] and bbox[3] >= extent[3])
+        if len(points) >= count or covers_all:
+            break
+        half_width *= 2
+    found = sorted(distance_m(lon, lat, note_lon, note_lat) for _, note_lon, note_lat in points)
+    if len(found) >= count:
+        # A closer note may lie outside the square window but inside this circle
+        points = points_in_bbox(index, radius_bbox(lon, lat, found[count - 1]))
+    nearest = sorted((distance_m(lon, lat, note_lon, note_lat), note_id) for note_id, note_lon, note_lat in points)
+    return [(note_id, distance) for distance, note_id in nearest[:count]]
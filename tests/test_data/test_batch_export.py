@@ -0,0 +1,78 @@
+# test_batch_export.py
+import os
+import sys
+import sqlite3
+import tempfile
+import shutil
+import pytest
+
+# Add the project root directory to the Python path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../..')))
+import batch_export
+
+
+def make_database(db_path, section):
+    conn = sqlite3.connect(db_path)
+    conn.execute('''
+        CREATE TABLE notes (
+            _id INTEGER PRIMARY KEY, title TEXT, content TEXT, created INTEGER, modified INTEGER,
+            color INTEGER, section TEXT, forms TEXT, lat REAL, lon REAL
+        )
+    ''')
+    conn.execute("CREATE TABLE images (_id INTEGER PRIMARY KEY, text TEXT)")
+    conn.execute("INSERT INTO notes (_id, modified, section, forms, lat, lon) VALUES (1, 1633046400000, ?, "
+                 "'{\"forms\":[{\"formname\":\"Plot\",\"formitems\":[{\"key\":\"Crew\",\"value\":\"A\",\"type\":\"text\"}]}]}', "
+                 "-33.1, 151.1)", (section,))
+    conn.commit()
+    conn.close()
+
+
+@pytest.fixture
+def survey_folder():
+    temp_dir = tempfile.mkdtemp()
+    make_database(os.path.join(temp_dir, "crew_a.gpap"), "Crew A")
+    make_database(os.path.join(temp_dir, "crew_b.gpap"), "Crew B")
+    # Not a database, so this one has to fail without stopping the others
+    with open(os.path.join(temp_dir, "broken.gpap"), "w") as f:
+        f.write("not a database")
+    yield temp_dir
+    shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+def test_find_databases(survey_folder):
+    names = [os.path.basename(path) for path in batch_export.find_databases(survey_folder)]
+    assert names == ["broken.gpap", "crew_a.gpap", "crew_b.gpap"]
+
+    pattern = os.path.join(survey_folder, "crew_*.gpap")
+    assert len(batch_export.find_databases(pattern)) == 2
+
+
+def test_export_batch(survey_folder):
+    results = batch_export.export_batch(survey_folder, workers=2)
+
+    assert [os.path.basename(result["dbfile"]) for result in results] == ["broken.gpap", "crew_a.gpap", "crew_b.gpap"]
+    assert results[0]["error"] is not None
+    assert results[1]["error"] is None and results[1]["notes"] == 1
+    assert all(result["seconds"] >= 0 for result in results)
+
+    with open(os.path.join(survey_folder, "crew_b.html"), encoding="utf-8") as f:
+        assert "<h2>1 - Crew B</h2>" in f.read()
+
+    with open(os.path.join(survey_folder, batch_export.SUMMARY_FILE_NAME), encoding="utf-8") as f:
+        summary = f.read()
+    assert "3 databases, 2 notes, 1 failed" in summary
+    assert "crew_a.html\">crew_a.gpap</a>" in summary
+
+
+def test_write_summary_escaped(survey_folder):
+    summary_spec = os.path.join(survey_folder, batch_export.SUMMARY_FILE_NAME)
+    results = [{"dbfile": "A&B.gpap", "output": os.path.join(survey_folder, "A&B #1.html"), "notes": 1,
+                "seconds": 0.5, "error": None},
+               {"dbfile": "<c>.gpap", "output": None, "notes": None, "seconds": 0.1,
+                "error": "file is not a <database>"}]
+    batch_export.write_summary(summary_spec, results)
+    with open(summary_spec, encoding="utf-8") as f:
+        summary = f.read()
+    assert "A%26B%20%231.html\">A&amp;B.gpap</a>" in summary
+    assert "&lt;c&gt;.gpap" in summary and "Failed: file is not a &lt;database&gt;" in summary
+    assert "<c>" not in summary and "<database>" not in summary
@@ -0,0 +1,55 @@
+# test_benchmarks.py
+import os
+import sys
+import json
+import sqlite3
+import tempfile
+import shutil
+import pytest
+
+# Add the project root directory to the Python path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../..')))
+from benchmarks import synthetic_gpap, run_benchmarks
+
+
+@pytest.fixture
+def temp_dir():
+    temp_dir = tempfile.mkdtemp()
+    yield temp_dir
+    shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+def test_make_synthetic_gpap(temp_dir):
+    dbfile = os.path.join(temp_dir, "synthetic.gpap")
+    synthetic_gpap.make_synthetic_gpap(dbfile, temp_dir, notes=4, forms_per_note=3, items_per_form=5,
+                                       pictures_per_note=2, image_width=64, image_height=48)
+
+    db = sqlite3.connect(dbfile)
+    assert db.execute("SELECT COUNT(*) FROM notes").fetchone()[0] == 4
+    assert db.execute("SELECT COUNT(*) FROM images").fetchone()[0] == 8
+    assert db.execute("SELECT COUNT(*) FROM imagedata").fetchone()[0] == 8
+    forms = json.loads(db.execute("SELECT forms FROM notes WHERE _id = 1").fetchone()[0])["forms"]
+    db.close()
+
+    assert len(forms) == 3
+    # The first form also carries the pictures control
+    assert len(forms[0]["formitems"]) == 6
+    assert forms[0]["formitems"][-1] == {"key": "photos", "value": "1;2", "type": "pictures"}
+    assert os.path.exists(os.path.join(temp_dir, "IMG_000008.jpg"))
+
+
+def test_run_benchmark(temp_dir):
+    results_file = os.path.join(temp_dir, "results.json")
+    run_benchmarks.run_benchmark(notes=3, pictures_per_note=1, image_width=64, image_height=48,
+                                 repeat=1, results_file=results_file)
+    run_benchmarks.run_benchmark(notes=3, pictures_per_note=1, image_width=64, image_height=48,
+                                 repeat=1, results_file=results_file)
+
+    with open(results_file, encoding="utf-8") as f:
+        entries = json.load(f)
+    # Each run is added to the file
+    assert len(entries) == 2
+    assert entries[0]["params"]["notes"] == 3
+    assert set(entries[0]["stages"]) == {"get_notes", "json_parse", "json_parse_fast", "flatten_forms",
+                                         "get_image_name", "get_image_names", "get_orientation", "render",
+                                         "write_file", "full_report"}
@@ -0,0 +1,50 @@
+# test_connection_pool.py
+import os
+import sys
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Add the project root directory to the Python path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../..')))
+from connection_pool import ConnectionPool, connection_for, shared_pool, close_shared_pools
+
+
+def test_one_connection_per_thread():
+    pool = ConnectionPool(lambda: sqlite3.connect(":memory:", check_same_thread=False))
+    main_db = pool.get()
+    assert pool.get() is main_db
+
+    barrier = threading.Barrier(3)
+
+    def worker(_):
+        db = pool.get()
+        # Each thread can use its connection, and gets the same one each time
+        db.execute("SELECT 1").fetchone()
+        barrier.wait()
+        return db is pool.get() and db is not main_db
+
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        assert all(executor.map(worker, range(3)))
+    assert len(pool) == 4
+
+    # Connections opened by other threads are closed too
+    pool.close()
+    assert len(pool) == 0
+    assert pool.get() is not main_db
+    pool.close()
+
+
+def test_connection_for():
+    db = sqlite3.connect(":memory:")
+    assert connection_for(db) is db
+    with ConnectionPool(lambda: db) as pool:
+        assert connection_for(pool) is db
+
+
+def test_shared_pool():
+    pool = shared_pool("test", lambda: sqlite3.connect(":memory:", check_same_thread=False))
+    assert shared_pool("test", lambda: None) is pool
+    close_shared_pools()
+    assert shared_pool("test", lambda: None) is not pool
+    close_shared_pools()
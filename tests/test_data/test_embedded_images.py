@@ -0,0 +1,74 @@
+# test_embedded_images.py
+import os
+import sys
+import base64
+import shutil
+import tempfile
+import pytest
+from PIL import Image
+
+# Add the project root directory to the Python path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../..')))
+from embedded_images import EmbeddedImages
+
+
+@pytest.fixture
+def temp_dir():
+    temp_dir = tempfile.mkdtemp()
+    yield temp_dir
+    shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+def test_data_uri(temp_dir):
+    red = os.path.join(temp_dir, "red.jpg")
+    copy = os.path.join(temp_dir, "copy.jpg")
+    blue = os.path.join(temp_dir, "blue.webp")
+    Image.new('RGB', (20, 10), color='red').save(red)
+    shutil.copyfile(red, copy)
+    Image.new('RGB', (20, 10), color='blue').save(blue)
+
+    embedded = EmbeddedImages(budget=None)
+    uri = embedded.data_uri(red)
+    with open(red, "rb") as f:
+        assert uri == "data:image/jpeg;base64," + base64.b64encode(f.read()).decode("ascii")
+    blue_uri = embedded.data_uri(blue)
+    assert blue_uri.startswith("data:image/webp;base64,")
+
+    # A copy of a photo shares the encoded copy, but each use is counted
+    assert embedded.data_uri(copy) is uri
+    assert embedded.embedded == 3
+    assert embedded.unique_images() == 2
+    assert embedded.used == 2 * len(uri) + len(blue_uri)
+
+    assert embedded.data_uri(os.path.join(temp_dir, "missing.jpg")) is None
+    assert embedded.data_uri(os.path.join(temp_dir, "notes.txt")) is None
+
+
+def test_budget(temp_dir):
+    red = os.path.join(temp_dir, "red.jpg")
+    Image.new('RGB', (20, 10), color='red').save(red)
+
+    embedded = EmbeddedImages(budget=None)
+    size = len(embedded.data_uri(red))
+
+    # Photos past the budget are left out
+    embedded = EmbeddedImages(budget=size * 2 + 1)
+    assert embedded.data_uri(red) is not None
+    assert embedded.data_uri(red) is not None
+    assert embedded.data_uri(red) is None
+    assert embedded.used == size * 2
+    assert embedded.skipped == 1
+    assert "1 over the budget" in embedded.summary()
+
+
+def test_budget_not_read(temp_dir):
+    specs = []
+    for i in range(5):
+        specs.append(os.path.join(temp_dir, f"photo{i}.jpg"))
+        Image.new('RGB', (20, 10), color=(i * 50, 0, 0)).save(specs[-1])
+
+    # Photos over the budget are neither read nor kept
+    embedded = EmbeddedImages(budget=1)
+    assert [embedded.data_uri(spec) for spec in specs] == [None] * 5
+    assert embedded.skipped == 5 and embedded.used == 0
+    assert not embedded._uris and not embedded._hashes
@@ -6,12 +6,16 @@ import tempfile
 import shutil
 import pytest
 import sys
+import pstats
+import datetime
 from unittest.mock import patch, MagicMock, mock_open
 from PIL import Image
 
 # Add the project root directory to the Python path
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../..')))
 import ExportInspections_gpap as exp
+import profiling
+import connection_pool
 
 
 @pytest.fixture
@@ -125,6 +129,27 @@ def test_open_db(test_setup):
     db.close()
 
 
+def test_open_db_options(test_setup):
+    # A read-only connection can't change the field data
+    db = exp.open_db(test_setup['db_path'], read_only=True, mmap_size=1 << 20, cache_size=-4096)
+    assert db.execute("PRAGMA cache_size").fetchone()[0] == -4096
+    with pytest.raises(sqlite3.OperationalError):
+        db.execute("DELETE FROM notes")
+    assert len(exp.get_notes(db)) == 1
+    db.close()
+    
+    db = exp.open_db(test_setup['db_path'], immutable=True)
+    assert len(exp.get_notes(db)) == 1
+    db.close()
+    
+    # The in-memory copy doesn't touch the file
+    db = exp.open_db(test_setup['db_path'], copy_to_memory=True)
+    db.execute("DELETE FROM notes")
+    assert exp.get_notes(db) == []
+    db.close()
+    assert test_setup['conn'].execute("SELECT COUNT(*) FROM notes").fetchone()[0] == 1
+
+
 def test_get_notes(test_setup):
     db = exp.open_db(test_setup['db_path'])
     rows = exp.get_notes(db)
@@ -137,6 +162,63 @@ def test_get_notes(test_setup):
     db.close()
 
 
+def test_get_notes_filters(test_setup):
+    conn = test_setup['conn']
+    day = 24 * 60 * 60 * 1000
+    conn.executemany("INSERT INTO notes (_id, modified, section, lat, lon) VALUES (?, ?, ?, ?, ?)",
+                     [(2, 1633046400000 + day, 'Other Section', -34.0, 150.0),
+                      (3, 1633046400000 + 2 * day, 'Test Section', -35.0, 149.0)])
+    conn.commit()
+    db = exp.open_db(test_setup['db_path'])
+    
+    # The iterator mode gives the same rows, a batch at a time
+    rows = exp.get_notes(db, iterator=True, batch_size=2)
+    assert not isinstance(rows, list)
+    assert list(rows) == exp.get_notes(db)
+    
+    def ids(**filters):
+        return [row[0] for row in exp.get_notes(db, **filters)]
+    
+    assert ids(start=1633046400000 + day) == [2, 3]
+    assert ids(start=1633046400000, end=1633046400000 + day) == [1]
+    first_day = datetime.datetime.fromtimestamp(1633046400000 / 1e3).date()
+    assert ids(start=first_day, end=first_day + datetime.timedelta(days=1)) == [1]
+    assert ids(section='Test Section') == [1, 3]
+    assert ids(bbox=(149.5, -34.5, 152.0, -33.0)) == [1, 2]
+    assert ids(id_range=(2, 3)) == [2, 3]
+    assert ids(section='Test Section', id_range=(2, 3)) == [3]
+    
+    # The same filters select compact notes
+    assert [note.id for note in exp.iter_notes(db, batch_size=1, section='Other Section')] == [2]
+    
+    db.close()
+
+
+def test_iter_notes_spatial(test_setup):
+    conn = test_setup['conn']
+    conn.executemany("INSERT INTO notes (_id, section, lat, lon) VALUES (?, ?, ?, ?)",
+                     [(2, 'Other Section', -33.2, 151.2), (3, 'Test Section', -34.0, 150.0), 
+                      (4, 'Test Section', None, None)])
+    conn.commit()
+    db = exp.open_db(test_setup['db_path'], read_only=True)
+    
+    def ids(**filters):
+        return [note.id for note in exp.iter_notes(db, **filters)]
+    
+    assert ids(bbox=(151.0, -33.5, 152.0, -33.0)) == [1, 2]
+    assert ids(radius=(151.123456, -33.123456, 15000)) == [1, 2]
+    assert ids(radius=(151.123456, -33.123456, 1000)) == [1]
+    assert ids(polygon=[(149.0, -35.0), (151.0, -33.0), (151.0, -35.0)]) == [3]
+    assert ids(nearest=(150.1, -34.1, 2)) == [2, 3]
+    # Spatial filters combine with each other and with the others
+    assert ids(nearest=(150.1, -34.1, 2), section='Test Section') == [3]
+    assert ids(radius=(151.123456, -33.123456, 15000), nearest=(150.1, -34.1, 2)) == [2]
+    
+    # The index is kept next to the database
+    assert os.path.exists(test_setup['db_path'] + exp.SPATIAL_INDEX_SUFFIX)
+    db.close()
+
+
 def test_get_latitude_index(test_setup):
     db = exp.open_db(test_setup['db_path'])
     lat_index = exp.get_latitude_index(db)
@@ -157,6 +239,38 @@ def test_get_longitude_index(test_setup):
     db.close()
 
 
+def test_get_note_schema(test_setup):
+    db = exp.open_db(test_setup['db_path'])
+    assert exp.get_note_schema(db) == {"id": "_id", "timestamp": "modified", "section": "section", 
+                                       "forms": "forms", "lat": "lat", "lon": "lon"}
+    db.close()
+    
+    # Smash's own column names are found by name wherever they are
+    smash_columns = ["_id", "lon", "lat", "altim", "ts", "description", "text", "form", "style", "isdirty"]
+    assert exp.get_note_schema(None, smash_columns) == {"id": "_id", "timestamp": "ts", "section": "text", 
+                                                        "forms": "form", "lat": "lat", "lon": "lon"}
+    # Columns that don't exist are selected as NULL
+    schema = exp.get_note_schema(None, ["_id", "form"])
+    assert exp.note_select_sql(schema) == 'SELECT "_id", NULL, NULL, "form", NULL, NULL FROM notes'
+
+
+def test_iter_notes(test_setup):
+    db = exp.open_db(test_setup['db_path'])
+    notes = list(exp.iter_notes(db))
+    
+    # Only the columns the report needs are read
+    assert len(notes) == 1
+    assert notes[0].id == 1
+    assert notes[0].section == 'Test Section'
+    assert notes[0].timestamp == 1633046400000
+    assert notes[0].lat == -33.123456 and notes[0].lon == 151.123456
+    
+    # A full row gives the same Note
+    assert exp.to_note(exp.get_notes(db)[0], exp.get_longitude_index(db), exp.get_latitude_index(db)) == notes[0]
+    
+    db.close()
+
+
 def test_get_image_name(test_setup):
     # Temporarily patch the DEFAULT_CONFIG to use our test database
     with patch('ExportInspections_gpap.DEFAULT_CONFIG', {'dbfile': test_setup['db_path']}):
@@ -168,6 +282,61 @@ def test_get_image_name(test_setup):
         assert image_names[1] == 'test_image2.jpg'
 
 
+def test_get_image_name_pool(test_setup):
+    # Without a connection, get_image_name reuses one connection per thread
+    with patch('ExportInspections_gpap.DEFAULT_CONFIG', {'dbfile': test_setup['db_path']}):
+        assert exp.get_image_name("1") == ['test_image1.jpg']
+        pool = exp.default_pool(test_setup['db_path'])
+        db = pool.get()
+        assert exp.get_image_name("2") == ['test_image2.jpg']
+        assert pool.get() is db and len(pool) == 1
+    
+    # A pool can be passed wherever a connection is expected
+    with exp.open_pool(test_setup['db_path'], read_only=True) as pool:
+        assert exp.get_image_name("1,2", custom_db=pool) == ['test_image1.jpg', 'test_image2.jpg']
+        assert len(exp.get_notes(pool)) == 1
+        assert [note.id for note in exp.iter_notes(pool)] == [1]
+    
+    connection_pool.close_shared_pools()
+
+
+def test_parse_image_ids():
+    assert exp.parse_image_ids("1,2") == [1, 2]
+    assert exp.parse_image_ids("3; 4;x") == [3, 4]
+    assert exp.parse_image_ids("") == []
+    assert exp.parse_image_ids(None) == []
+
+
+def test_get_image_names(test_setup):
+    db = exp.open_db(test_setup['db_path'])
+    
+    # The prepass should find the ids used by the pictures control
+    assert exp.collect_image_ids(db) == [1, 2]
+    # Only the images of the notes matching the filters
+    assert exp.collect_image_ids(db, id_range=(1, 1)) == [1, 2]
+    assert exp.get_image_names(db, section='Other Section') == {}
+    
+    # A chunk size of one forces a query per id, the result should be the same
+    assert exp.resolve_image_names(db, [1, 2], chunk_size=1) == {1: 'test_image1.jpg', 2: 'test_image2.jpg'}
+    assert exp.get_image_names(db) == {1: 'test_image1.jpg', 2: 'test_image2.jpg'}
+    
+    db.close()
+
+
+def test_lookup_image_names(test_setup):
+    # Ids found in the map are resolved without touching the database
+    with patch('ExportInspections_gpap.get_image_name') as mock_get_image_name:
+        names = exp.lookup_image_names("2,1", {1: 'a.jpg', 2: 'b.jpg'})
+        assert names == ['b.jpg', 'a.jpg']
+        mock_get_image_name.assert_not_called()
+    
+    # Ids missing from the map fall back to the per-control query
+    db = exp.open_db(test_setup['db_path'])
+    names = exp.lookup_image_names("1,2", {1: 'a.jpg'}, custom_db=db)
+    assert names == ['test_image1.jpg', 'test_image2.jpg']
+    db.close()
+
+
 def test_is_picture():
     # Test with a picture control
     picture_control = {"type": "pictures", "value": "1,2"}
@@ -231,6 +400,77 @@ def test_write_file(test_setup):
     assert content == test_content
 
 
+def test_write_chunks(test_setup):
+    # Chunks should be written in order, as a single file
+    exp.write_chunks(test_setup['output_path'], (str(i) for i in range(5)))
+    
+    with open(test_setup['output_path'], 'r') as f:
+        content = f.read()
+    
+    assert content == "01234"
+
+
+def test_iter_contents(test_setup):
+    db = exp.open_db(test_setup['db_path'])
+    
+    # Streaming the notes from the cursor should give the same report as get_contents
+    chunks = list(exp.iter_contents(exp.iter_notes(db), db, test_setup['image_folder'], 400))
+    assert "".join(chunks) == exp.get_contents(exp.get_notes(db), db, test_setup['image_folder'], 400)
+    
+    # The document header, one chunk per note and the document footer
+    assert len(chunks) == 3
+    assert chunks[0].startswith("<!DOCTYPE html>")
+    assert chunks[2] == exp.PAGE_FOOTER
+    assert "<h2>1 - Test Section</h2>" in chunks[1]
+    
+    # Controls listed before a pictures control are kept
+    assert "<em>Test Key: </em><strong> Test Value</strong>" in chunks[1]
+    
+    db.close()
+
+
+def test_iter_contents_parallel(test_setup):
+    conn = sqlite3.connect(test_setup['db_path'])
+    forms = json.dumps([{"formname": "Form", "formitems": [{"key": "Key", "value": "Value", "type": "string"}]}])
+    for note_id in range(2, 21):
+        conn.execute("INSERT INTO notes (_id, modified, section, forms, lat, lon) VALUES (?, ?, ?, ?, ?, ?)",
+                     (note_id, 1633046400000, f"Section {note_id}", forms, 1.0, 2.0))
+    conn.commit()
+    conn.close()
+    db = exp.open_db(test_setup['db_path'])
+    sequential = exp.get_contents(exp.get_notes(db), db, test_setup['image_folder'], 400)
+    
+    # Rendering on several threads or processes keeps the notes in their original order
+    for render_mode in ("thread", "process"):
+        chunks = list(exp.iter_contents(exp.iter_notes(db), db, test_setup['image_folder'], 400, 
+                                        render_workers=3, render_mode=render_mode))
+        assert "".join(chunks) == sequential
+        assert len(chunks) == 22
+    
+    with pytest.raises(ValueError):
+        list(exp.iter_contents(exp.iter_notes(db), db, test_setup['image_folder'], 400, 
+                               render_workers=2, render_mode="fibers"))
+    
+    db.close()
+
+
+def test_control_list_thumbnails(test_setup):
+    db = exp.open_db(test_setup['db_path'])
+    thumb_spec = os.path.join(test_setup['temp_dir'], "thumb1.jpg")
+    Image.new('RGB', (50, 100), color='red').save(thumb_spec)
+    thumbnails = {test_setup['test_image1']: thumb_spec}
+    
+    result = exp.control_list("Photos", [{"key": "Photo", "value": "1,2", "type": "pictures"}], 
+                              test_setup['image_folder'], 400, custom_db=db, thumbnails=thumbnails)
+    
+    # The thumbnail is displayed and links to the original
+    assert "<a href=\"file:///" + test_setup['test_image1'] + "\"><img width=\"200\" height=\"400\" src=\"file:///" + thumb_spec in result
+    # Images without a thumbnail still show the original
+    assert "src=\"file:///" + test_setup['test_image2'] in result
+    
+    db.close()
+
+
 def test_form_items(test_setup):
     # Test with valid form data
     form_data = '{"forms":[{"formname":"Test Form","formitems":[{"key":"Test Key","value":"Test Value","type":"text"}]}]}'
@@ -244,6 +484,30 @@ def test_form_items(test_setup):
     result = exp.form_items(None, test_setup['image_folder'])
     assert result == " "
 
+    # Neighbouring forms with the same name keep their own headings
+    form_data = ('{"forms":[{"formname":"A","formitems":[{"key":"One","value":"1","type":"text"}]},'
+                 '{"formname":"A","formitems":[{"key":"Two","value":"2","type":"text"}]}]}')
+    result = exp.form_items(form_data, test_setup['image_folder'])
+    assert result.count("<h3>A</h3>") == 2
+    assert result.count("</ul>") == 3
+
+
+def test_render_form():
+    controls = [exp.FormControl("Pipes & <Drains>", "Depth", 1.5, "double"),
+                exp.FormControl("Pipes & <Drains>", "Notes", "<b>cracked</b> & \"leaking\"", "string"),
+                exp.FormControl("Pipes & <Drains>", "Unanswered", "", "string"),
+                exp.FormControl("Pipes & <Drains>", "Status", "pending -", "string"),
+                exp.FormControl("Pipes & <Drains>", "", "no label", "string")]
+    result = exp.render_form("Pipes & <Drains>", controls, "/photos", 400)
+    
+    # Field data is escaped, and unanswered or unlabelled controls are left out
+    assert result == ("<h3>Pipes &amp; &lt;Drains&gt;</h3>\n<ul>\n"
+                      "\t<li><em>Depth: </em><strong> 1.5</strong></li>\n"
+                      "\t<li><em>Notes: </em><strong> &lt;b&gt;cracked&lt;/b&gt; &amp; &quot;leaking&quot;</strong></li>\n"
+                      "</ul>\n")
+    assert exp.scaled_size(100, 200, 400) == (200, 400)
+    assert exp.scaled_size(300, 150, 150) == (150, 75)
+
 
 @patch('os.startfile')
 def test_generate_inspection_report(mock_startfile, test_setup):
@@ -289,4 +553,213 @@ def test_generate_inspection_report_with_defaults(mock_startfile, mock_config, t
     assert os.path.exists(test_setup['output_path'])
     
     # Verify os.startfile was called with the correct path
-    mock_startfile.assert_called_once_with(test_setup['output_path'])
\ No newline at end of file
+    mock_startfile.assert_called_once_with(test_setup['output_path'])
+
+def test_generate_inspection_report_incremental(test_setup):
+    def generate():
+        exp.generate_inspection_report(
+            dbfile=test_setup['db_path'],
+            image_folder=test_setup['image_folder'],
+            output_file_name=test_setup['output_file'],
+            auto_open=False,
+            incremental=True
+        )
+        with open(test_setup['output_path'], 'r') as f:
+            return f.read()
+    
+    first = generate()
+    
+    # Unchanged notes come from the cache
+    with patch('ExportInspections_gpap.row_level', wraps=exp.row_level) as mock_row_level:
+        assert generate() == first
+        mock_row_level.assert_not_called()
+    
+    # Only new or edited notes are rendered again
+    conn = test_setup['conn']
+    conn.execute("UPDATE notes SET section = 'Edited Section' WHERE _id = 1")
+    conn.execute("INSERT INTO notes (_id, created, section, forms) VALUES (2, 1633046400000, 'New Section', NULL)")
+    conn.commit()
+    with patch('ExportInspections_gpap.row_level', wraps=exp.row_level) as mock_row_level:
+        content = generate()
+        assert mock_row_level.call_count == 2
+    assert "<h2>1 - Edited Section</h2>" in content
+    assert "<h2>2 - New Section</h2>" in content
+
+
+def test_generate_inspection_report_incremental_images(test_setup):
+    def generate(**options):
+        exp.generate_inspection_report(dbfile=test_setup['db_path'], image_folder=test_setup['image_folder'],
+                                       output_file_name=test_setup['output_file'], auto_open=False, workers=1,
+                                       incremental=True, **options)
+        with open(test_setup['output_path'], 'r') as f:
+            return f.read()
+
+    # A note rendered while its photo was missing is rendered again once the photo is back
+    moved_spec = test_setup['test_image1'] + ".moved"
+    os.replace(test_setup['test_image1'], moved_spec)
+    assert "thumbnails_400" not in generate().split("test_image2")[0]
+    os.replace(moved_spec, test_setup['test_image1'])
+    content = generate()
+    assert content.count("src=\"file:///" + os.path.join(test_setup['image_folder'], "thumbnails_400")) == 2
+
+    # A filtered run leaves the other notes' fragments in the cache
+    conn = test_setup['conn']
+    conn.execute("INSERT INTO notes (_id, section, forms) VALUES (2, 'Other Section', NULL)")
+    conn.commit()
+    generate()
+    generate(note_filters={"section": "Other Section"})
+    with patch('ExportInspections_gpap.row_level', wraps=exp.row_level) as mock_row_level:
+        generate()
+        mock_row_level.assert_not_called()
+
+
+def test_check_report_options():
+    options = exp.check_report_options(exp.ReportOptions(embed_thumbnails=True, incremental=True))
+    assert options.embed_thumbnails and not options.incremental
+    for bad in (dict(image_source="zip"), dict(render_mode="fibre"), 
+                dict(embed_thumbnails=True, thumbnail_format=None),
+                dict(embed_thumbnails=True, render_workers=2, render_mode="process")):
+        with pytest.raises(ValueError):
+            exp.check_report_options(exp.ReportOptions(**bad))
+
+
+def test_write_report_cleanup(test_setup):
+    # An error while writing still closes everything, and drops the exports it cut short
+    options = exp.ReportOptions(workers=1, exports=["notes.gpkg"])
+    with patch('ExportInspections_gpap.write_chunks', side_effect=RuntimeError("disk full")):
+        with pytest.raises(RuntimeError):
+            exp.write_report(test_setup['db_path'], test_setup['image_folder'], test_setup['output_path'], 
+                             400, options)
+    assert not [name for name in os.listdir(test_setup['temp_dir']) if name.startswith("notes.gpkg")]
+
+
+def test_generate_inspection_report_embedded(test_setup):
+    def generate(**options):
+        exp.generate_inspection_report(
+            dbfile=test_setup['db_path'],
+            image_folder=test_setup['image_folder'],
+            output_file_name=test_setup['output_file'],
+            auto_open=False,
+            workers=1,
+            embed_thumbnails=True,
+            **options
+        )
+        with open(test_setup['output_path'], 'r') as f:
+            return f.read()
+    
+    # The thumbnails are written into the report, lazily loaded
+    content = generate()
+    assert content.count("src=\"data:image/jpeg;base64,") == 2
+    assert content.count("loading=\"lazy\"") == 2
+    assert "file:///" not in content
+    
+    # Photos over the budget are linked instead
+    content = generate(embed_budget=0)
+    assert "data:image" not in content
+    assert "src=\"file:///" in content
+    
+    with pytest.raises(ValueError):
+        generate(thumbnail_format=None)
+
+
+def test_search_notes(test_setup):
+    conn = test_setup['conn']
+    conn.execute("INSERT INTO notes (_id, section, forms) VALUES (2, 'Poles', ?)",
+                 ('{"forms":[{"formname":"Pole","formitems":[{"key":"Species","value":"Ironbark"}]}]}',))
+    conn.commit()
+    db = exp.open_db(test_setup['db_path'], read_only=True)
+    assert [note_id for note_id, _ in exp.search_notes(db, "ironb")] == [2]
+    assert [note.id for note in exp.iter_notes(db, text="test value")] == [1]
+    assert [note.id for note in exp.iter_notes(db, text="test", note_ids=[2])] == []
+    assert os.path.exists(test_setup['db_path'] + exp.SEARCH_INDEX_SUFFIX)
+    db.close()
+
+    # The report gets a search box and the words of its notes in a script next to it
+    for options in ({}, {"page_size": 1}):
+        exp.generate_inspection_report(dbfile=test_setup['db_path'], image_folder=test_setup['image_folder'],
+                                       output_file_name=test_setup['output_file'], auto_open=False,
+                                       workers=1, search=True, **options)
+        with open(test_setup['output_path'], 'r') as f:
+            content = f.read()
+        assert "<script src=\"test_output.html.search.js\"></script>" in content
+        with open(test_setup['output_path'] + exp.SEARCH_SCRIPT_SUFFIX, encoding="utf-8") as f:
+            script = f.read()
+        assert "\"ironbark\":[2]" in script
+        if options:
+            assert "\"test_output_0002.html#note-2\"" in script
+        else:
+            assert "<div id=\"note-2\">" in content and "\"#note-2\"" in script
+
+
+def test_report_title_escaped(test_setup):
+    # The title comes from the file name, which is not HTML
+    for options in ({}, {"page_size": 1}):
+        exp.generate_inspection_report(dbfile=test_setup['db_path'], image_folder=test_setup['image_folder'],
+                                       output_file_name="<b>&.html", auto_open=False, workers=1, 
+                                       search=True, **options)
+        with open(os.path.join(test_setup['image_folder'], "<b>&.html"), encoding="utf-8") as f:
+            content = f.read()
+        assert "<b>" not in content
+        assert "<title>&lt;b&gt;&amp;</title>" in content
+        assert "src=\"&lt;b&gt;&amp;.html.search.js\"" in content
+    assert "href=\"%3Cb%3E%26_0001.html#note-1\"" in content
+    with patch('ExportInspections_gpap.to_note', side_effect=ValueError("<oops>")):
+        assert exp.row_level((1,), None, None, "", 400).endswith("<p>&lt;oops&gt;</p>\n")
+
+
+def test_write_paged_report(test_setup):
+    conn = test_setup['conn']
+    conn.executemany("INSERT INTO notes (_id, modified, section, forms, lat, lon) VALUES (?, ?, ?, NULL, 1.5, 2.5)",
+                     [(2, 1633046400000, 'B Section'), (3, 1633046400000, 'Test Section')])
+    conn.commit()
+    db = exp.open_db(test_setup['db_path'])
+    
+    # Two notes per page gives two pages for three notes
+    pages = exp.write_paged_report(exp.iter_notes(db), db, test_setup['output_path'], page_size=2, 
+                                   image_folder=test_setup['image_folder'], photo_size=400)
+    assert [os.path.basename(page) for page in pages] == ["test_output_0001.html", "test_output_0002.html"]
+    with open(pages[0], 'r', encoding='utf-8') as f:
+        first_page = f.read()
+    assert first_page.count("<!DOCTYPE html>") == 1
+    assert "<div id=\"note-1\">" in first_page and "<div id=\"note-2\">" in first_page
+    assert "test_output_0002.html\">Next</a>" in first_page
+    
+    with open(test_setup['output_path'], 'r', encoding='utf-8') as f:
+        index = f.read()
+    assert "<a href=\"test_output_0002.html#note-3\">3</a>" in index
+    assert "<td>(2.5, 1.5)</td>" in index
+    
+    # Splitting by section groups the notes of each section onto one page
+    pages = exp.write_paged_report(exp.iter_notes(db, order_by_section=True), db, test_setup['output_path'], 
+                                   split_by_section=True, image_folder=test_setup['image_folder'], photo_size=400)
+    assert len(pages) == 2
+    with open(pages[1], 'r', encoding='utf-8') as f:
+        second_page = f.read()
+    assert "<h2>1 - Test Section</h2>" in second_page and "<h2>3 - Test Section</h2>" in second_page
+    
+    db.close()
+
+
+def test_generate_inspection_report_profile(test_setup):
+    json_spec = os.path.join(test_setup['temp_dir'], "profile.json")
+    prof_spec = os.path.join(test_setup['temp_dir'], "report.prof")
+    exp.generate_inspection_report(
+        dbfile=test_setup['db_path'],
+        image_folder=test_setup['image_folder'],
+        output_file_name=test_setup['output_file'],
+        auto_open=False,
+        profile_json=json_spec,
+        cprofile_file=prof_spec
+    )
+
+    with open(json_spec, encoding="utf-8") as f:
+        stages = json.load(f)["stages"]
+    for name in ["open_db", "iter_notes", "form_items", "json.loads", "get_image_names", 
+                 "get_orientation", "row_level", "write_file"]:
+        assert stages[name]["calls"] > 0, name
+    assert stages["write_file"]["bytes"] == os.path.getsize(test_setup['output_path'])
+
+    # The cProfile output can be read back with pstats
+    assert pstats.Stats(prof_spec).total_calls > 0
+    assert not profiling.is_enabled()
+    profiling.reset()
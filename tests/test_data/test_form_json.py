@@ -0,0 +1,54 @@
+# test_form_json.py
+import os
+import sys
+import json
+import pytest
+
+# Add the project root directory to the Python path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../..')))
+import form_json
+from form_json import FormControl
+
+
+FORMS = {"forms": [
+    {"formname": "General", "formitems": [
+        {"key": "Condition", "value": "Good", "type": "string"},
+        {"value": 3, "type": "integer"},
+        {"key": "Photos", "value": "1;2", "type": "pictures"},
+        {"key": "Unanswered", "type": "string"},
+    ]},
+    {"formname": "Empty", "formitems": []},
+]}
+
+
+def test_flatten_forms():
+    assert form_json.flatten_forms(FORMS) == [
+        FormControl("General", "Condition", "Good", "string"),
+        FormControl("General", "", 3, "integer"),
+        FormControl("General", "Photos", "1;2", "pictures"),
+        # The empty form keeps its heading
+        FormControl("Empty", None, None, "", 1),
+    ]
+    assert form_json.load_controls(None) == []
+
+
+@pytest.mark.parametrize("name", list(form_json.DECODERS))
+def test_loads(name):
+    previous = form_json.decoder_name()
+    form_json.set_decoder(name)
+    try:
+        text = json.dumps(FORMS)
+        assert form_json.loads(text) == FORMS
+        assert form_json.load_controls(text) == form_json.flatten_forms(FORMS)
+        # Input only the stdlib decoder accepts still decodes
+        assert form_json.loads('{"value": 18446744073709551616}') == {"value": 2 ** 64}
+    finally:
+        form_json.set_decoder(previous)
+
+
+def test_set_decoder():
+    # json is always available and is the fallback for the faster decoders
+    assert "json" in form_json.DECODERS
+    assert form_json.decoder_name() in form_json.DECODERS
+    with pytest.raises(ValueError):
+        form_json.set_decoder("simdjson")
@@ -0,0 +1,65 @@
+# test_geopackage.py
+import os
+import sys
+import struct
+import sqlite3
+import pytest
+
+# Add the project root directory to the Python path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../..')))
+import geopackage
+
+
+def test_point_geometry():
+    geometry = geopackage.point_geometry(151.25, -33.5)
+    # GeoPackage header, then a little endian WKB point
+    assert geometry[:4] == b"GP\x00\x01"
+    assert struct.unpack_from("<i", geometry, 4) == (4326,)
+    assert struct.unpack_from("<BIdd", geometry, 8) == (1, 1, 151.25, -33.5)
+    assert geopackage.point_geometry(None, -33.5) is None
+
+
+def test_unique_column_names():
+    names = geopackage.unique_column_names(["id", "Form.Key", "form.key", "GEOM"], reserved=("fid", "geom"))
+    assert names == ["id", "Form.Key", "form.key_2", "GEOM_2"]
+
+
+def test_gpkg_timestamp():
+    assert geopackage.gpkg_timestamp(1633046400123) == "2021-10-01T00:00:00.123Z"
+    assert geopackage.gpkg_timestamp(None) is None
+
+
+def test_point_layer_writer(tmp_path):
+    output_spec = str(tmp_path / "points.gpkg")
+    writer = geopackage.PointLayerWriter(output_spec, "points", [("name", "TEXT"), ("height", "DOUBLE")],
+                                         batch_size=2)
+    for n in range(5):
+        writer.add(150.0 + n, -33.0 - n, [f"point {n}", n * 1.5])
+    writer.add(None, None, ["nowhere", None])
+    # Nothing is at the output until the layer is complete
+    assert not os.path.exists(output_spec)
+    writer.close()
+    assert not os.path.exists(output_spec + geopackage.PARTIAL_SUFFIX)
+
+    conn = sqlite3.connect(output_spec)
+    assert conn.execute("PRAGMA application_id").fetchone()[0] == geopackage.GPKG_APPLICATION_ID
+    assert conn.execute("PRAGMA integrity_check").fetchone()[0] == "ok"
+    assert conn.execute("SELECT COUNT(*) FROM points").fetchone()[0] == 6
+    assert conn.execute("SELECT table_name, column_name, geometry_type_name, srs_id FROM gpkg_geometry_columns"
+                        ).fetchall() == [("points", "geom", "POINT", 4326)]
+    assert conn.execute("SELECT min_x, min_y, max_x, max_y FROM gpkg_contents").fetchone() == (
+        150.0, -37.0, 154.0, -33.0)
+    # The spatial index holds every located point
+    assert conn.execute("SELECT id FROM rtree_points_geom WHERE minx >= 152.5 ORDER BY id").fetchall() == [
+        (4,), (5,)]
+    assert conn.execute("SELECT COUNT(*) FROM rtree_points_geom").fetchone()[0] == 5
+    assert conn.execute("SELECT extension_name FROM gpkg_extensions").fetchone()[0] == "gpkg_rtree_index"
+    conn.close()
+
+
+def test_point_layer_writer_abort(tmp_path):
+    output_spec = str(tmp_path / "points.gpkg")
+    writer = geopackage.PointLayerWriter(output_spec, "points", [("name", "TEXT")])
+    writer.add(150.0, -33.0, ["point"])
+    writer.abort()
+    assert os.listdir(tmp_path) == []
@@ -0,0 +1,138 @@
+# test_image_blobs.py
+import io
+import os
+import sys
+import sqlite3
+import tempfile
+import shutil
+import pytest
+from PIL import Image
+
+# Add the project root directory to the Python path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../..')))
+import image_blobs
+import ExportInspections_gpap as exp
+from benchmarks.synthetic_gpap import make_synthetic_gpap
+
+
+def jpeg_bytes(width, height):
+    data = io.BytesIO()
+    Image.new('RGB', (width, height), color='green').save(data, format="JPEG")
+    return data.getvalue()
+
+
+@pytest.fixture
+def blob_db():
+    temp_dir = tempfile.mkdtemp()
+    db_path = os.path.join(temp_dir, "test.gpap")
+    conn = sqlite3.connect(db_path)
+    conn.execute("CREATE TABLE images (_id INTEGER PRIMARY KEY, text TEXT, imagedata_id INTEGER)")
+    conn.execute("CREATE TABLE imagedata (_id INTEGER PRIMARY KEY, data BLOB)")
+    conn.executemany("INSERT INTO imagedata (_id, data) VALUES (?, ?)",
+                     [(10, jpeg_bytes(64, 32)), (11, jpeg_bytes(30, 90))])
+    conn.executemany("INSERT INTO images (_id, text, imagedata_id) VALUES (?, ?, ?)",
+                     [(1, "one.jpg", 10), (2, "two.jpg", 11), (3, "no_data.jpg", None)])
+    conn.commit()
+    conn.close()
+    yield temp_dir, db_path
+    shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+def test_blob_image_size(blob_db):
+    temp_dir, db_path = blob_db
+    db = image_blobs.open_readonly(db_path)
+    assert image_blobs.blob_image_size(db, 10) == (64, 32)
+    assert image_blobs.blob_image_size(db, 11) == (30, 90)
+    with pytest.raises(FileNotFoundError):
+        image_blobs.blob_image_size(db, 99)
+    assert image_blobs.resolve_image_blobs(db, [1, 2, 3, 4], chunk_size=2) == {1: 10, 2: 11}
+    db.close()
+    blobs = {os.path.join(temp_dir, "one.jpg"): 10, os.path.join(temp_dir, "missing.jpg"): 99}
+    assert image_blobs.read_blob_sizes(db_path, blobs) == {os.path.join(temp_dir, "one.jpg"): (64, 32)}
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_make_blob_thumbnails(blob_db, workers):
+    temp_dir, db_path = blob_db
+    thumbnail_folder = os.path.join(temp_dir, "thumbnails")
+    blobs = {os.path.join(temp_dir, "one.jpg"): 10, os.path.join(temp_dir, "two.jpg"): 11}
+    thumbnails = image_blobs.make_blob_thumbnails(db_path, blobs, thumbnail_folder, 16, workers=workers)
+
+    assert sorted(os.listdir(thumbnail_folder)) == ["one.jpg.jpg", "two.jpg.jpg"]
+    with Image.open(thumbnails[os.path.join(temp_dir, "two.jpg")]) as thumb:
+        assert thumb.size == (5, 16)
+    # No original is written
+    assert not os.path.exists(os.path.join(temp_dir, "one.jpg"))
+
+    # Thumbnails already in the folder are only kept if they were made at this size
+    thumbnails = image_blobs.make_blob_thumbnails(db_path, blobs, thumbnail_folder, 8, workers=workers)
+    with Image.open(thumbnails[os.path.join(temp_dir, "two.jpg")]) as thumb:
+        assert thumb.size == (3, 8)
+    thumbnails = image_blobs.make_blob_thumbnails(db_path, blobs, thumbnail_folder, 128, workers=workers)
+    with Image.open(thumbnails[os.path.join(temp_dir, "two.jpg")]) as thumb:
+        assert thumb.size == (30, 90)
+    mtime_ns = os.stat(thumbnails[os.path.join(temp_dir, "two.jpg")]).st_mtime_ns
+    image_blobs.make_blob_thumbnails(db_path, blobs, thumbnail_folder, 128, workers=workers)
+    assert os.stat(thumbnails[os.path.join(temp_dir, "two.jpg")]).st_mtime_ns == mtime_ns
+
+
+def test_extract_originals(blob_db):
+    temp_dir, db_path = blob_db
+    image_folder = os.path.join(temp_dir, "photos")
+    blobs = {os.path.join(image_folder, "one.jpg"): 10, os.path.join(image_folder, "two.jpg"): 11}
+    assert image_blobs.extract_originals(db_path, blobs, workers=2) == 2
+    with open(os.path.join(image_folder, "one.jpg"), "rb") as f:
+        assert f.read() == jpeg_bytes(64, 32)
+    # Only images that aren't on disk yet are written
+    assert image_blobs.extract_originals(db_path, blobs) == 0
+
+
+def test_report_from_blobs(tmp_path):
+    dbfile = str(tmp_path / "synthetic.gpap")
+    make_synthetic_gpap(dbfile, str(tmp_path / "extracted"), notes=3, forms_per_note=1, items_per_form=2,
+                        pictures_per_note=2, image_width=64, image_height=48)
+    report_folder = tmp_path / "report"
+    report_folder.mkdir()
+    exp.generate_inspection_report(dbfile=dbfile, image_folder=str(report_folder), output_file_name="report.html",
+                                   photo_size=32, auto_open=False, workers=1, image_source="blobs")
+
+    # The thumbnails are made from the blobs and no originals are written out
+    assert len(os.listdir(report_folder / "thumbnails_32")) == 6
+    assert not list(report_folder.glob("IMG_*.jpg"))
+    content = (report_folder / "report.html").read_text(encoding="utf-8")
+    assert content.count("<img width=\"32\" height=\"24\"") == 3
+    assert content.count("<img width=\"24\" height=\"32\"") == 3
+    # The originals aren't on disk, so the thumbnails don't link to them
+    assert "<a href" not in content
+
+    # With write_originals they are written out and linked
+    exp.generate_inspection_report(dbfile=dbfile, image_folder=str(report_folder), output_file_name="report.html",
+                                   photo_size=32, auto_open=False, workers=1, image_source="blobs",
+                                   write_originals=True)
+    assert len(list(report_folder.glob("IMG_*.jpg"))) == 6
+    content = (report_folder / "report.html").read_text(encoding="utf-8")
+    assert content.count("<a href=\"file:///") == 6
+    for image_spec in report_folder.glob("IMG_*.jpg"):
+        image_spec.unlink()
+
+    # Without thumbnails the originals the report shows are written out, their sizes read from the blobs
+    exp.generate_inspection_report(dbfile=dbfile, image_folder=str(report_folder), output_file_name="report.html",
+                                   photo_size=32, auto_open=False, thumbnail_format=None, image_source="blobs")
+    assert len(list(report_folder.glob("IMG_*.jpg"))) == 6
+    content = (report_folder / "report.html").read_text(encoding="utf-8")
+    assert content.count("<img width=\"32\" height=\"24\"") == 3
+    assert content.count("<a href=\"file:///") == 6
+
+
+def test_filtered_report_thumbnails(tmp_path):
+    dbfile = str(tmp_path / "synthetic.gpap")
+    make_synthetic_gpap(dbfile, str(tmp_path / "extracted"), notes=5, forms_per_note=1, items_per_form=2,
+                        pictures_per_note=2, image_width=64, image_height=48)
+    report_folder = tmp_path / "report"
+    report_folder.mkdir()
+    exp.generate_inspection_report(dbfile=dbfile, image_folder=str(report_folder), output_file_name="report.html",
+                                   photo_size=32, auto_open=False, workers=1, image_source="blobs",
+                                   note_filters={"id_range": (1, 1)})
+
+    # Thumbnails are only made for the photos of the notes in the report
+    assert len(os.listdir(report_folder / "thumbnails_32")) == 2
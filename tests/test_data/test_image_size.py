@@ -0,0 +1,69 @@
+# test_image_size.py
+import os
+import sys
+import tempfile
+import shutil
+import pytest
+from unittest.mock import patch
+from PIL import Image
+
+# Add the project root directory to the Python path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../..')))
+import image_size
+
+
+@pytest.fixture
+def image_folder():
+    temp_dir = tempfile.mkdtemp()
+    yield temp_dir
+    shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+def test_read_image_size(image_folder):
+    jpeg_spec = os.path.join(image_folder, "photo.jpg")
+    png_spec = os.path.join(image_folder, "photo.png")
+    text_spec = os.path.join(image_folder, "notes.txt")
+
+    # An EXIF block before the frame header has to be skipped
+    exif = Image.Exif()
+    exif[0x010E] = "x" * 5000
+    Image.new('RGB', (120, 80), color='red').save(jpeg_spec, exif=exif)
+    Image.new('RGB', (30, 40), color='blue').save(png_spec)
+    with open(text_spec, 'w') as f:
+        f.write("not an image")
+
+    assert image_size.read_image_size(jpeg_spec) == (120, 80)
+    assert image_size.read_image_size(png_spec) == (30, 40)
+    assert image_size.read_image_size(text_spec) is None
+
+
+def test_get_image_size_falls_back_to_pil(image_folder):
+    gif_spec = os.path.join(image_folder, "photo.gif")
+    Image.new('RGB', (64, 32), color='red').save(gif_spec)
+
+    assert image_size.get_image_size(gif_spec) == (64, 32)
+
+    with pytest.raises(FileNotFoundError):
+        image_size.get_image_size(os.path.join(image_folder, "missing.jpg"))
+
+
+def test_cached_image_size(image_folder):
+    image_spec = os.path.join(image_folder, "photo.jpg")
+    Image.new('RGB', (100, 200), color='red').save(image_spec)
+
+    cache = image_size.open_size_cache(image_folder)
+    assert image_size.cached_image_size(cache, image_spec) == (100, 200)
+    image_size.close_size_cache(cache)
+
+    # A second run on the unchanged folder should not read the image
+    cache = image_size.open_size_cache(image_folder)
+    with patch('image_size.get_image_size') as mock_get_image_size:
+        assert image_size.cached_image_size(cache, image_spec) == (100, 200)
+        mock_get_image_size.assert_not_called()
+
+    # Replacing the image invalidates its cache entry
+    Image.new('RGB', (300, 150), color='red').save(image_spec)
+    stat = os.stat(image_spec)
+    os.utime(image_spec, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000))
+    assert image_size.cached_image_size(cache, image_spec) == (300, 150)
+    image_size.close_size_cache(cache)
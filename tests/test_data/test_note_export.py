@@ -0,0 +1,132 @@
+# test_note_export.py
+import os
+import csv
+import sys
+import json
+import sqlite3
+import shutil
+import tempfile
+import pytest
+
+# Add the project root directory to the Python path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../..')))
+import ExportInspections_gpap as exp
+import note_export
+
+
+FORMS_1 = {"forms": [
+    {"formname": "General", "formitems": [
+        {"key": "Condition", "value": "Good", "type": "string"},
+        {"key": "Photos", "value": "1;2", "type": "pictures"},
+    ]},
+    {"formname": "Measure", "formitems": [{"key": "Depth", "value": 1.5, "type": "double"}]},
+]}
+
+FORMS_2 = {"forms": [
+    {"formname": "General", "formitems": [
+        {"key": "Condition", "value": "Poor, \"cracked\"", "type": "string"},
+        {"key": "Access", "value": "Ladder", "type": "string"},
+    ]},
+]}
+
+
+@pytest.fixture
+def gpap():
+    temp_dir = tempfile.mkdtemp()
+    dbfile = os.path.join(temp_dir, "survey.gpap")
+    conn = sqlite3.connect(dbfile)
+    conn.execute("CREATE TABLE notes (_id INTEGER PRIMARY KEY, ts INTEGER, text TEXT, form TEXT, "
+                 "lat REAL, lon REAL)")
+    conn.execute("CREATE TABLE images (_id INTEGER PRIMARY KEY, text TEXT)")
+    conn.executemany("INSERT INTO notes VALUES (?, ?, ?, ?, ?, ?)", [
+        (1, 1633046400000, "Pits", json.dumps(FORMS_1), -33.5, 151.25),
+        (2, 1633050000000, "Poles", json.dumps(FORMS_2), -33.75, 151.5),
+        (3, None, "Empty", None, None, None),
+    ])
+    conn.executemany("INSERT INTO images VALUES (?, ?)", [(1, "a.jpg"), (2, "b.jpg")])
+    conn.commit()
+    conn.close()
+    yield temp_dir, dbfile
+    shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+def test_export_jsonl(gpap):
+    temp_dir, dbfile = gpap
+    output_spec = os.path.join(temp_dir, "survey.jsonl")
+    assert note_export.export_notes(dbfile, [output_spec]) == 3
+
+    with open(output_spec, encoding="utf-8") as f:
+        records = [json.loads(line) for line in f]
+    assert [record["id"] for record in records] == [1, 2, 3]
+    assert records[0]["section"] == "Pits"
+    assert records[0]["controls"][0] == {"form": "General", "key": "Condition", "value": "Good",
+                                         "type": "string"}
+    assert records[0]["controls"][1]["images"] == ["a.jpg", "b.jpg"]
+    assert records[0]["controls"][2]["value"] == 1.5
+    assert records[2]["timestamp"] is None and records[2]["controls"] == []
+
+
+def test_export_csv(gpap):
+    temp_dir, dbfile = gpap
+    output_spec = os.path.join(temp_dir, "survey.csv")
+    assert note_export.export_notes(dbfile, [output_spec], section="Poles") == 1
+
+    with open(output_spec, encoding="utf-8", newline="") as f:
+        reader = csv.DictReader(f)
+        rows = list(reader)
+    # Only the columns of the exported notes
+    assert reader.fieldnames == note_export.BASE_COLUMNS + ["General.Condition", "General.Access"]
+    assert rows[0]["General.Condition"] == "Poor, \"cracked\""
+    assert rows[0]["lat"] == "-33.75"
+
+
+def test_export_parquet(gpap):
+    pq = pytest.importorskip("pyarrow.parquet")
+    temp_dir, dbfile = gpap
+    output_spec = os.path.join(temp_dir, "survey.parquet")
+    # Small batches so that the file is written in several parts
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr(note_export, "PARQUET_BATCH_SIZE", 2)
+        note_export.export_notes(dbfile, [output_spec])
+
+    table = pq.read_table(output_spec).to_pydict()
+    assert table["id"] == [1, 2, 3]
+    assert table["General.Condition"] == ["Good", "Poor, \"cracked\"", None]
+    assert table["General.Photos"] == ["a.jpg;b.jpg", None, None]
+    assert table["Measure.Depth"] == ["1.5", None, None]
+    assert table["timestamp"][2] is None
+
+
+def test_export_gpkg(gpap):
+    temp_dir, dbfile = gpap
+    output_spec = os.path.join(temp_dir, "survey.gpkg")
+    assert note_export.export_notes(dbfile, [output_spec]) == 3
+
+    conn = sqlite3.connect(output_spec)
+    rows = conn.execute("SELECT fid, geom IS NULL, id, timestamp, section, \"General.Condition\", "
+                        "\"General.Photos\" FROM notes ORDER BY fid").fetchall()
+    assert rows[0] == (1, 0, 1, "2021-10-01T00:00:00.000Z", "Pits", "Good", "a.jpg;b.jpg")
+    assert rows[2][1:4] == (1, 3, None)
+    assert conn.execute("SELECT minx, miny FROM rtree_notes_geom WHERE id = 2").fetchone() == (151.5, -33.75)
+    assert conn.execute("SELECT min_x, min_y, max_x, max_y FROM gpkg_contents").fetchone() == (
+        151.25, -33.75, 151.5, -33.5)
+    conn.close()
+
+
+def test_export_format(gpap):
+    temp_dir, dbfile = gpap
+    with pytest.raises(ValueError):
+        note_export.export_notes(dbfile, [os.path.join(temp_dir, "survey.xlsx")])
+
+
+def test_report_exports(gpap):
+    temp_dir, dbfile = gpap
+    # The exports are written from the notes read for the report
+    exp.generate_inspection_report(dbfile=dbfile, image_folder=temp_dir, output_file_name="survey.html",
+                                   auto_open=False, workers=1, exports=["survey.jsonl", "survey.csv"])
+    with open(os.path.join(temp_dir, "survey.html"), encoding="utf-8") as f:
+        assert "<h2>2 - Poles</h2>" in f.read()
+    with open(os.path.join(temp_dir, "survey.jsonl"), encoding="utf-8") as f:
+        assert len(f.readlines()) == 3
+    with open(os.path.join(temp_dir, "survey.csv"), encoding="utf-8", newline="") as f:
+        assert len(list(csv.DictReader(f))) == 3
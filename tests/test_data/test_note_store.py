@@ -0,0 +1,106 @@
+# test_note_store.py
+import os
+import sys
+import json
+import sqlite3
+import datetime
+import pytest
+
+# Add the project root directory to the Python path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../..')))
+import note_store
+from form_json import FormControl
+import ExportInspections_gpap as exp
+
+
+def forms(form_name, **values):
+    items = [{"key": key, "value": value, "type": "string"} for key, value in values.items()]
+    return json.dumps({"forms": [{"formname": form_name, "formitems": items}]})
+
+
+NOTES = [
+    exp.Note(1, 1633046400000, "Poles", forms("Pole", species="Ironbark", height="12.5"), -33.1, 151.1),
+    exp.Note(2, 1633132800000, "Poles", forms("Pole", species="Spotted Gum", height=9), -33.2, 151.2),
+    exp.Note(3, 1633219200000, "Lines", forms("Span", species="Ironbark", clearance="low"), None, None),
+    exp.Note(4, None, None, "not json", -34.0, 150.0),
+]
+
+
+@pytest.fixture
+def store():
+    return note_store.NoteStore.from_notes(NOTES)
+
+
+def test_note_store_columns(store):
+    assert len(store) == 4
+    assert list(store.ids) == [1, 2, 3, 4]
+    assert store.section(2) == "Lines" and store.section(3) is None
+    # Repeated strings are stored once
+    assert store.strings.strings.count("species") == 1
+    assert store.values.strings.count("Ironbark") == 1
+    assert store.controls(1) == [FormControl("Pole", "species", "Spotted Gum", "string"),
+                                 FormControl("Pole", "height", "9", "string")]
+    assert store.controls(3) == []
+    assert list(store.control_note) == [0, 0, 1, 1, 2, 2]
+    assert store.memory_size() > 0
+
+
+@pytest.fixture(params=["numpy", "python"])
+def filter_mode(request, monkeypatch):
+    # The filters run on NumPy when it is installed and loop in Python otherwise
+    if request.param == "numpy":
+        pytest.importorskip("numpy")
+    else:
+        monkeypatch.setattr(note_store, "numpy", None)
+    return request.param
+
+
+def test_note_store_filters(store, filter_mode):
+    assert store.selected_ids(store.where_section("Poles")) == [1, 2]
+    assert store.selected_ids(store.where_section("Nowhere")) == []
+    assert store.selected_ids(store.where_time(datetime.datetime.fromtimestamp(1633100000), 1633219200000)) == [2]
+    assert store.selected_ids(store.where_bbox((151.0, -33.5, 152.0, -33.0))) == [1, 2]
+    assert store.selected_ids(store.where_key("clearance")) == [3]
+    assert store.selected_ids(store.where_value("species", "Ironbark")) == [1, 3]
+    assert store.selected_ids(store.where_value("species", "Ironbark", form="Span")) == [3]
+    assert store.selected_ids(store.where_value("height", 9)) == [2]
+    assert store.selected_ids(store.where_range("height", 10)) == [1]
+    ironbark = store.where_value("species", "Ironbark")
+    poles = store.where_section("Poles")
+    assert store.selected_ids(note_store.mask_and(ironbark, poles)) == [1]
+    assert store.selected_ids(note_store.mask_or(ironbark, poles)) == [1, 2, 3]
+    assert store.selected_ids(note_store.mask_not(poles)) == [3, 4]
+    assert store.selected_ids(store.all()) == [1, 2, 3, 4]
+    assert all(type(mask) is bytearray for mask in (poles, note_store.mask_not(poles), note_store.mask_and(poles)))
+    assert store.selected_ids(store.where_time(end=1633100000000)) == [1]
+    assert store.selected_ids(note_store.NoteStore().where_section("Poles")) == []
+
+
+def test_note_store_aggregations(store):
+    assert store.key_counts() == {("Pole", "species"): 2, ("Pole", "height"): 2,
+                                  ("Span", "species"): 1, ("Span", "clearance"): 1}
+    assert store.key_counts(store.where_section("Lines")) == {("Span", "species"): 1, ("Span", "clearance"): 1}
+    assert store.value_counts("species") == {"Ironbark": 2, "Spotted Gum": 1}
+    assert store.distinct_values("species", form="Pole") == ["Ironbark", "Spotted Gum"]
+    assert store.distinct_values("species", mask=store.where_section("Lines")) == ["Ironbark"]
+    assert store.value_range("height") == (9.0, 12.5)
+    assert store.value_range("clearance") is None
+    assert store.value_range("missing") is None
+    summary = {(row["form"], row["key"]): row for row in store.summary()}
+    assert summary["Pole", "height"] == {"form": "Pole", "key": "height", "count": 2, "distinct": 2,
+                                         "min": 9.0, "max": 12.5}
+
+
+def test_load_note_store(tmp_path):
+    db_path = str(tmp_path / "survey.gpap")
+    conn = sqlite3.connect(db_path)
+    conn.execute("CREATE TABLE notes (_id INTEGER PRIMARY KEY, ts INTEGER, text TEXT, form TEXT, "
+                 "lat REAL, lon REAL)")
+    conn.executemany("INSERT INTO notes VALUES (?, ?, ?, ?, ?, ?)", NOTES)
+    conn.commit()
+    conn.close()
+    db = exp.open_db(db_path, read_only=True)
+    store = note_store.load_note_store(db, section="Poles")
+    db.close()
+    assert list(store.ids) == [1, 2]
+    assert store.value_counts("species") == {"Ironbark": 1, "Spotted Gum": 1}
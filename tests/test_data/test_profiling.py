@@ -0,0 +1,44 @@
+# test_profiling.py
+import os
+import sys
+import pytest
+
+# Add the project root directory to the Python path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../..')))
+import profiling
+
+
+@pytest.fixture
+def clean_profiling():
+    profiling.reset()
+    yield
+    profiling.disable()
+    profiling.reset()
+
+
+def test_disabled_by_default(clean_profiling):
+    @profiling.timed("double")
+    def double(x):
+        return x * 2
+
+    assert double(2) == 4
+    with profiling.stage("block"):
+        pass
+    profiling.add_bytes("block", 10)
+    assert profiling.summary() == {}
+
+
+def test_summary(clean_profiling):
+    profiling.enable()
+    for seconds in range(1, 21):
+        profiling.record("stage", seconds / 1000)
+    profiling.add_bytes("stage", 1234)
+    assert list(profiling.timed_iter("rows", [1, 2, 3])) == [1, 2, 3]
+
+    stats = profiling.summary()
+    assert stats["stage"]["calls"] == 20
+    assert stats["stage"]["total_seconds"] == pytest.approx(0.21)
+    assert stats["stage"]["p95_seconds"] == pytest.approx(0.019)
+    assert stats["stage"]["bytes"] == 1234
+    assert stats["rows"]["calls"] == 3
+    assert "stage" in profiling.format_summary()
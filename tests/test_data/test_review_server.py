@@ -0,0 +1,119 @@
+# test_review_server.py
+import os
+import sys
+import threading
+import urllib.request
+import urllib.error
+import pytest
+
+# Add the project root directory to the Python path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../..')))
+import review_server
+from benchmarks.synthetic_gpap import make_synthetic_gpap
+
+
+@pytest.fixture(params=["folder", "blobs"])
+def server(request, tmp_path):
+    dbfile = str(tmp_path / "survey.gpap")
+    photos = tmp_path / "photos"
+    make_synthetic_gpap(dbfile, str(photos), notes=5, forms_per_note=1, items_per_form=2,
+                        pictures_per_note=1, image_width=64, image_height=48)
+    if request.param == "blobs":
+        # Reviewing from the blobs doesn't need the photos on disk
+        for name in os.listdir(photos):
+            os.remove(photos / name)
+    app = review_server.ReviewApp(dbfile, str(photos), photo_size=32, page_size=2,
+                                  image_source=request.param)
+    server = review_server.make_server(app, port=0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield app, f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+    app.close()
+
+
+def fetch(url, headers=None):
+    request = urllib.request.Request(url, headers=headers or {})
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status, response.headers, response.read()
+    except urllib.error.HTTPError as e:
+        return e.code, e.headers, b""
+
+
+def test_pages(server):
+    app, base = server
+    status, headers, body = fetch(base + "/?page=2")
+    text = body.decode("utf-8")
+    assert status == 200
+    # Only the notes of the page are rendered, and only their thumbnails made
+    assert "<h2>3 - Section 3</h2>" in text and "<h2>4 - Section 4</h2>" in text
+    assert "<h2>1 - " not in text
+    assert "Page 2 of 3 (5 notes)" in text
+    assert len(os.listdir(app.thumbnail_folder)) == 2
+    assert "src=\"/thumb/IMG_000003.jpg.jpg\"" in text and "href=\"/photo/IMG_000003.jpg\"" in text
+
+    # Notes that haven't changed come from the cache
+    assert app.render_cache.misses == 2
+    fetch(base + "/?page=2")
+    assert app.render_cache.hits == 2 and app.render_cache.misses == 2
+
+    assert fetch(base + "/note/5")[0] == 200
+    assert fetch(base + "/?page=4")[0] == 404
+    assert fetch(base + "/note/99")[0] == 404
+
+
+def test_localize_links(server):
+    app, base = server
+    # Names are URL-quoted, so # ? and % don't cut the link short or change the path
+    image_spec = os.path.join(app.image_folder, "a&b #1?%.jpg")
+    thumb_spec = os.path.join(app.thumbnail_folder, "a&b #1?%.jpg.jpg")
+    fragment = (f"<a href=\"file:///{review_server.exp.escape(image_spec)}\">"
+                f"<img src=\"file:///{review_server.exp.escape(thumb_spec)}\"/></a>")
+    assert app.localize_links(fragment) == ("<a href=\"/photo/a%26b%20%231%3F%25.jpg\">"
+                                            "<img src=\"/thumb/a%26b%20%231%3F%25.jpg.jpg\"/></a>")
+
+
+def test_concurrent_pages(server):
+    app, base = server
+    # Pages loaded at once make their own thumbnails, each one only once
+    threads = [threading.Thread(target=fetch, args=(base + f"/?page={page}",)) for page in (1, 2, 3, 1)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(app.thumbnails) == 5 and not app.thumbnails_in_progress
+
+
+def test_thumbnails_and_photos(server):
+    app, base = server
+    fetch(base + "/?page=1")
+    status, headers, body = fetch(base + "/thumb/IMG_000001.jpg.jpg")
+    assert status == 200 and headers["Content-Type"] == "image/jpeg" and body[:2] == b"\xff\xd8"
+
+    # The browser's copy is revalidated with the ETag or the date
+    etag = headers["ETag"]
+    assert fetch(base + "/thumb/IMG_000001.jpg.jpg", {"If-None-Match": etag})[0] == 304
+    assert fetch(base + "/thumb/IMG_000001.jpg.jpg", {"If-Modified-Since": headers["Last-Modified"]})[0] == 304
+    assert fetch(base + "/thumb/IMG_000001.jpg.jpg", {"If-None-Match": "\"stale\""})[0] == 200
+
+    # Originals come from the folder or straight from the blob
+    status, headers, body = fetch(base + "/photo/IMG_000001.jpg")
+    assert status == 200 and int(headers["Content-Length"]) == len(body) and body[:2] == b"\xff\xd8"
+    assert fetch(base + "/photo/IMG_000001.jpg", {"If-None-Match": headers["ETag"]})[0] == 304
+
+    assert fetch(base + "/photo/..%2Fsurvey.gpap")[0] == 404
+    assert fetch(base + "/thumb/..%2F..%2Fsurvey.gpap")[0] == 404
+
+
+def test_lru_cache():
+    cache = review_server.LRUCache(maxsize=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    cache.put("c", 3)
+    # The least recently used entry goes first
+    assert cache.get("b") is None
+    assert cache.get("a") == 1 and cache.get("c") == 3
+    assert len(cache) == 2
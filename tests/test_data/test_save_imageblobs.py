@@ -0,0 +1,83 @@
+# test_save_imageblobs.py
+import os
+import sys
+import sqlite3
+import tempfile
+import threading
+import shutil
+import pytest
+
+# Add the project root directory to the Python path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../..')))
+from scratch import save_imageblobs
+
+
+@pytest.fixture
+def blob_db():
+    temp_dir = tempfile.mkdtemp()
+    db_path = os.path.join(temp_dir, "test.gpap")
+    conn = sqlite3.connect(db_path)
+    conn.execute("CREATE TABLE images (_id INTEGER PRIMARY KEY, text TEXT, imagedata_id INTEGER)")
+    conn.execute("CREATE TABLE imagedata (_id INTEGER PRIMARY KEY, data BLOB)")
+    conn.executemany("INSERT INTO imagedata (_id, data) VALUES (?, ?)",
+                     [(10, b"a" * 3000), (11, b"b" * 10)])
+    conn.executemany("INSERT INTO images (_id, text, imagedata_id) VALUES (?, ?, ?)",
+                     [(1, "one.jpg", 11), (2, "two.jpg", 10), (3, "orphan.jpg", 99)])
+    conn.commit()
+    conn.close()
+    yield temp_dir, db_path
+    shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+def test_iter_image_records(blob_db):
+    temp_dir, db_path = blob_db
+    # Images without image data are left out, the rest come in blob order
+    assert list(save_imageblobs.iter_image_records(db_path)) == [(2, "two.jpg", 10), (1, "one.jpg", 11)]
+
+
+def test_extract_images(blob_db):
+    temp_dir, db_path = blob_db
+    image_folder = os.path.join(temp_dir, "images")
+    records = save_imageblobs.get_image_ids(db_path)
+
+    assert save_imageblobs.extract_images(db_path, records, image_folder, workers=2) == 2
+    with open(os.path.join(image_folder, "two.jpg"), "rb") as f:
+        assert f.read() == b"a" * 3000
+    assert sorted(os.listdir(image_folder)) == ["one.jpg", "two.jpg"]
+
+    # Existing files are skipped unless asked otherwise
+    with open(os.path.join(image_folder, "one.jpg"), "wb") as f:
+        f.write(b"edited")
+    assert save_imageblobs.extract_images(db_path, records, image_folder) == 0
+    assert save_imageblobs.extract_images(db_path, records, image_folder, skip_existing=False) == 2
+    with open(os.path.join(image_folder, "one.jpg"), "rb") as f:
+        assert f.read() == b"b" * 10
+
+
+def test_extract_images_failures(blob_db, monkeypatch):
+    temp_dir, db_path = blob_db
+    image_folder = os.path.join(temp_dir, "images")
+    records = [(i, f"image{i}.jpg", 10) for i in range(10)]
+
+    def broken_connection(dbfile):
+        raise sqlite3.OperationalError("unable to open database file")
+
+    # Writes that fail still give back their slot, so the rest aren't blocked
+    monkeypatch.setattr(save_imageblobs, "open_readonly", broken_connection)
+    result = []
+    thread = threading.Thread(target=lambda: result.append(
+        save_imageblobs.extract_images(db_path, records, image_folder, workers=1)), daemon=True)
+    thread.start()
+    thread.join(timeout=10)
+    assert result == [0]
+
+
+def test_copy_blob_small_chunks(blob_db):
+    temp_dir, db_path = blob_db
+    db = save_imageblobs.open_readonly(db_path)
+    output_file_path = os.path.join(temp_dir, "out.jpg")
+
+    assert save_imageblobs.copy_blob(db, 10, output_file_path, chunk_size=7)
+    assert os.path.getsize(output_file_path) == 3000
+    assert not save_imageblobs.copy_blob(db, 99, output_file_path)
+    db.close()
@@ -0,0 +1,89 @@
+# test_search_index.py
+import os
+import sys
+import json
+import pytest
+
+# Add the project root directory to the Python path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../..')))
+import search_index
+
+
+def forms(form_name, **values):
+    items = [{"key": key, "value": value, "type": "string"} for key, value in values.items()]
+    return json.dumps({"forms": [{"formname": form_name, "formitems": items}]})
+
+
+@pytest.fixture
+def notes():
+    return [
+        (1, "Poles", forms("Pole", species="Spotted Gum", condition="Cracked crossarm")),
+        (2, "Poles", forms("Pole", species="Ironbark", condition="Good")),
+        (3, "Lines", forms("Span", clearance="Vegetation café")),
+        (4, None, "not json"),
+    ]
+
+
+@pytest.fixture
+def index(notes):
+    index = search_index.open_search_index(":memory:")
+    search_index.update_search_index(index, "v1", lambda: notes)
+    yield index
+    index.close()
+
+
+def test_note_text():
+    section, form_names, keys, values = search_index.note_text("Poles", forms("Pole", species="Ironbark"))
+    assert (section, form_names, keys, values) == ("Poles", "Pole", "species", "Ironbark")
+    assert search_index.note_text(None, "not json") == ("", "", "", "")
+
+
+def test_search(index):
+    ids = lambda text, **options: [note_id for note_id, _ in search_index.search(index, text, **options)]
+    assert ids("cracked") == [1]
+    assert ids("iron") == [2]
+    assert ids("poles gum") == [1]
+    assert sorted(ids("pole")) == [1, 2]
+    # Accents and case don't matter, punctuation is ignored
+    assert ids("CAFE") == [3]
+    assert ids("\"crossarm\" (") == [1]
+    assert ids("") == []
+    assert ids("keys: clearance", raw=True) == [3]
+    assert ids("ironbark OR vegetation", raw=True, limit=1) in ([2], [3])
+    assert "[Cracked]" in search_index.search(index, "cracked")[0][1]
+
+
+def test_update_search_index(notes):
+    index = search_index.open_search_index(":memory:")
+    assert search_index.update_search_index(index, "v1", lambda: notes) == 4
+    # Nothing is read while the database is unchanged
+    assert search_index.update_search_index(index, "v1", lambda: pytest.fail("notes were read")) == 0
+    # Only changed notes are indexed again, and deleted notes are removed
+    changed = [notes[0], (2, "Poles", forms("Pole", species="Blackbutt")), notes[2]]
+    assert search_index.update_search_index(index, "v2", lambda: changed) == 1
+    assert search_index.search(index, "ironbark") == []
+    assert [note_id for note_id, _ in search_index.search(index, "blackbutt")] == [2]
+    assert index.execute("SELECT COUNT(*) FROM indexed").fetchone()[0] == 3
+    index.close()
+
+
+def test_search_script_sink(tmp_path, notes):
+    class Note:
+        def __init__(self, id, section, forms):
+            self.id, self.section, self.forms = id, section, forms
+
+    script_spec = str(tmp_path / "report.html") + search_index.SEARCH_SCRIPT_SUFFIX
+    sink = search_index.SearchScriptSink(script_spec, {2: "report_0002.html#note-2"})
+    for note in notes:
+        sink.add(Note(*note))
+    sink.close()
+    with open(script_spec, encoding="utf-8") as f:
+        script = f.read()
+    assert script.startswith("var SEARCH_INDEX = ") and script.endswith(";\n")
+    data = json.loads(script[len("var SEARCH_INDEX = "):-2])
+    assert data["terms"]["cracked"] == [1]
+    assert data["terms"]["pole"] == [1, 2]
+    assert data["terms"]["café"] == [3]
+    assert data["notes"]["1"] == ["1 - Poles", "#note-1"]
+    assert data["notes"]["2"] == ["2 - Poles", "report_0002.html#note-2"]
+    assert data["notes"]["4"] == ["4 - Unknown", "#note-4"]
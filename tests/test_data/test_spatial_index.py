@@ -0,0 +1,99 @@
+# test_spatial_index.py
+import os
+import sys
+import random
+import sqlite3
+import pytest
+
+# Add the project root directory to the Python path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../..')))
+import spatial_index
+
+
+@pytest.fixture
+def points():
+    generator = random.Random(7)
+    return [(note_id, 148.0 + generator.random(), -33.0 - generator.random()) for note_id in range(1, 501)]
+
+
+@pytest.fixture
+def index(points):
+    index = spatial_index.open_spatial_index(":memory:", "v1", lambda: points)
+    yield index
+    index.close()
+
+
+def test_open_spatial_index(tmp_path, points):
+    index_spec = str(tmp_path / "survey.gpap.spatial.sqlite")
+    loads = []
+
+    def load_points():
+        loads.append(1)
+        return points[:10]
+
+    spatial_index.open_spatial_index(index_spec, "v1", load_points).close()
+    spatial_index.open_spatial_index(index_spec, "v1", load_points).close()
+    # Built once, and again only when the database changes
+    assert len(loads) == 1
+    index = spatial_index.open_spatial_index(index_spec, "v2", lambda: points[:3] + [(99, None, None)])
+    assert index.execute("SELECT COUNT(*) FROM note_rtree").fetchone()[0] == 3
+    # The extent is kept with the stamp, so nearest_notes doesn't scan the points for it
+    lons = [lon for _, lon, _ in points[:3]]
+    lats = [lat for _, _, lat in points[:3]]
+    assert index.execute("SELECT min_lon, min_lat, max_lon, max_lat FROM source").fetchone() == \
+        (min(lons), min(lats), max(lons), max(lats))
+    index.close()
+
+
+def test_open_spatial_index_without_extent(tmp_path, points):
+    index_spec = str(tmp_path / "survey.gpap.spatial.sqlite")
+    spatial_index.open_spatial_index(index_spec, "v1", lambda: points[:10]).close()
+    # An index written before the extent was stored is built again
+    old = sqlite3.connect(index_spec)
+    old.executescript("DROP TABLE source; CREATE TABLE source (stamp TEXT); INSERT INTO source VALUES ('v1');")
+    old.close()
+    index = spatial_index.open_spatial_index(index_spec, "v1", lambda: points)
+    assert index.execute("SELECT COUNT(*) FROM note_rtree").fetchone()[0] == 500
+    assert len(spatial_index.nearest_notes(index, 148.5, -33.5, count=3)) == 3
+    index.close()
+
+
+def test_ids_in_bbox(index, points):
+    bbox = (148.2, -33.6, 148.5, -33.1)
+    expected = [note_id for note_id, lon, lat in points
+                if bbox[0] <= lon <= bbox[2] and bbox[1] <= lat <= bbox[3]]
+    assert expected and spatial_index.ids_in_bbox(index, bbox) == expected
+
+    # The exact positions are kept, not the rounded R*Tree boxes
+    note_id, lon, lat = points[0]
+    assert spatial_index.ids_in_bbox(index, (lon, lat, lon, lat)) == [note_id]
+
+
+def test_ids_within_radius(index, points):
+    lon, lat = 148.5, -33.5
+    expected = [note_id for note_id, note_lon, note_lat in points
+                if spatial_index.distance_m(lon, lat, note_lon, note_lat) <= 20000]
+    assert expected and spatial_index.ids_within_radius(index, lon, lat, 20000) == expected
+    # About 111 km to a degree of latitude
+    assert spatial_index.distance_m(148.0, -33.0, 148.0, -34.0) == pytest.approx(111195, rel=1e-3)
+
+
+def test_ids_in_polygon(index, points):
+    triangle = [(148.0, -33.0), (149.0, -33.0), (148.0, -34.0)]
+    expected = [note_id for note_id, lon, lat in points if (lon - 148.0) + (-33.0 - lat) < 1.0]
+    assert spatial_index.ids_in_polygon(index, triangle) == expected
+    with pytest.raises(ValueError):
+        spatial_index.ids_in_polygon(index, triangle[:2])
+
+
+def test_nearest_notes(index, points):
+    lon, lat = 148.3, -33.7
+    by_distance = sorted((spatial_index.distance_m(lon, lat, note_lon, note_lat), note_id)
+                         for note_id, note_lon, note_lat in points)
+    nearest = spatial_index.nearest_notes(index, lon, lat, count=5)
+    assert [note_id for note_id, _ in nearest] == [note_id for _, note_id in by_distance[:5]]
+    assert nearest[0][1] == pytest.approx(by_distance[0][0])
+
+    # Far from every note, and asking for more notes than there are
+    assert len(spatial_index.nearest_notes(index, 0.0, 0.0, count=3)) == 3
+    assert len(spatial_index.nearest_notes(index, lon, lat, count=1000)) == 500
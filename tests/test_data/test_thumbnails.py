@@ -0,0 +1,89 @@
+# test_thumbnails.py
+import os
+import sys
+import tempfile
+import shutil
+import pytest
+from unittest.mock import patch
+from PIL import Image
+
+# Add the project root directory to the Python path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../..')))
+import thumbnails
+
+
+@pytest.fixture
+def image_folder():
+    temp_dir = tempfile.mkdtemp()
+    yield temp_dir
+    shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+def test_rotate_image():
+    # Orientation 6 means the camera was turned a quarter to the right
+    image = Image.new('RGB', (200, 100), color='red')
+    exif = image.getexif()
+    exif[thumbnails.ORIENTATION_TAG] = 6
+    image.info["exif"] = exif.tobytes()
+    assert thumbnails.rotate_image(image).size == (100, 200)
+
+    # Images without the tag are left as they are
+    assert thumbnails.rotate_image(Image.new('RGB', (200, 100))).size == (200, 100)
+
+
+def test_make_thumbnails(image_folder):
+    thumbnail_folder = os.path.join(image_folder, thumbnails.THUMBNAIL_FOLDER_NAME)
+    image_specs = []
+    for i, size in enumerate([(1200, 800), (600, 900), (100, 50)]):
+        image_spec = os.path.join(image_folder, f"photo{i}.jpg")
+        Image.new('RGB', size, color='blue').save(image_spec)
+        image_specs.append(image_spec)
+    missing_spec = os.path.join(image_folder, "missing.jpg")
+
+    result = thumbnails.make_thumbnails(image_specs + [missing_spec], thumbnail_folder, 300, workers=2)
+
+    # Missing images are left out so the report links the original
+    assert sorted(result) == sorted(image_specs)
+    sizes = [Image.open(result[spec]).size for spec in image_specs]
+    assert sizes == [(300, 200), (200, 300), (100, 50)]
+
+    # A second run on unchanged photos writes nothing
+    with patch('thumbnails.make_thumbnail') as mock_make_thumbnail:
+        assert thumbnails.make_thumbnails(image_specs, thumbnail_folder, 300, workers=1) == result
+        mock_make_thumbnail.assert_not_called()
+
+
+def test_make_thumbnails_webp(image_folder):
+    image_spec = os.path.join(image_folder, "photo.png")
+    Image.new('RGBA', (800, 400)).save(image_spec)
+
+    result = thumbnails.make_thumbnails([image_spec], image_folder, 200, thumbnail_format="webp")
+    assert result[image_spec].endswith("photo.png.webp")
+    assert Image.open(result[image_spec]).size == (200, 100)
+
+    with pytest.raises(ValueError):
+        thumbnails.make_thumbnails([image_spec], image_folder, 200, thumbnail_format="gif")
+
+
+def test_thumbnail_folder(image_folder):
+    image_spec = os.path.join(image_folder, "photo.jpg")
+    Image.new('RGB', (1200, 1600)).save(image_spec)
+
+    # A run at another size makes its own thumbnails instead of reusing the smaller ones
+    small = thumbnails.make_thumbnails([image_spec], thumbnails.thumbnail_folder(image_folder, 200), 200, workers=1)
+    large = thumbnails.make_thumbnails([image_spec], thumbnails.thumbnail_folder(image_folder, 800), 800, workers=1)
+    assert Image.open(small[image_spec]).size == (150, 200)
+    assert Image.open(large[image_spec]).size == (600, 800)
+
+
+def test_thumbnail_name(image_folder):
+    # Photos that differ only in their extension get thumbnails of their own
+    jpeg_spec = os.path.join(image_folder, "plot.jpg")
+    png_spec = os.path.join(image_folder, "plot.png")
+    Image.new('RGB', (100, 50)).save(jpeg_spec)
+    Image.new('RGB', (50, 100)).save(png_spec)
+    result = thumbnails.make_thumbnails([jpeg_spec, png_spec], thumbnails.thumbnail_folder(image_folder, 40), 40,
+                                        workers=1)
+    assert os.path.basename(result[jpeg_spec]) == "plot.jpg.jpg"
+    assert os.path.basename(result[png_spec]) == "plot.png.jpg"
+    assert Image.open(result[png_spec]).size == (20, 40)
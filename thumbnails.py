@@ -0,0 +1,135 @@
+"""
+thumbnails.py
+=============
+
+Writes small, correctly rotated copies of the field photos so that the report
+does not have to load every full-resolution original into the browser.
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import BinaryIO, Dict, Iterable, List, Optional, Tuple, Union
+from PIL import Image, ExifTags
+
+THUMBNAIL_FOLDER_NAME = "thumbnails"
+
+THUMBNAIL_FORMATS = {"jpeg": ".jpg", "webp": ".webp"}
+
+ORIENTATION_TAG = next(tag for tag, name in ExifTags.TAGS.items() if name == "Orientation")
+
+# How to undo each EXIF Orientation value (1 means the image is already upright)
+ORIENTATION_TRANSPOSE = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
+
+
+def rotate_image(image: Image.Image) -> Image.Image:
+    """Return the image turned upright according to its EXIF Orientation tag."""
+    try:
+        orientation = image.getexif().get(ORIENTATION_TAG, 1)
+    except Exception:
+        orientation = 1
+    method = ORIENTATION_TRANSPOSE.get(orientation)
+    if method is None:
+        return image
+    return image.transpose(method)
+
+
+def thumbnail_folder(image_folder: str, photo_size: int) -> str:
+    """Thumbnails of each size get their own folder, so a run at another size doesn't reuse them."""
+    return os.path.join(image_folder, f"{THUMBNAIL_FOLDER_NAME}_{photo_size}")
+
+
+def thumbnail_name(image_name: str, thumbnail_format: str = "jpeg") -> str:
+    """The whole file name is kept, so plot.jpg and plot.png get different thumbnails."""
+    return os.path.basename(image_name) + THUMBNAIL_FORMATS[thumbnail_format]
+
+
+def make_thumbnail(job: Tuple[str, str, int, str, int]) -> Optional[str]:
+    """Write one thumbnail; the job is (image_spec, thumb_spec, photo_size, format, mtime_ns)."""
+    image_spec, thumb_spec, photo_size, thumbnail_format, mtime_ns = job
+    try:
+        write_thumbnail(image_spec, thumb_spec, photo_size, thumbnail_format)
+        # The thumbnail carries the source's mtime so unchanged photos can be skipped
+        os.utime(thumb_spec, ns=(mtime_ns, mtime_ns))
+        return thumb_spec
+    except Exception as e:
+        print(f"Error making thumbnail for {image_spec}: {str(e)}")
+        return None
+
+
+def write_thumbnail(source: Union[str, BinaryIO], thumb_spec: str, photo_size: int,
+                    thumbnail_format: str = "jpeg") -> None:
+    """Write a thumbnail of an image file, or of an open file-like object such as a blob."""
+    # Reports running side by side may share a thumbnail folder
+    temp_spec = f"{thumb_spec}.{os.getpid()}.tmp"
+    try:
+        with Image.open(source) as image:
+            # Let the JPEG decoder scale down while decoding instead of afterwards
+            image.draft("RGB", (photo_size, photo_size))
+            thumb = rotate_image(image)
+            thumb.thumbnail((photo_size, photo_size))
+            if thumb.mode not in ("RGB", "L"):
+                thumb = thumb.convert("RGB")
+            thumb.save(temp_spec, format=thumbnail_format.upper(), quality=85)
+        os.replace(temp_spec, thumb_spec)
+    except Exception:
+        try:
+            os.remove(temp_spec)
+        except OSError:
+            pass
+        raise
+
+
+def make_thumbnails(image_specs: Iterable[str],
+                    thumbnail_folder: str,
+                    photo_size: int,
+                    thumbnail_format: str = "jpeg",
+                    workers: Optional[int] = None) -> Dict[str, str]:
+    """Make thumbnails for all images across a process pool.
+
+    Returns a map of original image path to thumbnail path. Thumbnails whose
+    source has not changed since they were written are reused, and images
+    that could not be read are left out so the report links the original.
+    """
+    if thumbnail_format not in THUMBNAIL_FORMATS:
+        raise ValueError(f"Unknown thumbnail format: {thumbnail_format}")
+    os.makedirs(thumbnail_folder, exist_ok=True)
+
+    # List the thumbnail folder once instead of checking each file
+    existing: Dict[str, int] = {}
+    with os.scandir(thumbnail_folder) as entries:
+        for entry in entries:
+            existing[entry.name] = entry.stat().st_mtime_ns
+
+    thumbnails: Dict[str, str] = {}
+    jobs: List[Tuple[str, str, int, str, int]] = []
+    for image_spec in image_specs:
+        try:
+            mtime_ns = os.stat(image_spec).st_mtime_ns
+        except OSError:
+            continue
+        name = thumbnail_name(image_spec, thumbnail_format)
+        thumb_spec = os.path.join(thumbnail_folder, name)
+        if existing.get(name) == mtime_ns:
+            thumbnails[image_spec] = thumb_spec
+        else:
+            jobs.append((image_spec, thumb_spec, photo_size, thumbnail_format, mtime_ns))
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers <= 1 or len(jobs) < 2:
+        results = map(make_thumbnail, jobs)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(make_thumbnail, jobs, chunksize=8))
+
+    for job, thumb_spec in zip(jobs, results):
+        if thumb_spec is not None:
+            thumbnails[job[0]] = thumb_spec
+    return thumbnails